@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2026 The P4 Language Consortium
+#
+# SPDX-License-Identifier: Apache-2.0
+
+# Measures the cost of building table entries with the shell API (match fields and action
+# parameters set one by one), with the verbose output disabled and enabled with different sinks.
+# No P4Runtime server is needed, the P4Info is read from a file.
+#
+# Usage: python benchmarks/construction.py [--p4info <path>] [--num-entries N]
+
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+import google.protobuf.text_format
+from p4.config.v1 import p4info_pb2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import p4runtime_sh.shell as sh  # noqa: E402
+from p4runtime_sh import output  # noqa: E402
+
+DEFAULT_P4INFO = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "p4runtime_sh", "testdata", "unittest.p4info.pb.txt")
+
+
+def build_entries(num_entries):
+    for i in range(num_entries):
+        te = sh.TableEntry("LpmOne")(action="actionA")
+        te.match["header_test.field32"] = "10.{}.{}.0/24".format((i >> 8) & 0xff, i & 0xff)
+        te.action["param"] = "00:00:00:00:00:01"
+        te.msg()
+
+
+def run(name, num_entries, verbose, sink):
+    sh.global_options["verbose"] = verbose
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        with output.redirect_output(sink):
+            start = time.perf_counter()
+            build_entries(num_entries)
+            elapsed = time.perf_counter() - start
+    print("{:<32} {:8.1f} us/entry".format(name, elapsed / num_entries * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Table entry construction benchmark')
+    parser.add_argument('--p4info', help='P4Info file (text format)',
+                        type=str, action='store', default=DEFAULT_P4INFO)
+    parser.add_argument('--num-entries', help='Number of entries to build',
+                        type=int, action='store', default=20000)
+    args = parser.parse_args()
+
+    p4info = p4info_pb2.P4Info()
+    with open(args.p4info, 'r') as f:
+        google.protobuf.text_format.Merge(f.read(), p4info)
+    sh.context.set_p4info(p4info)
+
+    n = args.num_entries
+    run("verbose=False", n, False, output.StdoutSink())
+    run("verbose=True, SilentSink", n, True, output.SilentSink())
+    run("verbose=True, LoggingSink (off)", n, True, output.LoggingSink())
+    run("verbose=True, BufferedSink", n, True, output.BufferedSink(maxlen=1000))
+    run("verbose=True, StdoutSink", n, True, output.StdoutSink())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2026 The P4 Language Consortium
+#
+# SPDX-License-Identifier: Apache-2.0
+
+# Measures the time needed to read all the values of a large indirect counter, with
+# CounterEntry.read (one Python object per index) and with CounterPoller.poll (values decoded
+# into arrays), and to compute the rates between two samples. No P4Runtime server is needed: the
+# Read responses are returned by a stub client.
+#
+# Usage: python benchmarks/counter_poller.py [--size N]
+
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+import google.protobuf.text_format
+from p4.config.v1 import p4info_pb2
+from p4.v1 import p4runtime_pb2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import p4runtime_sh.shell as sh  # noqa: E402
+
+P4INFO = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "p4runtime_sh", "testdata", "unittest.p4info.pb.txt")
+
+
+class StubClient:
+    def __init__(self, rep):
+        self._rep = rep
+
+    def read_one(self, entity):
+        return iter([self._rep])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Counter polling benchmark')
+    parser.add_argument('--size', help='Number of indices of the counter',
+                        type=int, action='store', default=65536)
+    args = parser.parse_args()
+
+    p4info = p4info_pb2.P4Info()
+    with open(P4INFO, 'r') as f:
+        google.protobuf.text_format.Merge(f.read(), p4info)
+    counter = next(c for c in p4info.counters if c.preamble.name == "CounterA")
+    counter.size = args.size
+    sh.context.set_p4info(p4info)
+
+    rep = p4runtime_pb2.ReadResponse()
+    for i in range(args.size):
+        c = rep.entities.add().counter_entry
+        c.counter_id = counter.preamble.id
+        c.index.index = i
+        c.data.byte_count = i * 100
+        c.data.packet_count = i
+    sh.client = StubClient(rep)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        packet_count = [c.packet_count for c in sh.CounterEntry("CounterA").read()]
+        elapsed = time.perf_counter() - start
+    assert len(packet_count) == args.size
+    print("CounterEntry.read:   {:8.3f} s".format(elapsed))
+
+    poller = sh.CounterPoller("CounterA")
+    start = time.perf_counter()
+    poller.poll()
+    elapsed = time.perf_counter() - start
+    print("CounterPoller.poll:  {:8.3f} s".format(elapsed))
+
+    poller.poll()
+    start = time.perf_counter()
+    poller.rates()
+    elapsed = time.perf_counter() - start
+    print("CounterPoller.rates: {:8.3f} s".format(elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2026 The P4 Language Consortium
+#
+# SPDX-License-Identifier: Apache-2.0
+
+# Measures the rate at which table entry objects are constructed, and at which table entries
+# returned by a Read RPC are decoded into table entry objects, for a P4Info with many tables
+# (generated from the unit test P4Info by duplicating its tables). No P4Runtime server is needed:
+# the Read responses are returned by a stub client.
+#
+# Usage: python benchmarks/entity_registry.py [--num-tables N] [--num-entries N]
+
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+import google.protobuf.text_format
+from p4.config.v1 import p4info_pb2
+from p4.v1 import p4runtime_pb2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import p4runtime_sh.shell as sh  # noqa: E402
+
+P4INFO = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "p4runtime_sh", "testdata", "unittest.p4info.pb.txt")
+
+
+class StubClient:
+    def __init__(self, rep):
+        self._rep = rep
+
+    def read_one(self, entity):
+        return iter([self._rep])
+
+
+def make_p4info(num_tables):
+    p4info = p4info_pb2.P4Info()
+    with open(P4INFO, 'r') as f:
+        google.protobuf.text_format.Merge(f.read(), p4info)
+    exact = next(t for t in p4info.tables if t.preamble.name == "ExactOne")
+    for i in range(num_tables):
+        t = p4info.tables.add()
+        t.CopyFrom(exact)
+        t.preamble.id = 0x02ff0000 + i
+        t.preamble.name = "generated.Table{}".format(i)
+        t.preamble.alias = "Table{}".format(i)
+    return p4info, exact.preamble.id
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Entity construction / read decoding benchmark')
+    parser.add_argument('--num-tables', help='Number of tables to add to the P4Info',
+                        type=int, action='store', default=2000)
+    parser.add_argument('--num-entries', help='Number of entries to construct / decode',
+                        type=int, action='store', default=20000)
+    args = parser.parse_args()
+
+    p4info, table_id = make_p4info(args.num_tables)
+    sh.context.set_p4info(p4info)
+    n = args.num_entries
+
+    start = time.perf_counter()
+    for _ in range(n):
+        sh.TableEntry("ExactOne")
+    elapsed = time.perf_counter() - start
+    print("construction: {:10.0f} entries/s".format(n / elapsed))
+
+    rep = p4runtime_pb2.ReadResponse()
+    for i in range(n):
+        te = rep.entities.add().table_entry
+        te.table_id = table_id
+        mf = te.match.add()
+        mf.field_id = 1
+        mf.exact.value = i.to_bytes(4, 'big')
+    sh.client = StubClient(rep)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        count = sum(1 for _ in sh.TableEntry("ExactOne").read())
+        elapsed = time.perf_counter() - start
+    print("read decoding: {:9.0f} entries/s".format(count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2026 The P4 Language Consortium
+#
+# SPDX-License-Identifier: Apache-2.0
+
+# Measures the cost of a scrape of the metrics exporter for a large indirect counter (one series
+# per index). The first scrape encodes the label sets of all the series, the following ones only
+# read and format the values. No P4Runtime server is needed: the Read responses are returned by a
+# stub client.
+#
+# Usage: python benchmarks/exporter.py [--size N]
+
+import argparse
+import os
+import sys
+import time
+
+import google.protobuf.text_format
+from p4.config.v1 import p4info_pb2
+from p4.v1 import p4runtime_pb2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import p4runtime_sh.shell as sh  # noqa: E402
+from p4runtime_sh.exporter import MetricsExporter  # noqa: E402
+
+P4INFO = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "p4runtime_sh", "testdata", "unittest.p4info.pb.txt")
+
+
+class StubClient:
+    def __init__(self, rep):
+        self._rep = rep
+
+    def read_one(self, entity):
+        return iter([self._rep])
+
+    def stats(self):
+        return {"primary": True, "writes_in_flight": 0, "stream_out_queue": 0,
+                "stream_in_queues": {}, "subscription_queues": {}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Metrics exporter benchmark')
+    parser.add_argument('--size', help='Number of indices of the counter',
+                        type=int, action='store', default=100000)
+    args = parser.parse_args()
+
+    p4info = p4info_pb2.P4Info()
+    with open(P4INFO, 'r') as f:
+        google.protobuf.text_format.Merge(f.read(), p4info)
+    counter = next(c for c in p4info.counters if c.preamble.name == "CounterA")
+    counter.size = args.size
+    sh.context.set_p4info(p4info)
+
+    rep = p4runtime_pb2.ReadResponse()
+    for i in range(args.size):
+        c = rep.entities.add().counter_entry
+        c.counter_id = counter.preamble.id
+        c.index.index = i
+        c.data.packet_count = i
+    sh.client = StubClient(rep)
+
+    exporter = MetricsExporter(counters=["CounterA"], direct_counters=[], meters=[])
+    for name in ("first scrape", "next scrapes"):
+        start = time.perf_counter()
+        size = len(exporter.collect())
+        elapsed = time.perf_counter() - start
+        print("{:<14} {:8.3f} s ({} bytes)".format(name, elapsed, size))
+    start = time.perf_counter()
+    exporter._counters[0].poll()
+    print("{:<14} {:8.3f} s".format("read only", time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
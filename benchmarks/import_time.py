@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2026 The P4 Language Consortium
+#
+# SPDX-License-Identifier: Apache-2.0
+
+# Measures the time it takes to import p4runtime_sh.shell (the programmatic API) in a fresh
+# interpreter, and checks that it does not import IPython and its dependencies, which are only
+# needed by the interactive shell.
+#
+# Usage: python benchmarks/import_time.py [--runs N] [--max-ms T]
+# The exit status is non-zero if a forbidden module was imported or if the median import time
+# exceeds --max-ms.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+FORBIDDEN_MODULES = ["IPython", "traitlets", "jedi", "prompt_toolkit"]
+
+SNIPPET = """
+import json, resource, sys, time
+start = time.perf_counter()
+import p4runtime_sh.shell
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "elapsed": elapsed,
+    "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "forbidden": sorted(m for m in %r if m in sys.modules),
+}))
+""" % (FORBIDDEN_MODULES,)
+
+
+def run_once():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run(
+        [sys.executable, "-c", SNIPPET], cwd=root, check=True,
+        stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='p4runtime_sh.shell import time benchmark')
+    parser.add_argument('--runs', help='Number of fresh interpreters to start',
+                        type=int, action='store', default=10)
+    parser.add_argument('--max-ms', help='Fail if the median import time exceeds this value',
+                        type=float, action='store', default=None)
+    args = parser.parse_args()
+
+    # the first run populates the bytecode caches and is not measured
+    run_once()
+    results = [run_once() for _ in range(args.runs)]
+    times_ms = [r["elapsed"] * 1000 for r in results]
+    median_ms = statistics.median(times_ms)
+    print("import p4runtime_sh.shell: median {:.1f}ms, min {:.1f}ms, max {:.1f}ms ({} runs)".format(
+        median_ms, min(times_ms), max(times_ms), args.runs))
+    print("max RSS: {:.1f}MB".format(max(r["maxrss_kb"] for r in results) / 1024))
+
+    rc = 0
+    forbidden = results[0]["forbidden"]
+    if forbidden:
+        print("ERROR: importing p4runtime_sh.shell imported {}".format(", ".join(forbidden)))
+        rc = 1
+    if args.max_ms is not None and median_ms > args.max_ms:
+        print("ERROR: median import time exceeds {}ms".format(args.max_ms))
+        rc = 1
+    return rc
+
+
+if __name__ == '__main__':
+    sys.exit(main())
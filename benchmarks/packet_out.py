@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2026 The P4 Language Consortium
+#
+# SPDX-License-Identifier: Apache-2.0
+
+# Measures the packet-out rate (packets per second received by the server) when sending with
+# PacketOut, PacketOutTemplate.send and PacketOutTemplate.send_many. A P4Runtime server which
+# only counts packet-outs is started in-process: the "queued" rate is the rate at which packets
+# are handed to the client stream, the "received" rate includes the gRPC stream and the server,
+# which shares the interpreter with the client.
+#
+# Usage: python benchmarks/packet_out.py [--num-packets N] [--payload-size B]
+
+import argparse
+from concurrent import futures
+import contextlib
+import os
+import sys
+import threading
+import time
+
+from google.rpc import code_pb2
+import grpc
+from p4.v1 import p4runtime_pb2
+from p4.v1 import p4runtime_pb2_grpc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import p4runtime_sh.shell as sh  # noqa: E402
+
+TESTDATA = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "p4runtime_sh", "testdata")
+
+
+class CountingServicer(p4runtime_pb2_grpc.P4RuntimeServicer):
+    def __init__(self):
+        self.num_packets = 0
+        self.cv = threading.Condition()
+        self.p4info = None
+
+    def GetForwardingPipelineConfig(self, request, context):
+        rep = p4runtime_pb2.GetForwardingPipelineConfigResponse()
+        rep.config.p4info.CopyFrom(self.p4info)
+        return rep
+
+    def SetForwardingPipelineConfig(self, request, context):
+        self.p4info = request.config.p4info
+        return p4runtime_pb2.SetForwardingPipelineConfigResponse()
+
+    def StreamChannel(self, request_iterator, context):
+        for req in request_iterator:
+            if req.HasField('arbitration'):
+                rep = p4runtime_pb2.StreamMessageResponse()
+                rep.arbitration.CopyFrom(req.arbitration)
+                rep.arbitration.status.code = code_pb2.OK
+                yield rep
+            elif req.HasField('packet'):
+                with self.cv:
+                    self.num_packets += 1
+                    self.cv.notify_all()
+
+    def wait_for(self, num_packets):
+        with self.cv:
+            self.cv.wait_for(lambda: self.num_packets >= num_packets)
+
+
+def run(name, servicer, num_packets, send):
+    target = servicer.num_packets + num_packets
+    start = time.perf_counter()
+    send()
+    queued = time.perf_counter() - start
+    servicer.wait_for(target)
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:10.0f} pps queued {:10.0f} pps received".format(
+        name, num_packets / queued, num_packets / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Packet-out rate benchmark')
+    parser.add_argument('--num-packets', help='Number of packets to send for each method',
+                        type=int, action='store', default=20000)
+    parser.add_argument('--payload-size', help='Payload size in bytes',
+                        type=int, action='store', default=64)
+    args = parser.parse_args()
+
+    servicer = CountingServicer()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    p4runtime_pb2_grpc.add_P4RuntimeServicer_to_server(servicer, server)
+    port = server.add_insecure_port('localhost:0')
+    server.start()
+
+    config = sh.FwdPipeConfig(os.path.join(TESTDATA, "unittest.p4info.pb.txt"),
+                              os.path.join(TESTDATA, "unittest.bin"))
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        sh.setup(device_id=0, grpc_addr="localhost:{}".format(port), election_id=(0, 1),
+                 config=config)
+
+    n = args.num_packets
+    payload = os.urandom(args.payload_size)
+    payloads = [payload] * n
+
+    def send_packet_out():
+        for p in payloads:
+            sh.PacketOut(p, egress_port="1").send()
+
+    template = sh.PacketOutTemplate(egress_port="1")
+
+    def send_template():
+        for p in payloads:
+            template.send(p)
+
+    try:
+        run("PacketOut.send", servicer, n, send_packet_out)
+        run("PacketOutTemplate.send", servicer, n, send_template)
+        run("PacketOutTemplate.send_many", servicer, n, lambda: template.send_many(payloads))
+    finally:
+        sh.teardown()
+        server.stop(None)
+
+
+if __name__ == '__main__':
+    main()
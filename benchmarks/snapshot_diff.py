@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2026 The P4 Language Consortium
+#
+# SPDX-License-Identifier: Apache-2.0
+
+# Measures the cost of building snapshots of table entries and of computing the diff between
+# two snapshots (1% of the entries modified, 1% deleted and 1% inserted). No P4Runtime server is
+# needed.
+#
+# Usage: python benchmarks/snapshot_diff.py [--num-entries N]
+
+import argparse
+import os
+import sys
+import time
+
+from p4.v1 import p4runtime_pb2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from p4runtime_sh import snapshot  # noqa: E402
+
+
+def make_entity(i, param):
+    entity = p4runtime_pb2.Entity()
+    te = entity.table_entry
+    te.table_id = 33574068
+    mf = te.match.add()
+    mf.field_id = 1
+    mf.lpm.value = i.to_bytes(4, 'big')
+    mf.lpm.prefix_len = 32
+    te.action.action.action_id = 16783703
+    p = te.action.action.params.add()
+    p.param_id = 1
+    p.value = param.to_bytes(6, 'big')
+    return entity
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Snapshot diff benchmark')
+    parser.add_argument('--num-entries', help='Number of table entries in each snapshot',
+                        type=int, action='store', default=100000)
+    args = parser.parse_args()
+    n = args.num_entries
+    step = 100
+
+    current_entities = [make_entity(i, 1) for i in range(n)]
+    desired_entities = [make_entity(i, 2 if i % step == 1 else 1)
+                        for i in range(n + n // step) if i % step != 0]
+
+    start = time.perf_counter()
+    current = snapshot.Snapshot(current_entities)
+    desired = snapshot.Snapshot(desired_entities)
+    elapsed = time.perf_counter() - start
+    print("build: {:8.2f} s ({:.1f} us/entry)".format(
+        elapsed, elapsed / (len(current) + len(desired)) * 1e6))
+
+    start = time.perf_counter()
+    diff = current.diff(desired)
+    elapsed = time.perf_counter() - start
+    print("diff:  {:8.2f} s ({:.1f} us/entry), {}".format(
+        elapsed, elapsed / n * 1e6, diff.counts()))
+
+
+if __name__ == '__main__':
+    main()
@@ -79,16 +79,10 @@ def str_to_bytes(value_str):
 
 
 def to_canonical_bytes(bytes_):
-    if len(bytes_) == 0:
-        return bytes_
-    num_zeros = 0
-    for b in bytes_:
-        if b != 0:
-            break
-        num_zeros += 1
-    if num_zeros == len(bytes_):
-        return bytes_[:1]
-    return bytes_[num_zeros:]
+    stripped = bytes_.lstrip(b'\x00')
+    if stripped or not bytes_:
+        return stripped
+    return bytes_[:1]
 
 
 def make_canonical_if_option_set(bytes_):
@@ -97,25 +91,53 @@ def make_canonical_if_option_set(bytes_):
     return bytes_
 
 
-def parse_value(value_str, bitwidth, base=0):
-    if bitwidth == 0:
-        return str_to_bytes(value_str)
-    if bitwidth == 32 and '.' in value_str:
-        return ipv4Addr_to_bytes(value_str)
-    elif bitwidth == 48 and ':' in value_str:
-        return macAddr_to_bytes(value_str)
-    elif bitwidth == 128 and ':' in value_str:
-        return ipv6Addr_to_bytes(value_str)
+def _int_str_to_bytes(value_str, nbytes, base):
     try:
         value = int(value_str, base)
     except ValueError:
         raise UserBadValueError(
             "Invalid value '{}': could not cast to integer, try in hex with 0x prefix".format(
                 value_str))
-    nbytes = (bitwidth + 7) // 8
     try:
         return value.to_bytes(nbytes, byteorder='big')
     except OverflowError:
         raise UserBadValueError(
             "Invalid value '{}': cannot be represented with '{}' bytes".format(
                 value_str, nbytes))
+
+
+def parse_value(value_str, bitwidth, base=0):
+    if bitwidth == 0:
+        return str_to_bytes(value_str)
+    if bitwidth == 32 and '.' in value_str:
+        return ipv4Addr_to_bytes(value_str)
+    elif bitwidth == 48 and ':' in value_str:
+        return macAddr_to_bytes(value_str)
+    elif bitwidth == 128 and ':' in value_str:
+        return ipv6Addr_to_bytes(value_str)
+    return _int_str_to_bytes(value_str, (bitwidth + 7) // 8, base)
+
+
+def make_value_parser(bitwidth, base=0):
+    """Returns a function which behaves like parse_value for the given bitwidth. The checks which
+    only depend on the bitwidth are done once, which matters when parsing many values for the same
+    field (e.g. when loading entries from a file)."""
+    if bitwidth == 0:
+        return str_to_bytes
+    nbytes = (bitwidth + 7) // 8
+    if bitwidth == 32:
+        addr_sep, addr_to_bytes = '.', ipv4Addr_to_bytes
+    elif bitwidth == 48:
+        addr_sep, addr_to_bytes = ':', macAddr_to_bytes
+    elif bitwidth == 128:
+        addr_sep, addr_to_bytes = ':', ipv6Addr_to_bytes
+    else:
+        def parse_int(value_str):
+            return _int_str_to_bytes(value_str, nbytes, base)
+        return parse_int
+
+    def parse(value_str):
+        if addr_sep in value_str:
+            return addr_to_bytes(value_str)
+        return _int_str_to_bytes(value_str, nbytes, base)
+    return parse
@@ -51,14 +51,28 @@ class P4RuntimeEntity(enum.Enum):
 class Context:
     def __init__(self):
         self.p4info = None
+        self._cache = {}
 
     def set_p4info(self, p4info):
         self.p4info = p4info
         self.p4info_obj_map = {}
         self.p4info_obj_map_by_id = {}
         self.p4info_objs_by_type = {}
+        self.p4info_names_by_type = {}
+        self._cache = {}
         self._import_p4info_names()
 
+    # Used by other modules to store data derived from the P4Info message (e.g. per-table
+    # information shared by all TableEntry instances). builder is only called the first time a key
+    # is requested; the cache is cleared every time the P4Info message changes.
+    def get_cached(self, key, builder):
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = builder()
+            self._cache[key] = value
+            return value
+
     def get_obj(self, obj_type, name):
         key = (obj_type, name)
         return self.p4info_obj_map.get(key, None)
@@ -73,17 +87,13 @@ class Context:
         a = self.get_obj(P4Type.action, action_name)
         if a is None:
             return None
-        for p in a.params:
-            if p.name == name:
-                return p
+        return self._params_by_name[a.preamble.id].get(name)
 
     def get_mf(self, table_name, name):
         t = self.get_obj(P4Type.table, table_name)
         if t is None:
             return None
-        for mf in t.match_fields:
-            if mf.name == name:
-                return mf
+        return self._mfs_by_name[t.preamble.id].get(name)
 
     def get_param_id(self, action_name, name):
         p = self.get_param(action_name, name)
@@ -97,23 +107,25 @@ class Context:
         a = self.get_obj(P4Type.action, action_name)
         if a is None:
             return None
-        for p in a.params:
-            if p.id == id_:
-                return p.name
+        p = self._params_by_id[a.preamble.id].get(id_)
+        return None if p is None else p.name
 
     def get_mf_name(self, table_name, id_):
         t = self.get_obj(P4Type.table, table_name)
         if t is None:
             return None
-        for mf in t.match_fields:
-            if mf.id == id_:
-                return mf.name
+        mf = self._mfs_by_id[t.preamble.id].get(id_)
+        return None if mf is None else mf.name
 
     def get_objs(self, obj_type):
         m = self.p4info_objs_by_type[obj_type]
         for name, obj in m.items():
             yield name, obj
 
+    # Sorted names of all the objects of the given type, computed once per P4Info message.
+    def get_obj_names(self, obj_type):
+        return self.p4info_names_by_type[obj_type]
+
     def get_name_from_id(self, id_):
         return self.p4info_obj_map_by_id[id_].preamble.name
 
@@ -124,10 +136,32 @@ class Context:
         ctrl_pkt_md = self.get_obj(P4Type.controller_packet_metadata, ctrl_pkt_md_name)
         if not ctrl_pkt_md:
             return None
-        for md in ctrl_pkt_md.metadata:
-            if md.id == id_:
-                return md.name
-        return None
+        md = self._pkt_md_by_id[ctrl_pkt_md.preamble.id].get(id_)
+        return None if md is None else md.name
+
+    # Indexes (by name and by id) for the match fields of each table, the parameters of each
+    # action and the metadata fields of each controller header, keyed by the id of the parent
+    # object. If a name or id is repeated, the first occurrence wins, as with a linear search.
+    def _index_p4info_fields(self):
+        def index(fields, attr):
+            d = {}
+            for f in fields:
+                d.setdefault(getattr(f, attr), f)
+            return d
+
+        self._mfs_by_name = {}
+        self._mfs_by_id = {}
+        for t in self.p4info.tables:
+            self._mfs_by_name[t.preamble.id] = index(t.match_fields, "name")
+            self._mfs_by_id[t.preamble.id] = index(t.match_fields, "id")
+        self._params_by_name = {}
+        self._params_by_id = {}
+        for a in self.p4info.actions:
+            self._params_by_name[a.preamble.id] = index(a.params, "name")
+            self._params_by_id[a.preamble.id] = index(a.params, "id")
+        self._pkt_md_by_id = {}
+        for ctrl_pkt_md in self.p4info.controller_packet_metadata:
+            self._pkt_md_by_id[ctrl_pkt_md.preamble.id] = index(ctrl_pkt_md.metadata, "id")
 
     # In order to make the CLI easier to use, we accept any suffix that
     # uniquely identifies the object among p4info objects of the same type.
@@ -145,9 +179,11 @@ class Context:
                     key = (obj_type, suffix)
                     self.p4info_obj_map[key] = obj
                     suffix_count[key] += 1
+            self.p4info_names_by_type[obj_type] = tuple(sorted(self.p4info_objs_by_type[obj_type]))
         for key, c in suffix_count.items():
             if c > 1:
                 del self.p4info_obj_map[key]
+        self._index_p4info_fields()
 
 
 # Add p4info object and object id "getters" for each object type; these are just
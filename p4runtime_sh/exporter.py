@@ -0,0 +1,393 @@
+# SPDX-FileCopyrightText: 2026 The P4 Language Consortium
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+import math
+import os
+import re
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+import time
+
+from p4.config.v1 import p4info_pb2
+from p4.v1 import p4runtime_pb2
+from . import shell
+from .context import P4Type
+from .p4runtime import P4RuntimeException, parse_p4runtime_error
+from .utils import UserError
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+_BYTES_UNITS = (p4info_pb2.CounterSpec.UNSPECIFIED, p4info_pb2.CounterSpec.BYTES,
+                p4info_pb2.CounterSpec.BOTH)
+_PACKETS_UNITS = (p4info_pb2.CounterSpec.UNSPECIFIED, p4info_pb2.CounterSpec.PACKETS,
+                  p4info_pb2.CounterSpec.BOTH)
+_METER_PARAMS = ("cir", "cburst", "pir", "pburst")
+
+
+def _label_name(name):
+    # e.g. "match_hdr.ipv4.dst_addr" -> "match_hdr_ipv4_dst_addr"
+    name = re.sub("[^a-zA-Z0-9_]", "_", name)
+    return "_" + name if name[:1].isdigit() else name
+
+
+def _label_value(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    return "{" + ",".join('{}="{}"'.format(k, _label_value(str(v))) for k, v in labels) + "}"
+
+
+def _hex(value):
+    return "{:#x}".format(int.from_bytes(value, byteorder='big'))
+
+
+def _format_match(match_type, field_key):
+    # field_key is an element of the field matches of a table entry key (see
+    # shell.table_entry_key), the value uses the syntax of the shell's match fields
+    if match_type == p4info_pb2.MatchField.LPM:
+        return "{}/{}".format(_hex(field_key[1]), field_key[2])
+    if match_type == p4info_pb2.MatchField.TERNARY:
+        return "{}&&&{}".format(_hex(field_key[1]), _hex(field_key[2]))
+    if match_type == p4info_pb2.MatchField.RANGE:
+        return "{}..{}".format(_hex(field_key[1]), _hex(field_key[2]))
+    return _hex(field_key[1])
+
+
+def _write_family(out, name, type_, help_, series):
+    # series: list of (prefixes, values), where each prefix is the sample name followed by its
+    # labels and a space
+    out.append("# TYPE {} {}\n# HELP {} {}\n".format(name, type_, name, help_))
+    for prefixes, values in series:
+        if prefixes:
+            out.append("\n".join(map(str.__add__, prefixes, map(str, values))))
+            out.append("\n")
+
+
+def _series(name, samples):
+    # samples: list of (labels, value)
+    return (["{}{} ".format(name, _labels(labels) if labels else "") for labels, _ in samples],
+            [value for _, value in samples])
+
+
+class _CounterSeries:
+    # The values of an indirect or direct counter, read with a CounterPoller. The label sets of
+    # the samples are encoded once per counter index (or table entry) and reused for every scrape.
+    # For direct counters, the poller drops the rows of deleted table entries, which are then no
+    # longer exported.
+
+    def __init__(self, counter):
+        self.name = counter.preamble.name
+        self.poller = shell.CounterPoller(self.name, history=2)
+        self.direct = self.poller.direct
+        unit = counter.spec.unit
+        self.units = []
+        if unit in _BYTES_UNITS:
+            self.units.append("bytes")
+        if unit in _PACKETS_UNITS:
+            self.units.append("packets")
+        self.sample = None
+        self._prefixes = {u: [] for u in self.units}
+        # direct counters: table entry key of each row with a prefix, and value of
+        # CounterPoller.compactions when the prefixes were last moved
+        self._keys = []
+        self._compactions = 0
+        if self.direct:
+            self._table_name = shell.context.get_name_from_id(counter.direct_table_id)
+            table = shell.context.get_table(self._table_name)
+            self._fields = {mf.id: (_label_name("match_" + mf.name), mf.match_type)
+                            for mf in table.match_fields}
+
+    def _row_labels(self, row):
+        if not self.direct:
+            return (("counter", self.name), ("index", row))
+        _, priority, _, matches = self.poller.keys[row]
+        labels = [("counter", self.name), ("table", self._table_name)]
+        for field_key in matches:
+            name, match_type = self._fields.get(field_key[0], (None, None))
+            if name is None:
+                name = "match_{}".format(field_key[0])
+            labels.append((name, _format_match(match_type, field_key)))
+        if priority:
+            labels.append(("priority", priority))
+        return labels
+
+    def poll(self):
+        self.sample = self.poller.poll()
+        if self.poller.compactions != self._compactions:
+            # direct counters: the rows of deleted table entries were dropped, the prefixes of the
+            # remaining entries move to their new rows (in the same order)
+            self._compactions = self.poller.compactions
+            old_rows = {key: row for row, key in enumerate(self._keys)}
+            kept = [old_rows[key] for key in self.poller.keys if key in old_rows]
+            for u in self.units:
+                prefixes = self._prefixes[u]
+                self._prefixes[u] = [prefixes[row] for row in kept]
+            self._keys = [self._keys[row] for row in kept]
+        # direct counters: new table entries get new rows
+        num_rows = len(self.sample.packet_count)
+        num_prefixes = len(self._prefixes[self.units[0]])
+        if num_prefixes < num_rows:
+            family = "p4_direct_counter" if self.direct else "p4_counter"
+            for row in range(num_prefixes, num_rows):
+                labels = _labels(self._row_labels(row))
+                for u in self.units:
+                    self._prefixes[u].append("{}_{}_total{} ".format(family, u, labels))
+                if self.direct:
+                    self._keys.append(self.poller.keys[row])
+
+    def series(self, unit):
+        if self.sample is None or unit not in self.units:
+            return None
+        values = self.sample.byte_count if unit == "bytes" else self.sample.packet_count
+        return (self._prefixes[unit], values)
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsExporter:
+    """
+    Exports the values of the counters and meters of the P4 program, and metrics of the P4Runtime
+    client, in the OpenMetrics text format. The values are read from the device for every scrape,
+    with one wildcard read per counter or meter. By default, all the indirect counters, direct
+    counters and indirect meters are exported; to export only some of them, provide lists of
+    names.
+
+    Indirect counters are exported as p4_counter_bytes_total / p4_counter_packets_total, with
+    counter and index labels, and direct counters as p4_direct_counter_bytes_total /
+    p4_direct_counter_packets_total, with counter and table labels and one label for each match
+    field of the entry (named after the match field, e.g. match_hdr_ipv4_dst_addr), plus priority
+    for entries with a priority. Meter configurations are exported as p4_meter_cir, p4_meter_cburst,
+    p4_meter_pir and p4_meter_pburst gauges. The label sets are encoded once per series, so a scrape
+    mostly costs the wildcard reads.
+
+    The client metrics include the state of the stream queues and, if metrics are enabled for the
+    client (see P4RuntimeClient.enable_metrics), the RPC counts, errors, latency histograms and
+    bytes sent / received.
+
+    exporter = MetricsExporter(counters=["MyIngress.port_counter"], direct_counters=[])
+    exporter.serve(port=9464)  # http://localhost:9464/metrics, in a background thread
+    exporter.write_textfile("/var/lib/node_exporter/p4.prom")  # or write to a file
+    """
+
+    def __init__(self, counters=None, direct_counters=None, meters=None):
+        context = shell.context
+        self._counters = []
+        for obj_type, names in ((P4Type.counter, counters),
+                                (P4Type.direct_counter, direct_counters)):
+            if names is None:
+                names = [name for name, _ in context.get_objs(obj_type)]
+            for name in names:
+                counter = context.get_obj(obj_type, name)
+                if counter is None:
+                    raise UserError("{} '{}' does not exist".format(obj_type.pretty_name, name))
+                self._counters.append(_CounterSeries(counter))
+        if meters is None:
+            meters = [name for name, _ in context.get_objs(P4Type.meter)]
+        self._meters = []
+        for name in meters:
+            meter = context.get_meter(name)
+            if meter is None:
+                raise UserError("meter '{}' does not exist".format(name))
+            self._meters.append(meter)
+        self.scrapes = 0
+        self.read_errors = 0
+        self.last_scrape_duration = 0
+        self._lock = Lock()
+        self._server = None
+        self._thread = None
+
+    @parse_p4runtime_error
+    def _read_meter(self, meter):
+        entity = p4runtime_pb2.Entity()
+        entity.meter_entry.meter_id = meter.preamble.id
+        entries = []
+        for rep in shell.client.read_one(entity):
+            for e in rep.entities:
+                if e.meter_entry.HasField("config"):
+                    entries.append((e.meter_entry.index.index, e.meter_entry.config))
+        return entries
+
+    def _write_counters(self, out, direct):
+        counters = [c for c in self._counters if c.direct == direct]
+        if not counters:
+            return
+        family = "p4_direct_counter" if direct else "p4_counter"
+        kind = "direct counters" if direct else "indirect counters"
+        for unit in ("bytes", "packets"):
+            series = [s for s in (c.series(unit) for c in counters) if s is not None]
+            if series:
+                _write_family(out, "{}_{}".format(family, unit), "counter",
+                              "{} count of P4 {}.".format(unit.capitalize()[:-1], kind), series)
+
+    def _write_meters(self, out, meter_entries):
+        if not meter_entries:
+            return
+        for param in _METER_PARAMS:
+            prefixes = []
+            values = []
+            for name, entries in meter_entries:
+                for index, config in entries:
+                    prefixes.append("p4_meter_{}{} ".format(
+                        param, _labels((("meter", name), ("index", index)))))
+                    values.append(getattr(config, param))
+            _write_family(out, "p4_meter_" + param, "gauge",
+                          "Configured {} of P4 indirect meters.".format(param),
+                          [(prefixes, values)])
+
+    def _write_client(self, out):
+        stats = shell.client.stats()
+        _write_family(out, "p4runtime_client_primary", "gauge",
+                      "Whether the P4Runtime client is the primary client.",
+                      [_series("p4runtime_client_primary", [((), int(bool(stats["primary"])))])])
+        _write_family(out, "p4runtime_client_writes_in_flight", "gauge",
+                      "Number of WriteRequests sent and not completed yet.",
+                      [_series("p4runtime_client_writes_in_flight",
+                               [((), stats["writes_in_flight"])])])
+        queues = [((("queue", "out"),), stats["stream_out_queue"])]
+        queues.extend(((("queue", t),), n) for t, n in stats["stream_in_queues"].items())
+        queues.extend(((("queue", t), ("subscriptions", "true")), n)
+                      for t, n in stats["subscription_queues"].items())
+        _write_family(out, "p4runtime_client_stream_queue_depth", "gauge",
+                      "Number of StreamChannel messages waiting in the client queues.",
+                      [_series("p4runtime_client_stream_queue_depth", queues)])
+        if "rpcs" in stats:
+            self._write_client_metrics(out, stats)
+        _write_family(out, "p4runtime_exporter_read_errors", "counter",
+                      "Number of counter and meter reads which failed during scrapes.",
+                      [_series("p4runtime_exporter_read_errors_total", [((), self.read_errors)])])
+        _write_family(out, "p4runtime_exporter_scrape_duration_seconds", "gauge",
+                      "Duration of the previous scrape.",
+                      [_series("p4runtime_exporter_scrape_duration_seconds",
+                               [((), self.last_scrape_duration)])])
+
+    def _write_client_metrics(self, out, stats):
+        rpcs = sorted(stats["rpcs"].items())
+        _write_family(out, "p4runtime_client_rpcs", "counter", "Number of RPCs completed.",
+                      [_series("p4runtime_client_rpcs_total",
+                               [((("rpc", rpc),), m["calls"]) for rpc, m in rpcs])])
+        _write_family(out, "p4runtime_client_rpc_errors", "counter",
+                      "Number of failed RPCs, by gRPC status code.",
+                      [_series("p4runtime_client_rpc_errors_total",
+                               [((("rpc", rpc), ("code", code)), n)
+                                for rpc, m in rpcs for code, n in sorted(m["errors"].items())])])
+        _write_family(out, "p4runtime_client_rpc_p4_errors", "counter",
+                      "Number of failed updates in WriteRequests, by P4Runtime error code.",
+                      [_series("p4runtime_client_rpc_p4_errors_total",
+                               [((("rpc", rpc), ("code", code)), n)
+                                for rpc, m in rpcs for code, n in sorted(m["p4_errors"].items())])])
+        histogram = []
+        for rpc, m in rpcs:
+            for le, n in m["latency_histogram"]:
+                le = "+Inf" if le == math.inf else le
+                histogram.append(("p4runtime_client_rpc_latency_seconds_bucket",
+                                  (("rpc", rpc), ("le", le)), n))
+            histogram.append(("p4runtime_client_rpc_latency_seconds_count", (("rpc", rpc),),
+                              m["calls"]))
+            histogram.append(("p4runtime_client_rpc_latency_seconds_sum", (("rpc", rpc),),
+                              m["latency_sum"]))
+        _write_family(out, "p4runtime_client_rpc_latency_seconds", "histogram",
+                      "Latency of the RPCs.",
+                      [(["{}{} ".format(name, _labels(labels)) for name, labels, _ in histogram],
+                        [n for _, _, n in histogram])])
+        for direction in ("sent", "received"):
+            _write_family(out, "p4runtime_client_rpc_{}_bytes".format(direction), "counter",
+                          "Serialized size of the messages {} in RPCs.".format(direction),
+                          [_series("p4runtime_client_rpc_{}_bytes_total".format(direction),
+                                   [((("rpc", rpc),), m["bytes_" + direction])
+                                    for rpc, m in rpcs])])
+        stream = stats["stream"]
+        _write_family(out, "p4runtime_client_stream_messages_received", "counter",
+                      "Number of StreamChannel messages received, by type.",
+                      [_series("p4runtime_client_stream_messages_received_total",
+                               [((("type", t),), n)
+                                for t, n in sorted(stream["messages_received"].items())])])
+        _write_family(out, "p4runtime_client_stream_messages_sent", "counter",
+                      "Number of StreamChannel messages sent.",
+                      [_series("p4runtime_client_stream_messages_sent_total",
+                               [((), stream["messages_sent"])])])
+        for direction in ("sent", "received"):
+            _write_family(out, "p4runtime_client_stream_{}_bytes".format(direction), "counter",
+                          "Size of the StreamChannel messages {}.".format(direction),
+                          [_series("p4runtime_client_stream_{}_bytes_total".format(direction),
+                                   [((), stream["bytes_" + direction])])])
+
+    def collect(self):
+        """Reads the counters and meters from the device and returns the metrics, in the
+        OpenMetrics text format."""
+        with self._lock:
+            start = time.monotonic()
+            for c in self._counters:
+                try:
+                    c.poll()
+                except P4RuntimeException as e:
+                    logging.error("Error when reading counter '{}': {}".format(c.name, e))
+                    self.read_errors += 1
+                    c.sample = None
+            meter_entries = []
+            for meter in self._meters:
+                try:
+                    meter_entries.append((meter.preamble.name, self._read_meter(meter)))
+                except P4RuntimeException as e:
+                    logging.error("Error when reading meter '{}': {}".format(
+                        meter.preamble.name, e))
+                    self.read_errors += 1
+            out = []
+            self._write_counters(out, direct=False)
+            self._write_counters(out, direct=True)
+            self._write_meters(out, meter_entries)
+            self._write_client(out)
+            out.append("# EOF\n")
+            self.scrapes += 1
+            self.last_scrape_duration = time.monotonic() - start
+            return "".join(out)
+
+    def write_textfile(self, path):
+        """Writes the metrics to a file (replaced atomically), e.g. for the node_exporter textfile
+        collector."""
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.collect())
+        os.replace(tmp_path, path)
+
+    def serve(self, port=9464, address="127.0.0.1"):
+        """Serves the metrics over HTTP (at /metrics) in a background thread, until shutdown() is
+        called. Returns the port, which is useful when port is 0 (any available port)."""
+        if self._server is not None:
+            raise UserError("The exporter is already serving metrics")
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.collect().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("Metrics exporter: " + format % args)
+
+        self._server = _HTTPServer((address, port), Handler)
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self._server.server_address[1]
+
+    def shutdown(self):
+        """Stops serving metrics over HTTP."""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
@@ -6,9 +6,16 @@ import enum
 from .utils import UserError
 
 
+@enum.unique
 class Options(enum.Enum):
-    canonical_bytestrings = bool
-    verbose = bool
+    canonical_bytestrings = 1
+    verbose = 2
+
+
+# The type of each option. It cannot be used as the enum value, as options with the same type would
+# then be aliases of each other.
+Options.canonical_bytestrings.type = bool
+Options.verbose.type = bool
 
 
 class UnknownOptionName(UserError):
@@ -26,7 +33,7 @@ class InvalidOptionValueType(UserError):
 
     def __str__(self):
         return "Invalid value type for option {}: expected {} but got value {} with type {}".format(
-            self.option.name, self.option.value.__name__, self.value, type(self.value).__name__)
+            self.option.name, self.option.type.__name__, self.value, type(self.value).__name__)
 
 
 class GlobalOptions:
@@ -43,6 +50,7 @@ instead of the canonical representation. See P4Runtime specification for details
         Options.verbose: """
 Print a text style representation of the protobuf contents of P4Runtime
 messages while creating them using methods in the p4runtime-shell package.
+The output goes to stdout by default, see p4runtime_sh.output to change it.
 """
     }
 
@@ -59,13 +67,13 @@ messages while creating them using methods in the p4runtime-shell package.
             self._values[option] = GlobalOptions.option_defaults[option]
 
     def _supported_options_as_str(self):
-        return ", ".join(["{} ({})".format(o.name, o.value.__name__) for o in Options])
+        return ", ".join(["{} ({})".format(o.name, o.type.__name__) for o in Options])
 
     def _supported_options_as_str_verbose(self):
         s = ""
         for option in Options:
             s += "Option name: {}\n".format(option.name)
-            s += "Type: {}\n".format(option.value.__name__)
+            s += "Type: {}\n".format(option.type.__name__)
             s += "Default value: {}\n".format(GlobalOptions.option_defaults[option])
             s += "Description: {}\n".format(GlobalOptions.option_helpstrings.get(option, "N/A"))
             s += "\n"
@@ -102,7 +110,7 @@ To reset all options to their default value, use global_options.reset
             option = Options[name]
         except KeyError:
             raise UnknownOptionName(name)
-        if type(value) != option.value:
+        if type(value) != option.type:
             raise InvalidOptionValueType(option, value)
         self.set_option(option, value)
 
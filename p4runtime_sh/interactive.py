@@ -0,0 +1,28 @@
+# SPDX-FileCopyrightText: 2026 The P4 Language Consortium
+#
+# SPDX-License-Identifier: Apache-2.0
+
+# IPython-specific parts of the shell. This module is only imported when the interactive shell is
+# started, so that importing p4runtime_sh.shell to use the API programmatically does not pay for
+# importing IPython (which takes several hundred milliseconds).
+
+from IPython import start_ipython
+from traitlets.config.loader import Config
+from IPython.terminal.prompts import Prompts, Token
+
+
+# see https://ipython.readthedocs.io/en/stable/config/details.html
+class MyPrompt(Prompts):
+    def in_prompt_tokens(self, cli=None):
+        return [(Token.Prompt, 'P4Runtime sh'),
+                (Token.PrompSeparator, ' >>> ')]
+
+
+def start(user_ns):
+    c = Config()
+    c.TerminalInteractiveShell.banner1 = '*** Welcome to the IPython shell for P4Runtime ***'
+    c.TerminalInteractiveShell.prompts_class = MyPrompt
+    c.TerminalInteractiveShell.autocall = 2
+    c.TerminalInteractiveShell.show_rewritten_input = False
+
+    start_ipython(user_ns=user_ns, config=c, argv=[])
@@ -0,0 +1,92 @@
+# SPDX-FileCopyrightText: 2026 The P4 Language Consortium
+#
+# SPDX-License-Identifier: Apache-2.0
+
+# Destination of the messages printed by the shell while P4Runtime entities are being built (e.g.
+# the FieldMatch message after a match field is set), when the verbose global option is set. The
+# messages are only formatted if the current sink is enabled, so a disabled sink (or verbose set to
+# False) costs nothing.
+
+import collections
+import contextlib
+import logging
+
+
+class OutputSink:
+    """Base class for output sinks."""
+    def is_enabled(self):
+        return True
+
+    def write(self, text):
+        raise NotImplementedError
+
+
+class StdoutSink(OutputSink):
+    """Prints messages to stdout, this is the default."""
+    def write(self, text):
+        print(text)
+
+
+class SilentSink(OutputSink):
+    """Discards messages, which are never formatted."""
+    def is_enabled(self):
+        return False
+
+    def write(self, text):
+        pass
+
+
+class BufferedSink(OutputSink):
+    """Stores messages in memory, keeping only the last maxlen ones if maxlen is not None."""
+    def __init__(self, maxlen=None):
+        self.lines = collections.deque(maxlen=maxlen)
+
+    def write(self, text):
+        self.lines.append(text)
+
+    def getvalue(self):
+        return "\n".join(self.lines)
+
+    def clear(self):
+        self.lines.clear()
+
+
+class LoggingSink(OutputSink):
+    """Sends messages to a logger (the 'p4runtime_sh' logger by default). Messages are only
+    formatted if the logger is enabled for the level."""
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logging.getLogger("p4runtime_sh") if logger is None else logger
+        self.level = level
+
+    def is_enabled(self):
+        return self.logger.isEnabledFor(self.level)
+
+    def write(self, text):
+        self.logger.log(self.level, text)
+
+
+_sink = StdoutSink()
+
+
+def get_output_sink():
+    return _sink
+
+
+def set_output_sink(sink):
+    """Sets the sink used for all subsequent output, returns the previous one."""
+    global _sink
+    if not isinstance(sink, OutputSink):
+        raise TypeError("sink must be an instance of OutputSink")
+    previous = _sink
+    _sink = sink
+    return previous
+
+
+@contextlib.contextmanager
+def redirect_output(sink):
+    """Context manager which sets the output sink for the duration of its scope."""
+    previous = set_output_sink(sink)
+    try:
+        yield sink
+    finally:
+        set_output_sink(previous)
@@ -2,14 +2,22 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import asyncio
+import bisect
+from collections import Counter, deque
+from concurrent import futures
 from functools import wraps
 import google.protobuf.text_format
 from google.rpc import status_pb2, code_pb2
 import grpc
+import grpc.aio
+import inspect
+import itertools
 import logging
+import math
 import queue
-import sys
 import threading
+import time
 from typing import NamedTuple
 
 from p4.v1 import p4runtime_pb2
@@ -54,10 +62,10 @@ class P4RuntimeErrorIterator:
             if not one_error_any.Unpack(p4_error):
                 raise P4RuntimeErrorFormatException(
                     "Cannot convert Any message to p4.Error")
-            if p4_error.canonical_code == code_pb2.OK:
-                continue
             v = self.idx, p4_error
             self.idx += 1
+            if p4_error.canonical_code == code_pb2.OK:
+                continue
             return v
         raise StopIteration
 
@@ -102,7 +110,19 @@ class P4RuntimeException(Exception):
         return message
 
 
+# Both decorators support regular functions and coroutine functions (for AsyncP4RuntimeClient).
 def parse_p4runtime_write_error(f):
+    if inspect.iscoroutinefunction(f):
+        @wraps(f)
+        async def handle_async(*args, **kwargs):
+            try:
+                return await f(*args, **kwargs)
+            except grpc.RpcError as e:
+                if e.code() != grpc.StatusCode.UNKNOWN:
+                    raise e
+                raise P4RuntimeWriteException(e) from None
+        return handle_async
+
     @wraps(f)
     def handle(*args, **kwargs):
         try:
@@ -115,6 +135,15 @@ def parse_p4runtime_write_error(f):
 
 
 def parse_p4runtime_error(f):
+    if inspect.iscoroutinefunction(f):
+        @wraps(f)
+        async def handle_async(*args, **kwargs):
+            try:
+                return await f(*args, **kwargs)
+            except grpc.RpcError as e:
+                raise P4RuntimeException(e) from None
+        return handle_async
+
     @wraps(f)
     def handle(*args, **kwargs):
         try:
@@ -135,16 +164,417 @@ def read_pem_file(path):
     try:
         with open(path, 'rb') as f:
             return f.read()
-    except Exception:
-        logging.critical("Cannot read from PEM file '{}'".format(path))
-        sys.exit(1)
+    except Exception as e:
+        raise ConnectionError("Cannot read from PEM file '{}'".format(path)) from e
+
+
+def ssl_channel_credentials(ssl_options):
+    # root certificates are retrieved from a default location chosen by gRPC runtime unless
+    # the user provides custom certificates.
+    root_certificates = None
+    if ssl_options.cacert is not None:
+        root_certificates = read_pem_file(ssl_options.cacert)
+    certificate_chain = None
+    if ssl_options.cert is not None:
+        certificate_chain = read_pem_file(ssl_options.cert)
+    private_key = None
+    if ssl_options.key is not None:
+        private_key = read_pem_file(ssl_options.key)
+    return grpc.ssl_channel_credentials(root_certificates, private_key, certificate_chain)
+
+
+def make_set_fwd_pipe_config_request(client, p4info_path, bin_path):
+    req = p4runtime_pb2.SetForwardingPipelineConfigRequest()
+    req.device_id = client.device_id
+    if client.role_name is not None:
+        req.role = client.role_name
+    election_id = req.election_id
+    election_id.high = client.election_id[0]
+    election_id.low = client.election_id[1]
+    req.action = p4runtime_pb2.SetForwardingPipelineConfigRequest.VERIFY_AND_COMMIT
+    with open(p4info_path, 'r') as f1:
+        with open(bin_path, 'rb') as f2:
+            try:
+                google.protobuf.text_format.Merge(f1.read(), req.config.p4info,
+                                                  allow_unknown_field=True)
+            except google.protobuf.text_format.ParseError:
+                logging.error("Error when parsing P4Info")
+                raise
+            req.config.p4_device_config = f2.read()
+    return req
+
+
+def _convert_write_error(e):
+    # same conversion as the one performed by the parse_p4runtime_write_error decorator
+    if isinstance(e, grpc.RpcError) and e.code() == grpc.StatusCode.UNKNOWN:
+        return P4RuntimeWriteException(e)
+    return e
+
+
+def _serialize_stream_request(req):
+    # Requests may be queued already serialized (see PacketOutTemplate in
+    # shell.py), which saves building a Protobuf message for each of them.
+    if type(req) is bytes:
+        return req
+    return req.SerializeToString()
+
+
+class _RpcMetrics:
+    __slots__ = ("calls", "errors", "p4_errors", "buckets", "latency_sum", "latency_max",
+                 "bytes_sent", "bytes_received")
+
+    def __init__(self, num_buckets):
+        self.calls = 0
+        # gRPC status code name -> count
+        self.errors = Counter()
+        # P4Runtime error code name -> count, for the failed updates of WriteRequests
+        self.p4_errors = Counter()
+        # non-cumulative counts, the last bucket is +Inf
+        self.buckets = [0] * (num_buckets + 1)
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+
+class ClientMetrics:
+    """
+    Metrics collected by a P4RuntimeClient once enabled with enable_metrics(). For each RPC
+    (Write, Read, ...): the number of calls, the number of errors by gRPC status code (and by
+    P4Runtime error code for the updates of failed WriteRequests), a latency histogram and the
+    number of bytes sent and received (serialized size of the messages). For the StreamChannel:
+    the number of messages received by type, and the number of messages and bytes sent and
+    received.
+    """
+    # upper bounds of the latency histogram buckets, in seconds
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                       5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rpcs = {}
+        # updated by the stream receive thread / the gRPC thread consuming stream requests, under
+        # the lock, since stats() can be called from any thread
+        self.stream_messages_received = Counter()
+        self.stream_bytes_received = 0
+        self.stream_messages_sent = 0
+        self.stream_bytes_sent = 0
+
+    def _get(self, rpc):
+        m = self.rpcs.get(rpc)
+        if m is None:
+            m = self.rpcs[rpc] = _RpcMetrics(len(self.LATENCY_BUCKETS))
+        return m
+
+    def observe(self, rpc, latency, code=None, p4_codes=(), bytes_sent=0, bytes_received=0):
+        """Records a completed call; code is the gRPC status code name for failed calls."""
+        with self._lock:
+            m = self._get(rpc)
+            m.calls += 1
+            if code is not None:
+                m.errors[code] += 1
+                m.p4_errors.update(p4_codes)
+            m.buckets[bisect.bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+            m.latency_sum += latency
+            m.latency_max = max(m.latency_max, latency)
+            m.bytes_sent += bytes_sent
+            m.bytes_received += bytes_received
+
+    def add_bytes_received(self, rpc, num_bytes):
+        with self._lock:
+            self._get(rpc).bytes_received += num_bytes
+
+    def add_stream_sent(self, num_bytes):
+        with self._lock:
+            self.stream_messages_sent += 1
+            self.stream_bytes_sent += num_bytes
+
+    def add_stream_bytes_received(self, num_bytes):
+        with self._lock:
+            self.stream_bytes_received += num_bytes
+
+    def add_stream_message_received(self, type_):
+        with self._lock:
+            self.stream_messages_received[type_] += 1
+
+    def stats(self):
+        """Returns the metrics as a dictionary."""
+        rpcs = {}
+        with self._lock:
+            for rpc, m in self.rpcs.items():
+                cumulative = list(itertools.accumulate(m.buckets))
+                rpcs[rpc] = {
+                    "calls": m.calls,
+                    "errors": dict(m.errors),
+                    "p4_errors": dict(m.p4_errors),
+                    "latency_ms": {
+                        "avg": m.latency_sum / m.calls * 1e3 if m.calls else 0.0,
+                        "max": m.latency_max * 1e3,
+                    },
+                    # (upper bound in seconds, number of calls with a lower latency)
+                    "latency_histogram": list(zip(self.LATENCY_BUCKETS + (math.inf,), cumulative)),
+                    "latency_sum": m.latency_sum,
+                    "bytes_sent": m.bytes_sent,
+                    "bytes_received": m.bytes_received,
+                }
+            stream = {
+                "messages_received": dict(self.stream_messages_received),
+                "bytes_received": self.stream_bytes_received,
+                "messages_sent": self.stream_messages_sent,
+                "bytes_sent": self.stream_bytes_sent,
+            }
+        return {"rpcs": rpcs, "stream": stream}
+
+
+def _p4_error_codes(grpc_error):
+    # P4Runtime error code names of the failed updates of a WriteRequest, for metrics
+    try:
+        return [code_pb2.Code.Name(p4_error.canonical_code)
+                for _, p4_error in P4RuntimeErrorIterator(grpc_error)]
+    except (P4RuntimeErrorFormatException, ValueError):
+        return []
+
+
+class _ResponseCounter:
+    # Wraps the response iterator of a server-streaming call to count the bytes received.
+    def __init__(self, call, metrics, rpc):
+        self._call = call
+        self._metrics = metrics
+        self._rpc = rpc
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        rep = next(self._call)
+        self._metrics.add_bytes_received(self._rpc, rep.ByteSize())
+        return rep
+
+    def __getattr__(self, name):
+        return getattr(self._call, name)
+
+
+class _MetricsInterceptor(grpc.UnaryUnaryClientInterceptor, grpc.UnaryStreamClientInterceptor):
+    # Records the unary and server-streaming RPCs of a client in a ClientMetrics instance. The
+    # interceptor is only installed when metrics are enabled, so there is no overhead otherwise.
+    def __init__(self, metrics):
+        self._metrics = metrics
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        rpc = client_call_details.method.rsplit("/", 1)[-1]
+        bytes_sent = request.ByteSize()
+        start = time.perf_counter()
+        call = continuation(client_call_details, request)
+
+        def done(call):
+            latency = time.perf_counter() - start
+            e = call.exception()
+            if e is None:
+                self._metrics.observe(rpc, latency, bytes_sent=bytes_sent,
+                                      bytes_received=call.result().ByteSize())
+                return
+            code = e.code() if isinstance(e, grpc.RpcError) else None
+            p4_codes = _p4_error_codes(e) if code == grpc.StatusCode.UNKNOWN else ()
+            self._metrics.observe(rpc, latency, code.name if code else type(e).__name__,
+                                  p4_codes, bytes_sent=bytes_sent)
+        call.add_done_callback(done)
+        return call
+
+    def intercept_unary_stream(self, continuation, client_call_details, request):
+        rpc = client_call_details.method.rsplit("/", 1)[-1]
+        bytes_sent = request.ByteSize()
+        start = time.perf_counter()
+        call = continuation(client_call_details, request)
+
+        def done():
+            code = call.code()
+            self._metrics.observe(rpc, time.perf_counter() - start,
+                                  None if code == grpc.StatusCode.OK else code.name,
+                                  bytes_sent=bytes_sent)
+        call.add_callback(done)
+        return _ResponseCounter(call, self._metrics, rpc)
+
+
+class StreamSubscription:
+    """A subscription to a type of StreamChannel messages ("packet", "digest" or
+    "idle_timeout_notification"), created with P4RuntimeClient.subscribe.
+
+    Messages are delivered by the thread which receives from the stream,
+    without going through the client's stream_in_q. If a callback is provided
+    and batch_size is 1, the callback is invoked directly by that thread for
+    each message, so it should return quickly. Otherwise, messages are
+    buffered in a bounded queue (maxsize messages) and can be consumed by
+    iterating over the subscription, or with get and get_batch; if a callback
+    is provided, a dedicated thread consumes the queue and invokes the
+    callback with lists of messages. When the queue is full, new messages are
+    dropped and counted in the dropped attribute.
+
+    A batch is delivered once batch_size messages are available, or once
+    batch_timeout seconds have elapsed since the first message of the batch
+    was received (if batch_timeout is not None).
+
+    If on_receive is provided, it is invoked by the receive thread for each
+    message, before the message is delivered or buffered.
+    """
+
+    def __init__(self, client, type_, callback=None, maxsize=1024, batch_size=1,
+                 batch_timeout=None, on_receive=None):
+        if maxsize <= 0:
+            raise ValueError("maxsize must be a positive integer")
+        if batch_size <= 0:
+            raise ValueError("batch_size must be a positive integer")
+        if batch_timeout is not None and batch_timeout < 0:
+            raise ValueError("batch_timeout can't be a negative number")
+        self.type = type_
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.received = 0
+        self.dropped = 0
+        self.closed = False
+        self._client = client
+        self._callback = callback
+        self._on_receive = on_receive
+        # (receive time, message) tuples, the receive time is used for batch_timeout
+        self._q = deque()
+        self._cv = threading.Condition()
+        self._direct = callback is not None and batch_size == 1
+        self._dispatch_thread = None
+        if callback is not None and not self._direct:
+            self._dispatch_thread = threading.Thread(target=self._dispatch, daemon=True)
+            self._dispatch_thread.start()
+
+    @property
+    def pending(self):
+        return len(self._q)
+
+    def _deliver(self, msg):
+        # called by the stream receive thread
+        self.received += 1
+        if self._on_receive is not None:
+            try:
+                self._on_receive(msg)
+            except Exception:
+                logging.exception("Error in stream subscription callback")
+        if self._direct:
+            try:
+                self._callback(msg)
+            except Exception:
+                logging.exception("Error in stream subscription callback")
+            return
+        with self._cv:
+            if len(self._q) >= self.maxsize:
+                self.dropped += 1
+                return
+            self._q.append((time.monotonic(), msg))
+            if len(self._q) == 1 or len(self._q) >= self.batch_size:
+                self._cv.notify_all()
+
+    def _close(self):
+        with self._cv:
+            self.closed = True
+            self._cv.notify_all()
+
+    def close(self):
+        """Stops the delivery of messages. Buffered messages can still be consumed."""
+        self._client.unsubscribe(self)
+        self._close()
+        if self._dispatch_thread is not None and \
+                self._dispatch_thread is not threading.current_thread():
+            self._dispatch_thread.join()
+
+    def _batch_ready(self):
+        if self.closed or len(self._q) >= self.batch_size:
+            return True
+        if self._q and self.batch_timeout is not None:
+            return time.monotonic() - self._q[0][0] >= self.batch_timeout
+        return False
+
+    def _pop(self, max_count):
+        q = self._q
+        return [q.popleft()[1] for _ in range(min(max_count, len(q)))]
+
+    def get(self, timeout=None):
+        """Returns the next message, or None if the timeout expired or if the
+        subscription is closed and all messages have been consumed."""
+        with self._cv:
+            if not self._cv.wait_for(lambda: self._q or self.closed, timeout) or not self._q:
+                return None
+            return self._pop(1)[0]
+
+    def drain(self, max_count=None, timeout=None):
+        """Waits until at least one message is available and returns all the
+        buffered messages (at most max_count), without waiting for a full
+        batch. Returns an empty list if the timeout expired or if the
+        subscription is closed and all messages have been consumed."""
+        with self._cv:
+            if not self._cv.wait_for(lambda: self._q or self.closed, timeout):
+                return []
+            return self._pop(len(self._q) if max_count is None else max_count)
+
+    def get_batch(self, timeout=None):
+        """Returns the next batch of messages (a list with at most batch_size
+        messages). If the timeout expires first, returns the messages received
+        so far, if any. Returns an empty list if the subscription is closed
+        and all messages have been consumed."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cv:
+            while not self._batch_ready():
+                if self._q and self.batch_timeout is not None:
+                    wait = self._q[0][0] + self.batch_timeout - time.monotonic()
+                    if deadline is not None:
+                        wait = min(wait, deadline - time.monotonic())
+                elif deadline is not None:
+                    wait = deadline - time.monotonic()
+                else:
+                    wait = None
+                if wait is not None and wait <= 0:
+                    break
+                self._cv.wait(wait)
+            return self._pop(self.batch_size)
+
+    def batches(self):
+        """Yields batches of messages until the subscription is closed."""
+        while True:
+            batch = self.get_batch()
+            if not batch:
+                return
+            yield batch
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from batch
+
+    def _dispatch(self):
+        for batch in self.batches():
+            try:
+                self._callback(batch)
+            except Exception:
+                logging.exception("Error in stream subscription callback")
 
 
 class P4RuntimeClient:
-    def __init__(self, device_id, grpc_addr, election_id, role_name=None, ssl_options=None):
+    _subscribable_types = ("packet", "digest", "idle_timeout_notification")
+
+    def __init__(self, device_id, grpc_addr, election_id, role_name=None, ssl_options=None,
+                 max_in_flight_writes=16):
         self.device_id = device_id
         self.election_id = election_id
         self.role_name = role_name
+        if max_in_flight_writes <= 0:
+            raise ValueError("max_in_flight_writes must be a positive integer")
+        self.max_in_flight_writes = max_in_flight_writes
+        self._writes_in_flight = 0
+        self._writes_cv = threading.Condition()
+        # message type -> tuple of StreamSubscription, replaced (not mutated) on
+        # subscribe / unsubscribe so that the receive thread does not need a lock
+        self._subscriptions = {}
+        self._subscriptions_lock = threading.Lock()
+        # updated for every arbitration message received from the server
+        self.is_primary = None
+        self._primary_callbacks = []
+        # ClientMetrics instance, if enabled (see enable_metrics)
+        self.metrics = None
         if ssl_options is None:
             self.ssl_options = SSLOptions(True)
         else:
@@ -154,30 +584,23 @@ class P4RuntimeClient:
             try:
                 logging.debug("Using insecure channel")
                 self.channel = grpc.insecure_channel(grpc_addr)
-            except Exception:
-                logging.critical("Failed to connect to P4Runtime server")
-                sys.exit(1)
+            except Exception as e:
+                raise ConnectionError("Failed to connect to P4Runtime server") from e
         else:
-            # root certificates are retrieved from a default location chosen by gRPC runtime unless
-            # the user provides custom certificates.
-            root_certificates = None
-            if self.ssl_options.cacert is not None:
-                root_certificates = read_pem_file(self.ssl_options.cacert)
-            certificate_chain = None
-            if self.ssl_options.cert is not None:
-                certificate_chain = read_pem_file(self.ssl_options.cert)
-            private_key = None
-            if self.ssl_options.key is not None:
-                private_key = read_pem_file(self.ssl_options.key)
-            creds = grpc.ssl_channel_credentials(root_certificates, private_key, certificate_chain)
+            creds = ssl_channel_credentials(self.ssl_options)
             try:
                 self.channel = grpc.secure_channel(grpc_addr, creds)
-            except Exception:
-                logging.critical("Failed to connect to P4Runtime server")
-                sys.exit(1)
+            except Exception as e:
+                raise ConnectionError("Failed to connect to P4Runtime server") from e
 
         self.stub = p4runtime_pb2_grpc.P4RuntimeStub(self.channel)
-        self.set_up_stream()
+        # ConnectionError if the server does not answer the arbitration request
+        try:
+            self.set_up_stream()
+        except ConnectionError:
+            self.stream.cancel()
+            self.tear_down()
+            raise
 
     def set_up_stream(self):
         self.stream_out_q = queue.Queue()
@@ -195,22 +618,42 @@ class P4RuntimeClient:
                 p = self.stream_out_q.get()
                 if p is None:
                     break
-                yield p
+                # A list is a batch of requests queued with a single put().
+                if type(p) is list:
+                    yield from p
+                else:
+                    yield p
+
+        def serialize_stream_request(req):
+            data = _serialize_stream_request(req)
+            metrics = self.metrics
+            if metrics is not None:
+                metrics.add_stream_sent(len(data))
+            return data
+
+        def deserialize_stream_response(data):
+            metrics = self.metrics
+            if metrics is not None:
+                metrics.add_stream_bytes_received(len(data))
+            return p4runtime_pb2.StreamMessageResponse.FromString(data)
 
         def stream_recv_wrapper(stream):
             @parse_p4runtime_error
             def stream_recv():
+                subscriptions = self._subscriptions
                 for p in stream:
-                    if p.HasField("arbitration"):
-                        self.stream_in_q["arbitration"].put(p)
-                    elif p.HasField("packet"):
-                        self.stream_in_q["packet"].put(p)
-                    elif p.HasField("digest"):
-                        self.stream_in_q["digest"].put(p)
-                    elif p.HasField("idle_timeout_notification"):
-                        self.stream_in_q["idle_timeout_notification"].put(p)
+                    type_ = _stream_msg_type(p, self.stream_in_q)
+                    metrics = self.metrics
+                    if metrics is not None:
+                        metrics.add_stream_message_received(type_)
+                    if type_ == "arbitration":
+                        self._update_primary(p.arbitration)
+                    subs = subscriptions.get(type_)
+                    if subs:
+                        for sub in subs:
+                            sub._deliver(p)
                     else:
-                        self.stream_in_q["unknown"].put(p)
+                        self.stream_in_q[type_].put(p)
             try:
                 stream_recv()
             except P4RuntimeException as e:
@@ -218,7 +661,15 @@ class P4RuntimeClient:
                 logging.critical(e)
                 for k in self.stream_in_q:
                     self.stream_in_q[k].put(None)
-        self.stream = self.stub.StreamChannel(stream_req_iterator())
+            finally:
+                for subs in list(self._subscriptions.values()):
+                    for sub in subs:
+                        sub._close()
+        stream_channel = self.channel.stream_stream(
+            '/p4.v1.P4Runtime/StreamChannel',
+            request_serializer=serialize_stream_request,
+            response_deserializer=deserialize_stream_response)
+        self.stream = stream_channel(stream_req_iterator())
         self.stream_recv_thread = threading.Thread(
             target=stream_recv_wrapper, args=(self.stream,))
         self.stream_recv_thread.start()
@@ -237,14 +688,63 @@ class P4RuntimeClient:
 
         rep = self.get_stream_packet("arbitration", timeout=2)
         if rep is None:
-            logging.critical("Failed to establish session with server")
-            sys.exit(1)
+            raise ConnectionError("Failed to establish session with server")
         is_primary = (rep.arbitration.status.code == code_pb2.OK)
         logging.debug("Session established, client is '{}'".format(
             'primary' if is_primary else 'backup'))
         if not is_primary:
             print("You are not the primary client, you only have read access to the server")
 
+    def _update_primary(self, arbitration):
+        was_primary = self.is_primary
+        self.is_primary = (arbitration.status.code == code_pb2.OK)
+        if was_primary is False and self.is_primary:
+            logging.debug("Client is now 'primary'")
+            for callback in list(self._primary_callbacks):
+                callback()
+
+    def add_primary_callback(self, callback):
+        """Registers a function (with no arguments) which is called from the stream receive
+        thread whenever the client transitions from backup to primary, i.e. when the state of the
+        device may have been changed by another controller."""
+        self._primary_callbacks.append(callback)
+
+    def remove_primary_callback(self, callback):
+        self._primary_callbacks.remove(callback)
+
+    def enable_metrics(self):
+        """Starts collecting metrics for the RPCs of the client (see ClientMetrics) and returns
+        the ClientMetrics instance. The RPCs are instrumented with a gRPC interceptor, which is
+        removed by disable_metrics()."""
+        if self.metrics is None:
+            metrics = ClientMetrics()
+            channel = grpc.intercept_channel(self.channel, _MetricsInterceptor(metrics))
+            self.stub = p4runtime_pb2_grpc.P4RuntimeStub(channel)
+            self.metrics = metrics
+        return self.metrics
+
+    def disable_metrics(self):
+        self.metrics = None
+        self.stub = p4runtime_pb2_grpc.P4RuntimeStub(self.channel)
+
+    def stats(self):
+        """Returns a dictionary with the state of the client (primary or backup, writes in
+        flight, number of messages in the stream queues) and, if enabled, its metrics."""
+        pending = Counter()
+        for type_, subs in list(self._subscriptions.items()):
+            for sub in subs:
+                pending[type_] += sub.pending
+        stats = {
+            "primary": self.is_primary,
+            "writes_in_flight": self._writes_in_flight,
+            "stream_out_queue": self.stream_out_q.qsize(),
+            "stream_in_queues": {type_: q.qsize() for type_, q in self.stream_in_q.items()},
+            "subscription_queues": dict(pending),
+        }
+        if self.metrics is not None:
+            stats.update(self.metrics.stats())
+        return stats
+
     def get_stream_packet(self, type_, timeout=1):
         if type_ not in self.stream_in_q:
             print("Unknown stream type '{}'".format(type_))
@@ -255,6 +755,30 @@ class P4RuntimeClient:
         except queue.Empty:  # timeout expired
             return None
 
+    def subscribe(self, type_, callback=None, maxsize=1024, batch_size=1, batch_timeout=None,
+                  on_receive=None):
+        """Subscribes to the StreamChannel messages of the given type ("packet",
+        "digest" or "idle_timeout_notification") and returns a
+        StreamSubscription. While there is at least one subscription for a
+        type, messages of that type are delivered to the subscriptions only,
+        not to stream_in_q."""
+        if type_ not in self._subscribable_types:
+            raise ValueError("Cannot subscribe to stream messages of type '{}'".format(type_))
+        sub = StreamSubscription(self, type_, callback=callback, maxsize=maxsize,
+                                 batch_size=batch_size, batch_timeout=batch_timeout,
+                                 on_receive=on_receive)
+        with self._subscriptions_lock:
+            self._subscriptions[type_] = self._subscriptions.get(type_, ()) + (sub,)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._subscriptions_lock:
+            subs = tuple(s for s in self._subscriptions.get(sub.type, ()) if s is not sub)
+            if subs:
+                self._subscriptions[sub.type] = subs
+            else:
+                self._subscriptions.pop(sub.type, None)
+
     @parse_p4runtime_error
     def get_p4info(self):
         logging.debug("Retrieving P4Info file")
@@ -267,23 +791,7 @@ class P4RuntimeClient:
     @parse_p4runtime_error
     def set_fwd_pipe_config(self, p4info_path, bin_path):
         logging.debug("Setting forwarding pipeline config")
-        req = p4runtime_pb2.SetForwardingPipelineConfigRequest()
-        req.device_id = self.device_id
-        if self.role_name is not None:
-            req.role = self.role_name
-        election_id = req.election_id
-        election_id.high = self.election_id[0]
-        election_id.low = self.election_id[1]
-        req.action = p4runtime_pb2.SetForwardingPipelineConfigRequest.VERIFY_AND_COMMIT
-        with open(p4info_path, 'r') as f1:
-            with open(bin_path, 'rb') as f2:
-                try:
-                    google.protobuf.text_format.Merge(f1.read(), req.config.p4info,
-                                                      allow_unknown_field=True)
-                except google.protobuf.text_format.ParseError:
-                    logging.error("Error when parsing P4Info")
-                    raise
-                req.config.p4_device_config = f2.read()
+        req = make_set_fwd_pipe_config_request(self, p4info_path, bin_path)
         return self.stub.SetForwardingPipelineConfig(req)
 
     def tear_down(self):
@@ -295,40 +803,83 @@ class P4RuntimeClient:
                 self.stream_in_q[k].put(None)
         if self.stream_recv_thread:
             self.stream_recv_thread.join()
+        self.wait_for_writes()
         self.channel.close()
         del self.channel  # avoid a race condition if channel deleted when process terminates
 
-    @parse_p4runtime_write_error
-    def write(self, req):
+    def _set_write_request_header(self, req):
         req.device_id = self.device_id
         if self.role_name is not None:
             req.role = self.role_name
         election_id = req.election_id
         election_id.high = self.election_id[0]
         election_id.low = self.election_id[1]
+
+    @parse_p4runtime_write_error
+    def write(self, req):
+        self._set_write_request_header(req)
         return self.stub.Write(req)
 
     @parse_p4runtime_write_error
     def write_update(self, update):
         req = p4runtime_pb2.WriteRequest()
-        req.device_id = self.device_id
-        if self.role_name is not None:
-            req.role = self.role_name
-        election_id = req.election_id
-        election_id.high = self.election_id[0]
-        election_id.low = self.election_id[1]
+        self._set_write_request_header(req)
         req.updates.extend([update])
         return self.stub.Write(req)
 
+    def write_async(self, req):
+        """Sends a WriteRequest without waiting for the server's response. Returns a
+        concurrent.futures.Future which resolves to the WriteResponse, or to a
+        P4RuntimeWriteException in case of error. At most max_in_flight_writes requests can be
+        outstanding at any given time: when the window is full, this method blocks until a
+        response is received for one of them."""
+        self._set_write_request_header(req)
+        with self._writes_cv:
+            while self._writes_in_flight >= self.max_in_flight_writes:
+                self._writes_cv.wait()
+            self._writes_in_flight += 1
+        f = futures.Future()
+        f.set_running_or_notify_cancel()
+
+        def done(grpc_future):
+            with self._writes_cv:
+                self._writes_in_flight -= 1
+                self._writes_cv.notify_all()
+            try:
+                f.set_result(grpc_future.result())
+            except Exception as e:
+                f.set_exception(_convert_write_error(e))
+
+        try:
+            self.stub.Write.future(req).add_done_callback(done)
+        except Exception:
+            with self._writes_cv:
+                self._writes_in_flight -= 1
+                self._writes_cv.notify_all()
+            raise
+        return f
+
+    def wait_for_writes(self, timeout=None):
+        """Waits until all the requests sent with write_async have completed. Returns False if the
+        timeout expired before that, True otherwise."""
+        with self._writes_cv:
+            return self._writes_cv.wait_for(lambda: self._writes_in_flight == 0, timeout)
+
     # Decorator is useless here: in case of server error, the exception is raised during the
     # iteration (when next() is called).
     @parse_p4runtime_error
     def read_one(self, entity):
+        return self.read([entity])
+
+    @parse_p4runtime_error
+    def read(self, entities):
+        """Sends a single ReadRequest for all the given entities and returns an iterator over the
+        ReadResponse messages."""
         req = p4runtime_pb2.ReadRequest()
         if self.role_name is not None:
             req.role = self.role_name
         req.device_id = self.device_id
-        req.entities.extend([entity])
+        req.entities.extend(entities)
         return self.stub.Read(req)
 
     @parse_p4runtime_error
@@ -336,3 +887,189 @@ class P4RuntimeClient:
         req = p4runtime_pb2.CapabilitiesRequest()
         rep = self.stub.Capabilities(req)
         return rep.p4runtime_api_version
+
+
+def _stream_msg_type(msg, known_types):
+    type_ = msg.WhichOneof("update")
+    return type_ if type_ in known_types else "unknown"
+
+
+class AsyncP4RuntimeClient:
+    """An asyncio version of P4RuntimeClient, built on grpc.aio.
+
+    The constructor does not perform any I/O; the connection is established
+    (StreamChannel and arbitration) by connect(). The client can also be used as
+    an asynchronous context manager:
+
+    async with AsyncP4RuntimeClient(1, 'localhost:9559', (1, 0)) as client:
+        p4info = await client.get_p4info()
+
+    All RPC methods are coroutines, except read_one which is an asynchronous
+    generator of ReadResponse messages. Incoming stream messages are dispatched
+    to the asyncio queues in stream_in_q; outgoing stream messages can be sent
+    with stream_send.
+    """
+    def __init__(self, device_id, grpc_addr, election_id, role_name=None, ssl_options=None):
+        self.device_id = device_id
+        self.grpc_addr = grpc_addr
+        self.election_id = election_id
+        self.role_name = role_name
+        if ssl_options is None:
+            self.ssl_options = SSLOptions(True)
+        else:
+            self.ssl_options = ssl_options
+        self.is_primary = None
+        self.channel = None
+        self.stub = None
+        self.stream = None
+        self.stream_recv_task = None
+        self.stream_out_q = None
+        self.stream_in_q = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.tear_down()
+        return False
+
+    async def connect(self, timeout=2):
+        """Opens the gRPC channel and the StreamChannel, then performs the
+        arbitration handshake. Raises ConnectionError if the server does not
+        answer the arbitration request within timeout seconds."""
+        logging.debug("Connecting to device {} at {}".format(self.device_id, self.grpc_addr))
+        if self.ssl_options.insecure:
+            logging.debug("Using insecure channel")
+            self.channel = grpc.aio.insecure_channel(self.grpc_addr)
+        else:
+            creds = ssl_channel_credentials(self.ssl_options)
+            self.channel = grpc.aio.secure_channel(self.grpc_addr, creds)
+        self.stub = p4runtime_pb2_grpc.P4RuntimeStub(self.channel)
+        self.set_up_stream()
+        return await self.handshake(timeout=timeout)
+
+    def set_up_stream(self):
+        self.stream_out_q = asyncio.Queue()
+        # queues for different messages
+        self.stream_in_q = {
+            "arbitration": asyncio.Queue(),
+            "packet": asyncio.Queue(),
+            "digest": asyncio.Queue(),
+            "idle_timeout_notification": asyncio.Queue(),
+            "unknown": asyncio.Queue(),
+        }
+
+        async def stream_req_iterator():
+            while True:
+                p = await self.stream_out_q.get()
+                if p is None:
+                    break
+                yield p
+
+        async def stream_recv():
+            try:
+                async for p in self.stream:
+                    self.stream_in_q[_stream_msg_type(p, self.stream_in_q)].put_nowait(p)
+            except asyncio.CancelledError:
+                pass  # stream cancelled by tear_down
+            except grpc.RpcError as e:
+                if e.code() != grpc.StatusCode.CANCELLED:
+                    logging.critical("StreamChannel error, closing stream")
+                    logging.critical(P4RuntimeException(e))
+            for k in self.stream_in_q:
+                self.stream_in_q[k].put_nowait(None)
+
+        self.stream = self.stub.StreamChannel(stream_req_iterator())
+        self.stream_recv_task = asyncio.ensure_future(stream_recv())
+
+    async def handshake(self, timeout=2):
+        req = p4runtime_pb2.StreamMessageRequest()
+        arbitration = req.arbitration
+        arbitration.device_id = self.device_id
+        election_id = arbitration.election_id
+        election_id.high = self.election_id[0]
+        election_id.low = self.election_id[1]
+        if self.role_name is not None:
+            arbitration.role.name = self.role_name
+        await self.stream_send(req)
+
+        rep = await self.get_stream_packet("arbitration", timeout=timeout)
+        if rep is None:
+            raise ConnectionError("Failed to establish session with server")
+        self.is_primary = (rep.arbitration.status.code == code_pb2.OK)
+        logging.debug("Session established, client is '{}'".format(
+            'primary' if self.is_primary else 'backup'))
+        return self.is_primary
+
+    async def stream_send(self, msg):
+        """Sends a StreamMessageRequest on the StreamChannel."""
+        await self.stream_out_q.put(msg)
+
+    async def get_stream_packet(self, type_, timeout=1):
+        if type_ not in self.stream_in_q:
+            logging.error("Unknown stream type '{}'".format(type_))
+            return None
+        try:
+            return await asyncio.wait_for(self.stream_in_q[type_].get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    @parse_p4runtime_error
+    async def get_p4info(self):
+        logging.debug("Retrieving P4Info file")
+        req = p4runtime_pb2.GetForwardingPipelineConfigRequest()
+        req.device_id = self.device_id
+        req.response_type = p4runtime_pb2.GetForwardingPipelineConfigRequest.P4INFO_AND_COOKIE
+        rep = await self.stub.GetForwardingPipelineConfig(req)
+        return rep.config.p4info
+
+    @parse_p4runtime_error
+    async def set_fwd_pipe_config(self, p4info_path, bin_path):
+        logging.debug("Setting forwarding pipeline config")
+        req = make_set_fwd_pipe_config_request(self, p4info_path, bin_path)
+        return await self.stub.SetForwardingPipelineConfig(req)
+
+    async def tear_down(self):
+        if self.stream_out_q is not None:
+            logging.debug("Cleaning up stream")
+            self.stream_out_q.put_nowait(None)
+        if self.stream is not None:
+            self.stream.cancel()
+        if self.stream_recv_task is not None:
+            await self.stream_recv_task
+        if self.channel is not None:
+            await self.channel.close()
+        self.channel = None
+
+    _set_write_request_header = P4RuntimeClient._set_write_request_header
+
+    @parse_p4runtime_write_error
+    async def write(self, req):
+        self._set_write_request_header(req)
+        return await self.stub.Write(req)
+
+    @parse_p4runtime_write_error
+    async def write_update(self, update):
+        req = p4runtime_pb2.WriteRequest()
+        self._set_write_request_header(req)
+        req.updates.extend([update])
+        return await self.stub.Write(req)
+
+    async def read_one(self, entity):
+        req = p4runtime_pb2.ReadRequest()
+        if self.role_name is not None:
+            req.role = self.role_name
+        req.device_id = self.device_id
+        req.entities.extend([entity])
+        try:
+            async for rep in self.stub.Read(req):
+                yield rep
+        except grpc.RpcError as e:
+            raise P4RuntimeException(e) from None
+
+    @parse_p4runtime_error
+    async def api_version(self):
+        req = p4runtime_pb2.CapabilitiesRequest()
+        rep = await self.stub.Capabilities(req)
+        return rep.p4runtime_api_version
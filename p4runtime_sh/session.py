@@ -0,0 +1,260 @@
+# SPDX-FileCopyrightText: 2026 The P4 Language Consortium
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from concurrent import futures
+import hashlib
+import logging
+import threading
+
+from p4.v1 import p4runtime_pb2
+from . import shell
+from .context import Context
+from .p4runtime import P4RuntimeClient, P4RuntimeWriteException
+from .utils import UserError
+
+
+def p4info_fingerprint(p4info):
+    """Returns a digest of a P4Info message. Devices with the same fingerprint run the same P4
+    program and can share a single Context."""
+    return hashlib.sha256(p4info.SerializeToString(deterministic=True)).hexdigest()
+
+
+class FanoutError(UserError):
+    def __init__(self, errors):
+        self.errors = errors
+
+    def __str__(self):
+        s = "Error(s) for {} session(s):\n".format(len(self.errors))
+        for key, e in self.errors.items():
+            s += "\t* {}: {}\n".format(key, str(e).strip())
+        return s
+
+
+class Session:
+    """
+    A P4Runtime connection to one device, together with the Context for the P4 program running on
+    that device. Use the session as a context manager to target it with the shell's entity classes:
+
+    with manager['s1']:
+        te = TableEntry('<table_name>')(action='<action_name>')
+        ...
+        te.insert()
+
+    Activating a session replaces the shell's global client and context, so this is not meant to be
+    used concurrently from multiple threads: use SessionManager.fanout or SessionManager.run
+    instead.
+    """
+    def __init__(self, key, client, context, fingerprint):
+        self.key = key
+        self.client = client
+        self.context = context
+        self.fingerprint = fingerprint
+        self._saved = []
+
+    def __enter__(self):
+        self._saved.append((shell.client, shell.context))
+        shell.client = self.client
+        shell.context = self.context
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        shell.client, shell.context = self._saved.pop()
+        return False
+
+    def __repr__(self):
+        return "Session({!r}, device_id={})".format(self.key, self.client.device_id)
+
+
+class _FanoutBatch(shell.WriteBatch):
+    """A WriteBatch which sends every WriteRequest to several sessions in parallel."""
+    def __init__(self, manager, sessions, max_updates=1000):
+        super().__init__(max_updates)
+        self._manager = manager
+        self._sessions = sessions
+
+    def _send(self, req, entities):
+        def write(session):
+            # P4RuntimeClient.write sets the device id and election id in place
+            session_req = p4runtime_pb2.WriteRequest()
+            session_req.CopyFrom(req)
+            shadow = shell._shadows.get(session.client)
+            try:
+                session.client.write(session_req)
+            except Exception as e:
+                if isinstance(e, P4RuntimeWriteException):
+                    self._set_failed_entities(e, session_req, entities)
+                if shadow is not None:
+                    shadow._record(session_req.updates, e)
+                raise
+            if shadow is not None:
+                shadow._record(session_req.updates)
+        self._manager._run_on(self._sessions, write)
+
+    def __enter__(self):
+        # entities are built using the (shared) context of the target sessions
+        self._sessions[0].__enter__()
+        try:
+            return super().__enter__()
+        except Exception:
+            self._sessions[0].__exit__(None, None, None)
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return super().__exit__(exc_type, exc_value, traceback)
+        finally:
+            self._sessions[0].__exit__(exc_type, exc_value, traceback)
+
+
+class SessionManager:
+    """
+    Manages P4Runtime sessions to many devices from a single process. Sessions are keyed by
+    (grpc_addr, device_id) unless a custom key is provided to connect(). Devices running the same
+    P4 program (same P4Info fingerprint) share a single Context.
+    """
+    def __init__(self, max_workers=None):
+        self._sessions = {}
+        self._contexts = {}
+        self._lock = threading.Lock()
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def connect(self, device_id=1, grpc_addr='localhost:9559', election_id=(1, 0),
+                role_name=None, config=None, ssl_options=None, key=None):
+        """Connects to a device and returns the new Session. If config is provided (as a
+        shell.FwdPipeConfig), the forwarding pipeline is pushed to the device first. Raises
+        ConnectionError if the device cannot be reached, the other sessions are not affected."""
+        if key is None:
+            key = (grpc_addr, device_id)
+        with self._lock:
+            if key in self._sessions:
+                raise UserError("Session {!r} already exists".format(key))
+        try:
+            client = P4RuntimeClient(device_id, grpc_addr, election_id, role_name, ssl_options)
+        except ConnectionError as e:
+            raise ConnectionError("Cannot connect session {!r}: {}".format(key, e)) from e
+        try:
+            if config is not None:
+                client.set_fwd_pipe_config(config.p4info, config.bin)
+            p4info = client.get_p4info()
+        except Exception:
+            client.tear_down()
+            raise
+        fingerprint = p4info_fingerprint(p4info)
+        with self._lock:
+            context = self._contexts.get(fingerprint)
+            if context is None:
+                logging.debug("Parsing P4Info message for session {!r}".format(key))
+                context = Context()
+                context.set_p4info(p4info)
+                self._contexts[fingerprint] = context
+            if key in self._sessions:
+                session = None
+            else:
+                session = Session(key, client, context, fingerprint)
+                self._sessions[key] = session
+        if session is None:
+            client.tear_down()
+            raise UserError("Session {!r} already exists".format(key))
+        return session
+
+    def __getitem__(self, key):
+        try:
+            return self._sessions[key]
+        except KeyError:
+            raise UserError("Unknown session {!r}".format(key)) from None
+
+    def __contains__(self, key):
+        return key in self._sessions
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def keys(self):
+        return list(self._sessions.keys())
+
+    def num_contexts(self):
+        """Number of distinct P4Info Contexts shared by the sessions."""
+        return len(self._contexts)
+
+    def close(self, key):
+        """Tears down the session with the given key."""
+        with self._lock:
+            session = self._sessions.pop(key, None)
+            if session is None:
+                raise UserError("Unknown session {!r}".format(key))
+            if not any(s.fingerprint == session.fingerprint for s in self._sessions.values()):
+                del self._contexts[session.fingerprint]
+        shadow = shell._shadows.get(session.client)
+        if shadow is not None:
+            shadow.disable()
+        session.client.tear_down()
+
+    def close_all(self):
+        for key in self.keys():
+            self.close(key)
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_all()
+        return False
+
+    def _get_sessions(self, keys):
+        if keys is None:
+            return list(self._sessions.values())
+        return [self[key] for key in keys]
+
+    def _run_on(self, sessions, fn):
+        fs = {session.key: self._executor.submit(fn, session) for session in sessions}
+        results = {}
+        errors = {}
+        for key, f in fs.items():
+            try:
+                results[key] = f.result()
+            except Exception as e:
+                errors[key] = e
+        if errors:
+            raise FanoutError(errors)
+        return results
+
+    def run(self, fn, keys=None):
+        """Calls fn(session) for each session (or for the sessions with the provided keys) in
+        parallel, and returns a dictionary of the results, keyed by session key. If any call
+        raises an exception, a FanoutError is raised, with an errors attribute mapping the session
+        keys to the exceptions."""
+        return self._run_on(self._get_sessions(keys), fn)
+
+    def fanout(self, keys=None, max_updates=1000):
+        """
+        Returns a batch context manager: the writes issued in its scope are sent to all the sessions
+        (or to the sessions with the provided keys) in parallel, using multi-update WriteRequests.
+        All target sessions must run the same P4 program. See shell.batch for more information
+        about batches.
+
+        with manager.fanout():
+            te = TableEntry('<table_name>')(action='<action_name>')
+            ...
+            te.insert()
+        """
+        sessions = self._get_sessions(keys)
+        if not sessions:
+            raise UserError("No session to fan out to")
+        if len(set(s.fingerprint for s in sessions)) > 1:
+            raise UserError("Cannot fan out writes to sessions running different P4 programs")
+        return _FanoutBatch(self, sessions, max_updates)
+
+    def read_many(self, entities, keys=None, entities_per_request=1, max_workers=16):
+        """
+        Reads the entities (entity objects or p4runtime_pb2.Entity messages) from all the sessions
+        (or from the sessions with the provided keys) with concurrent ReadRequests, and returns an
+        iterator of shell.ReadResult(device, source, entity) tuples, where device is the session
+        key. See shell.read_many for more information.
+        """
+        targets = [(s.client, s.context, s.key) for s in self._get_sessions(keys)]
+        return shell._read_many(targets, entities, entities_per_request, max_workers)
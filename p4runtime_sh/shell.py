@@ -3,36 +3,50 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
+from array import array
+from concurrent import futures
+import csv
+import json
 import time
-from collections import Counter, namedtuple, OrderedDict
+from collections import Counter, deque, namedtuple, OrderedDict
 import enum
+import grpc
 import logging
-from threading import Thread
-from IPython import start_ipython
-from traitlets.config.loader import Config
-from IPython.terminal.prompts import Prompts, Token
 import os.path
+import queue
 import sys
-from p4runtime_sh.p4runtime import (P4RuntimeClient, P4RuntimeException, parse_p4runtime_error,
-                                    SSLOptions)
+from threading import Event, Lock, Thread
+from p4runtime_sh.p4runtime import (P4RuntimeClient, P4RuntimeException, P4RuntimeWriteException,
+                                    parse_p4runtime_error, SSLOptions)
 from p4.v1 import p4runtime_pb2
 from p4.config.v1 import p4info_pb2
-from . import bytes_utils
+from . import bytes_utils, output
 from . global_options import global_options, Options
 from .context import P4RuntimeEntity, P4Type, Context
 from .utils import UserError, InvalidP4InfoError
 import google.protobuf.text_format
-from google.protobuf import descriptor
-import queue
+from google.protobuf import descriptor, symbol_database, text_encoding
+from google.protobuf.internal.type_checkers import ToShortestFloat
+import math
 
 
 context = Context()
 client = None
+# active WriteBatch instance, if any (see batch())
+write_batch = None
+# P4RuntimeClient -> ShadowCache instance, for the clients with a shadow cache (see
+# shadow_cache()); the cache of the active client is used by the shell's reads and writes
+_shadows = {}
 
 
-def _print(*args, **kwargs):
-    if global_options.get_option(Options.verbose):
-        print(*args, **kwargs)
+def _print(*args):
+    # The arguments (often Protobuf messages) are only converted to strings if the output is
+    # actually going somewhere, see p4runtime_sh/output.py.
+    if not global_options.get_option(Options.verbose):
+        return
+    sink = output.get_output_sink()
+    if sink.is_enabled():
+        sink.write(" ".join(str(arg) for arg in args))
 
 
 class UserUsageError(UserError):
@@ -52,35 +66,47 @@ class NotSupportedYet(UserError):
 
 
 class _PrintContext:
+    """Keeps track of the messages enclosing the field being printed, for the substitutions which
+    depend on them (e.g. a match field id can only be resolved to a name within a TableEntry)."""
     def __init__(self):
-        self.skip_one = False
-        self.stack = []
+        self.tables = []
+        self.actions = []
+        self.ctrl_pkt_mds = []
+
+    def push(self, scope, msg):
+        if scope == "TableEntry":
+            self.tables.append(msg)
+        elif scope == "Action":
+            self.actions.append(msg)
+        else:
+            self.ctrl_pkt_mds.append("packet_in" if scope == "PacketIn" else "packet_out")
+
+    def pop(self, scope):
+        if scope == "TableEntry":
+            self.tables.pop()
+        elif scope == "Action":
+            self.actions.pop()
+        else:
+            self.ctrl_pkt_mds.pop()
 
     def find_table(self):
-        for msg in reversed(self.stack):
-            if msg.DESCRIPTOR.name == "TableEntry":
-                try:
-                    return context.get_name_from_id(msg.table_id)
-                except KeyError:
-                    return None
-        return None
+        if not self.tables:
+            return None
+        try:
+            return context.get_name_from_id(self.tables[-1].table_id)
+        except KeyError:
+            return None
 
     def find_action(self):
-        for msg in reversed(self.stack):
-            if msg.DESCRIPTOR.name == "Action":
-                try:
-                    return context.get_name_from_id(msg.action_id)
-                except KeyError:
-                    return None
-        return None
+        if not self.actions:
+            return None
+        try:
+            return context.get_name_from_id(self.actions[-1].action_id)
+        except KeyError:
+            return None
 
     def find_controller_packet_metadata(self):
-        for msg in reversed(self.stack):
-            if msg.DESCRIPTOR.name == "PacketIn":
-                return "packet_in"
-            if msg.DESCRIPTOR.name == "PacketOut":
-                return "packet_out"
-        return None
+        return self.ctrl_pkt_mds[-1] if self.ctrl_pkt_mds else None
 
 
 def _sub_object(field, value, pcontext):
@@ -115,108 +141,211 @@ def _sub_pkt_md(field, value, pcontext):
     return context.get_packet_metadata_name_from_id(ctrl_pkt_md_name, id_)
 
 
-def _gen_pretty_print_proto_field(substitutions, pcontext):
-    def myPrintField(self, field, value):
-        self._PrintFieldName(field)
-        self.out.write(' ')
-        if field.type == descriptor.FieldDescriptor.TYPE_BYTES:
-            # TODO(antonin): any kind of checks required?
-            self.out.write('\"')
-            self.out.write(''.join('\\\\x{:02x}'.format(b) for b in value))
-            self.out.write('\"')
-        else:
-            self.PrintFieldValue(field, value)
-        subs = None
-        if field.containing_type is not None:
-            subs = substitutions.get(field.containing_type.name, None)
-        if subs and field.name in subs and value != 0:
-            name = subs[field.name](field, value, pcontext)
-            self.out.write(' ("{}")'.format(name))
-        self.out.write(' ' if self.as_one_line else '\n')
-
-    return myPrintField
-
-
-def _repr_pretty_proto(msg, substitutions):
+class _ProtoPrinter:
     """A custom version of google.protobuf.text_format.MessageToString which represents Protobuf
     messages with a more user-friendly string. In particular, P4Runtime ids are supplemented with
-    the P4 name and binary strings are displayed in hexadecimal format."""
-    pcontext = _PrintContext()
-
-    def message_formatter(message, indent, as_one_line):
-        # For each messages we do 2 passes: the first one updates the _PrintContext instance and
-        # calls MessageToString again. The second pass returns None immediately (default handling by
-        # text_format).
-        if pcontext.skip_one:
-            pcontext.skip_one = False
-            return
-        pcontext.stack.append(message)
-        pcontext.skip_one = True
-        s = google.protobuf.text_format.MessageToString(
-            message, indent=indent, as_one_line=as_one_line, message_formatter=message_formatter)
-        s = s[indent:-1]
-        pcontext.stack.pop()
-        return s
+    the P4 name and binary strings are displayed in hexadecimal format.
+
+    For each message type, the way to print each field (including the substitution function to
+    use, if any) is computed the first time a message of that type is printed and cached. The only
+    state shared between calls is that cache, so an instance can be used from several threads."""
+    _MESSAGE, _MAP, _BYTES, _STRING, _ENUM, _BOOL, _FLOAT, _OTHER = range(8)
+    # messages which determine how the ids of some nested fields are resolved, see _PrintContext
+    _scopes = ("TableEntry", "Action", "PacketIn", "PacketOut")
+    # binary strings are displayed as "\\x0a\\x00..."
+    _hex_bytes = ["\\\\x{:02x}".format(b) for b in range(256)]
+
+    def __init__(self, substitutions):
+        self._substitutions = substitutions
+        # message descriptor -> (scope, {field descriptor: field layout})
+        self._layouts = {}
+
+    def _make_field_layout(self, field):
+        FD = descriptor.FieldDescriptor
+        cpp_type = field.cpp_type
+        if cpp_type == FD.CPPTYPE_MESSAGE:
+            if field.message_type.GetOptions().map_entry:
+                kind = self._MAP
+            else:
+                kind = self._MESSAGE
+        elif field.type == FD.TYPE_BYTES:
+            kind = self._BYTES
+        elif cpp_type == FD.CPPTYPE_STRING:
+            kind = self._STRING
+        elif cpp_type == FD.CPPTYPE_ENUM:
+            kind = self._ENUM
+        elif cpp_type == FD.CPPTYPE_BOOL:
+            kind = self._BOOL
+        elif cpp_type == FD.CPPTYPE_FLOAT:
+            kind = self._FLOAT
+        else:
+            kind = self._OTHER
+        name = field.name
+        if field.is_extension:
+            name = "[" + field.full_name + "]"
+        elif field.type == FD.TYPE_GROUP:
+            name = field.message_type.name
+        if cpp_type != FD.CPPTYPE_MESSAGE:
+            name += ":"
+        sub = None
+        if field.containing_type is not None:
+            sub = self._substitutions.get(field.containing_type.name, {}).get(field.name)
+        repeated = field.label == FD.LABEL_REPEATED
+        enum_values = field.enum_type.values_by_number if kind == self._ENUM else None
+        return (name, kind, repeated, sub, field, enum_values)
+
+    def _get_layout(self, msg_descriptor):
+        layout = self._layouts.get(msg_descriptor)
+        if layout is None:
+            scope = msg_descriptor.name if msg_descriptor.name in self._scopes else None
+            fields = {f: self._make_field_layout(f) for f in msg_descriptor.fields}
+            layout = (scope, fields)
+            # concurrent calls may build the same layout, which is harmless
+            self._layouts[msg_descriptor] = layout
+        return layout
+
+    def format(self, msg):
+        out = []
+        self._print_message(msg, 0, out, _PrintContext())
+        return "".join(out)
+
+    def _print_message(self, msg, indent, out, pcontext):
+        msg_descriptor = msg.DESCRIPTOR
+        scope, fields = self._get_layout(msg_descriptor)
+        if scope is not None:
+            pcontext.push(scope, msg)
+        start = len(out)
+        is_any = msg_descriptor.full_name == "google.protobuf.Any"
+        if not (is_any and self._print_any(msg, indent, out, pcontext)):
+            for field, value in msg.ListFields():
+                layout = fields.get(field)
+                if layout is None:  # extension
+                    layout = self._make_field_layout(field)
+                if layout[1] == self._MAP:
+                    entry_cls = value.GetEntryClass()
+                    for key in sorted(value):
+                        self._print_field(
+                            layout, entry_cls(key=key, value=value[key]), indent, out, pcontext)
+                elif layout[2]:
+                    for element in value:
+                        self._print_field(layout, element, indent, out, pcontext)
+                else:
+                    self._print_field(layout, value, indent, out, pcontext)
+        if len(out) == start:
+            # this is what text_format does for empty messages when using a message_formatter, and
+            # what the shell has always done
+            out.append(" " * indent + "\n")
+        if scope is not None:
+            pcontext.pop(scope)
+
+    def _print_any(self, msg, indent, out, pcontext):
+        if "/" not in msg.type_url:
+            return False
+        try:
+            packed_cls = symbol_database.Default().GetSymbol(msg.TypeName())
+        except KeyError:
+            return False
+        packed = packed_cls()
+        packed.MergeFromString(msg.value)
+        out.append("{}[{}] {{\n".format(" " * indent, msg.type_url))
+        self._print_message(packed, indent + 2, out, pcontext)
+        out.append(" " * indent + "}\n")
+        return True
 
-    # We modify the "internals" of the text_format module which is not great as it may break in the
-    # future, but this enables us to keep the code fairly small.
-    saved_printer = google.protobuf.text_format._Printer.PrintField
-    google.protobuf.text_format._Printer.PrintField = _gen_pretty_print_proto_field(
-        substitutions, pcontext)
+    def _print_field(self, layout, value, indent, out, pcontext):
+        name, kind, _, sub, field, enum_values = layout
+        out.append(" " * indent)
+        out.append(name)
+        out.append(" ")
+        if kind == self._MESSAGE or kind == self._MAP:
+            out.append("{\n")
+            self._print_message(value, indent + 2, out, pcontext)
+            out.append(" " * indent + "}")
+        elif kind == self._BYTES:
+            out.append('"' + "".join(map(self._hex_bytes.__getitem__, value)) + '"')
+        elif kind == self._STRING:
+            out.append('"' + text_encoding.CEscape(value.encode("utf-8"), False) + '"')
+        elif kind == self._ENUM:
+            enum_value = enum_values.get(value)
+            out.append(str(value) if enum_value is None else enum_value.name)
+        elif kind == self._BOOL:
+            out.append("true" if value else "false")
+        elif kind == self._FLOAT:
+            out.append(str(value) if math.isnan(value) else str(ToShortestFloat(value)))
+        else:
+            out.append(str(value))
+        if sub is not None and value != 0:
+            out.append(' ("{}")'.format(sub(field, value, pcontext)))
+        out.append("\n")
+
+
+_p4info_printer = _ProtoPrinter({
+    "Table": {"const_default_action_id": _sub_object,
+              "implementation_id": _sub_object,
+              "direct_resource_ids": _sub_object},
+    "ActionRef": {"id": _sub_object},
+    "ActionProfile": {"table_ids": _sub_object},
+    "DirectCounter": {"direct_table_id": _sub_object},
+    "DirectMeter": {"direct_table_id": _sub_object},
+})
+
+
+_p4runtime_printer = _ProtoPrinter({
+    "TableEntry": {"table_id": _sub_object},
+    "FieldMatch": {"field_id": _sub_mf},
+    "Action": {"action_id": _sub_object},
+    "Param": {"param_id": _sub_ap},
+    "ActionProfileMember": {"action_profile_id": _sub_object},
+    "ActionProfileGroup": {"action_profile_id": _sub_object},
+    "MeterEntry": {"meter_id": _sub_object},
+    "CounterEntry": {"counter_id": _sub_object},
+    "ValueSetEntry": {"value_set_id": _sub_object},
+    "RegisterEntry": {"register_id": _sub_object},
+    "DigestEntry": {"digest_id": _sub_object},
+    "DigestListAck": {"digest_id": _sub_object},
+    "DigestList": {"digest_id": _sub_object},
+    "PacketMetadata": {"metadata_id": _sub_pkt_md}
+})
 
-    s = google.protobuf.text_format.MessageToString(msg, message_formatter=message_formatter)
 
-    google.protobuf.text_format._Printer.PrintField = saved_printer
+def _repr_pretty_p4info(msg):
+    return _p4info_printer.format(msg)
 
-    return s
 
+def _repr_pretty_p4runtime(msg):
+    return _p4runtime_printer.format(msg)
 
-def _repr_pretty_p4info(msg):
-    substitutions = {
-        "Table": {"const_default_action_id": _sub_object,
-                  "implementation_id": _sub_object,
-                  "direct_resource_ids": _sub_object},
-        "ActionRef": {"id": _sub_object},
-        "ActionProfile": {"table_ids": _sub_object},
-        "DirectCounter": {"direct_table_id": _sub_object},
-        "DirectMeter": {"direct_table_id": _sub_object},
-    }
-    return _repr_pretty_proto(msg, substitutions)
 
+class _LazyDocstring:
+    """A descriptor used to generate instance docstrings on first access instead of in the
+    constructor, as formatting them can be much more expensive than creating the instance. The
+    instance's _get_docstring method is called to generate the docstring."""
+    def __init__(self, class_doc=None):
+        self._class_doc = class_doc
 
-def _repr_pretty_p4runtime(msg):
-    substitutions = {
-        "TableEntry": {"table_id": _sub_object},
-        "FieldMatch": {"field_id": _sub_mf},
-        "Action": {"action_id": _sub_object},
-        "Param": {"param_id": _sub_ap},
-        "ActionProfileMember": {"action_profile_id": _sub_object},
-        "ActionProfileGroup": {"action_profile_id": _sub_object},
-        "MeterEntry": {"meter_id": _sub_object},
-        "CounterEntry": {"counter_id": _sub_object},
-        "ValueSetEntry": {"value_set_id": _sub_object},
-        "RegisterEntry": {"register_id": _sub_object},
-        "DigestEntry": {"digest_id": _sub_object},
-        "DigestListAck": {"digest_id": _sub_object},
-        "DigestList": {"digest_id": _sub_object},
-        "PacketMetadata": {"metadata_id": _sub_pkt_md}
-    }
-    return _repr_pretty_proto(msg, substitutions)
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self._class_doc
+        return obj._get_docstring()
 
 
 class P4Object:
+    __doc__ = _LazyDocstring()
+
     def __init__(self, obj_type, obj):
         self.name = obj.preamble.name
         self.id = obj.preamble.id
         self._obj_type = obj_type
         self._obj = obj
-        self.__doc__ = """
+
+    def _get_docstring(self):
+        return """
 A wrapper around the P4Info Protobuf message for {} '{}'.
 You can access any field from the message with <self>.<field name>.
 You can access the name directly with <self>.name.
 You can access the id directly with <self>.id.
 If you need the underlying Protobuf message, you can access it with msg().
-""".format(obj_type.pretty_name, self.name)
+""".format(self._obj_type.pretty_name, self.name)
 
     def __dir__(self):
         d = ["info", "msg", "name", "id"]
@@ -258,12 +387,32 @@ If you need the underlying Protobuf message, you can access it with msg().
             raise UserError("'actions' is only available for tables and action profiles")
 
 
+def _get_p4object(obj_type, name):
+    # P4Object wrappers are immutable and shared by all the entities which refer to the same P4Info
+    # object; they are cached for the lifetime of the P4Info message.
+    registry = context.get_cached(("P4Object", obj_type), dict)
+    try:
+        return registry[name]
+    except KeyError:
+        pass
+    obj = context.get_obj(obj_type, name)
+    if obj is None:
+        raise UserError("{} '{}' does not exist".format(obj_type.pretty_name, name))
+    p4_object = registry[name] = P4Object(obj_type, obj)
+    return p4_object
+
+
 class P4Objects:
+    __doc__ = _LazyDocstring()
+
     def __init__(self, obj_type):
         self._obj_type = obj_type
-        self._names = sorted([name for name, _ in context.get_objs(obj_type)])
+        self._names = context.get_obj_names(obj_type)
         self._iter = None
-        self.__doc__ = """
+
+    def _get_docstring(self):
+        obj_type = self._obj_type
+        return """
 All the {pnames} in the P4 program.
 To access a specific {pname}, use {p4info}['<name>'].
 You can use this class to iterate over all {pname} instances:
@@ -276,14 +425,10 @@ You can use this class to iterate over all {pname} instances:
             print(name)
 
     def _ipython_key_completions_(self):
-        return self._names
+        return list(self._names)
 
     def __getitem__(self, name):
-        obj = context.get_obj(self._obj_type, name)
-        if obj is None:
-            raise UserError("{} '{}' does not exist".format(
-                self._obj_type.pretty_name, name))
-        return P4Object(self._obj_type, obj)
+        return _get_p4object(self._obj_type, name)
 
     def __setitem__(self, name, value):
         raise UserError("Operation not allowed")
@@ -300,21 +445,56 @@ You can use this class to iterate over all {pname} instances:
         return self[name]
 
 
+def _unique_suffixes(names):
+    suffixes = {}
+    suffix_count = Counter()
+    for fname in names:
+        suffix = None
+        for s in reversed(fname.split(".")):
+            suffix = s if suffix is None else s + "." + suffix
+            suffixes[suffix] = fname
+            suffix_count[suffix] += 1
+    for suffix, c in suffix_count.items():
+        if c > 1:
+            del suffixes[suffix]
+    return suffixes
+
+
 class MatchKey:
+    __doc__ = _LazyDocstring()
+
     def __init__(self, table_name, match_fields):
         self._table_name = table_name
         self._fields = OrderedDict()
         self._fields_suffixes = {}
         for mf in match_fields:
-            self._add_field(mf)
+            self._fields[mf.name] = mf
+        self._recompute_suffixes()
         self._mk = OrderedDict()
-        self._set_docstring()
+        self._doc = None
 
-    def _set_docstring(self):
-        self.__doc__ = "Match key fields for table '{}':\n\n".format(self._table_name)
-        for name, info in self._fields.items():
-            self.__doc__ += str(info)
-        self.__doc__ += """
+    @classmethod
+    def _from_table_info(cls, table_name, table_info):
+        # The field dictionaries are shared (read-only) between all the instances for the table.
+        mk = cls.__new__(cls)
+        mk._table_name = table_name
+        mk._fields = table_info.match_fields
+        mk._fields_suffixes = table_info.match_fields_suffixes
+        mk._mk = OrderedDict()
+        mk._doc = None
+        return mk
+
+    def _get_docstring(self):
+        if self._doc is None:
+            self._doc = MatchKey._make_docstring(self._table_name, self._fields)
+        return self._doc
+
+    @staticmethod
+    def _make_docstring(table_name, fields):
+        doc = "Match key fields for table '{}':\n\n".format(table_name)
+        for name, info in fields.items():
+            doc += str(info)
+        doc += """
 Set a field value with <self>['<field_name>'] = '...'
   * For exact match: <self>['<f>'] = '<value>'
   * For ternary match: <self>['<f>'] = '<value>&&&<mask>'
@@ -327,6 +507,7 @@ If it's inconvenient to use the whole field name, you can use a unique suffix.
 You may also use <self>.set(<f>='<value>')
 \t(<f> must not include a '.' in this case, but remember that you can use a unique suffix)
 """
+        return doc
 
     def _ipython_key_completions_(self):
         return self._fields.keys()
@@ -523,23 +704,8 @@ You may also use <self>.set(<f>='<value>')
         mf.range.high = bytes_utils.make_canonical_if_option_set(end)
         return mf
 
-    def _add_field(self, field_info):
-        self._fields[field_info.name] = field_info
-        self._recompute_suffixes()
-
     def _recompute_suffixes(self):
-        suffixes = {}
-        suffix_count = Counter()
-        for fname in self._fields:
-            suffix = None
-            for s in reversed(fname.split(".")):
-                suffix = s if suffix is None else s + "." + suffix
-                suffixes[suffix] = fname
-                suffix_count[suffix] += 1
-        for suffix, c in suffix_count.items():
-            if c > 1:
-                del suffixes[suffix]
-        self._fields_suffixes = suffixes
+        self._fields_suffixes = _unique_suffixes(self._fields)
 
     def __str__(self):
         return '\n'.join([str(mf) for name, mf in self._mk.items()])
@@ -559,31 +725,58 @@ You may also use <self>.set(<f>='<value>')
         return len(self._mk)
 
 
+class _ActionInfo:
+    """Per-action data derived from the P4Info message, shared by all Action instances for the
+    same action. Use _ActionInfo.get to retrieve the cached instance."""
+    def __init__(self, action_info):
+        self.action_info = action_info
+        self.params = OrderedDict()
+        for param in action_info.params:
+            self.params[param.name] = param
+        self._doc = None
+
+    @staticmethod
+    def get(action_name):
+        action_info = context.get_action(action_name)
+        if action_info is None:
+            return None
+        return context.get_cached(
+            (_ActionInfo, action_info.preamble.id), lambda: _ActionInfo(action_info))
+
+    def docstring(self):
+        if self._doc is None:
+            doc = "Action parameters for action '{}':\n\n".format(
+                self.action_info.preamble.name)
+            for name, info in self.params.items():
+                doc += str(info)
+            doc += "\n\n"
+            doc += "Set a param value with <self>['<param_name>'] = '<value>'\n"
+            doc += "You may also use <self>.set(<param_name>='<value>')\n"
+            self._doc = doc
+        return self._doc
+
+
 class Action:
+    __doc__ = _LazyDocstring()
+
     def __init__(self, action_name=None):
         self._init = False
         if action_name is None:
             raise UserError("Please provide name for action")
         self.action_name = action_name
-        action_info = context.get_action(action_name)
-        if action_info is None:
+        info = _ActionInfo.get(action_name)
+        if info is None:
             raise UserError("Unknown action '{}'".format(action_name))
+        self._cached_info = info
+        action_info = info.action_info
         self._action_id = action_info.preamble.id
-        self._params = OrderedDict()
-        for param in action_info.params:
-            self._params[param.name] = param
+        self._params = info.params
         self._action_info = action_info
         self._param_values = OrderedDict()
-        self._set_docstring()
         self._init = True
 
-    def _set_docstring(self):
-        self.__doc__ = "Action parameters for action '{}':\n\n".format(self.action_name)
-        for name, info in self._params.items():
-            self.__doc__ += str(info)
-        self.__doc__ += "\n\n"
-        self.__doc__ += "Set a param value with <self>['<param_name>'] = '<value>'\n"
-        self.__doc__ += "You may also use <self>.set(<param_name>='<value>')\n"
+    def _get_docstring(self):
+        return self._cached_info.docstring()
 
     def _ipython_key_completions_(self):
         return self._params.keys()
@@ -651,6 +844,590 @@ class Action:
             self[name] = value
 
 
+def _failed_entity(entity, update):
+    # Entity objects are commonly reused to write several entries, so the object is copied from
+    # the update (only for the failed ones, to keep batching cheap).
+    if isinstance(entity, _EntityBase):
+        return entity._new_from_msg(getattr(update.entity, entity._entity_type.name))
+    return entity
+
+
+class WriteBatch:
+    """
+    Collects the updates generated by insert / modify / delete calls and sends them to the server
+    as multi-update WriteRequests. Do not instantiate directly, use batch() instead.
+    """
+    def __init__(self, max_updates=1000, pipelined=False):
+        if max_updates is not None and (type(max_updates) is not int or max_updates <= 0):
+            raise UserError("max_updates must be a positive integer")
+        self.max_updates = max_updates
+        self.pipelined = pipelined
+        self._updates = []
+        self._entities = []
+        # (future, request, entities, shadow cache) for each WriteRequest sent in pipelined mode
+        # which has not been checked for completion yet
+        self._pending = deque()
+        # exceptions of the failed WriteRequests sent in pipelined mode, reported by wait()
+        self._errors = []
+        # number of updates sent so far
+        self.num_updates = 0
+
+    def __dir__(self):
+        return ["max_updates", "pipelined", "num_updates", "flush", "wait"]
+
+    def __len__(self):
+        return len(self._updates)
+
+    def add(self, update, entity=None):
+        """Append an Update message to the batch, flushing the batch if it is full. entity is the
+        object which generated the update, it is used for error reporting."""
+        self._updates.append(update)
+        self._entities.append(entity)
+        if self.max_updates is not None and len(self._updates) >= self.max_updates:
+            self.flush()
+
+    @staticmethod
+    def _set_failed_entities(e, req, entities):
+        e.failed_entities = [
+            (_failed_entity(entities[idx], req.updates[idx]) if idx < len(entities) else None,
+             p4_error)
+            for idx, p4_error in e.errors]
+
+    def flush(self):
+        """Send all pending updates in a single WriteRequest.
+
+        In case of error, the P4RuntimeWriteException raised has an additional
+        failed_entities attribute: a list of (entity, p4.Error) tuples, where
+        entity is a copy of the object which generated the failed update, as it
+        was when the update was generated (the object itself may have been
+        modified and written again since then). In pipelined
+        mode, this method does not wait for the server's response and errors are
+        reported by wait()."""
+        if not self._updates:
+            return
+        req = p4runtime_pb2.WriteRequest()
+        req.updates.extend(self._updates)
+        entities = self._entities
+        self._updates = []
+        self._entities = []
+        logging.debug("Flushing write batch with {} update(s)".format(len(entities)))
+        self.num_updates += len(entities)
+        self._send(req, entities)
+
+    def _send(self, req, entities):
+        if self.pipelined:
+            pending = self._pending
+            pending.append((client.write_async(req), req, entities, _shadows.get(client)))
+            # completed requests are dropped (in order, so that errors are reported in the order
+            # of the requests), so that mostly the in-flight ones are kept
+            while pending and pending[0][0].done():
+                self._complete(*pending.popleft())
+            return
+        shadow = _shadows.get(client)
+        try:
+            client.write(req)
+        except Exception as e:
+            if isinstance(e, P4RuntimeWriteException):
+                self._set_failed_entities(e, req, entities)
+            if shadow is not None:
+                shadow._record(req.updates, e)
+            raise
+        if shadow is not None:
+            shadow._record(req.updates)
+
+    def wait(self):
+        """Wait for the completion of all the WriteRequests sent in pipelined
+        mode. If some of them failed, the first error is raised; in the case of
+        a P4RuntimeWriteException, its failed_entities attribute includes the
+        failed updates for all the WriteRequests of the batch."""
+        pending = self._pending
+        self._pending = deque()
+        for item in pending:
+            self._complete(*item)
+        errors = self._errors
+        self._errors = []
+        if not errors:
+            return
+        first_error = errors[0]
+        if isinstance(first_error, P4RuntimeWriteException):
+            first_error.failed_entities = [
+                failed for e in errors if isinstance(e, P4RuntimeWriteException)
+                for failed in e.failed_entities]
+        raise first_error
+
+    def _complete(self, f, req, entities, shadow):
+        # Waits for a WriteRequest sent in pipelined mode and keeps its error for wait().
+        e = f.exception()
+        if shadow is not None:
+            shadow._record(req.updates, e)
+        if e is None:
+            return
+        if isinstance(e, P4RuntimeWriteException):
+            self._set_failed_entities(e, req, entities)
+        self._errors.append(e)
+
+    def __enter__(self):
+        global write_batch
+        if write_batch is not None:
+            raise UserError("Write batches cannot be nested")
+        write_batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global write_batch
+        try:
+            if exc_type is None:
+                self.flush()
+                self.wait()
+                return False
+            # the WriteRequests already sent are still awaited, their errors are logged since the
+            # exception raised in the scope takes precedence
+            try:
+                self.wait()
+            except Exception:
+                logging.exception("Error in a WriteRequest sent by the batch")
+            return False
+        finally:
+            write_batch = None
+
+
+def batch(max_updates=1000, pipelined=False):
+    """
+    Returns a context manager which batches all the writes (insert / modify / delete) issued in
+    its scope. Updates are sent as multi-update WriteRequests, either when max_updates updates have
+    been collected or when exiting the scope. Pending updates are discarded if an exception is
+    raised in the scope. With max_updates=None, all the updates of the scope are sent in a single
+    WriteRequest, which must not exceed the server's maximum message size (4MB by default for
+    gRPC servers).
+
+    For example:
+    with batch(max_updates=1000):
+        for i in range(10000):
+            te = table_entry['<table_name>'](action='<action_name>')
+            te.match['<f>'] = str(i)
+            te.insert()
+
+    Note that the P4Runtime server may apply the updates of a WriteRequest in any order, so updates
+    which depend on each other (e.g. a member and the table entry which refers to it) should not be
+    part of the same WriteRequest. Use <batch>.flush() to send pending updates early.
+
+    If pipelined is True, WriteRequests are sent without waiting for the response to the previous
+    ones, up to the client's max_in_flight_writes. Errors are then reported when exiting the scope
+    (if an exception is raised in the scope, the WriteRequests already sent are still awaited and
+    their errors logged).
+    In this mode, there is no ordering guarantee between WriteRequests either, so call
+    <batch>.flush() followed by <batch>.wait() before writing dependent updates.
+    """
+    return WriteBatch(max_updates, pipelined)
+
+
+ReadResult = namedtuple('ReadResult', ['device', 'source', 'entity'])
+
+# Entity field -> (path to the P4Info object id in the entity message)
+_ENTITY_SOURCE_ID = {
+    "table_entry": ("table_id",),
+    "action_profile_member": ("action_profile_id",),
+    "action_profile_group": ("action_profile_id",),
+    "meter_entry": ("meter_id",),
+    "direct_meter_entry": ("table_entry", "table_id"),
+    "counter_entry": ("counter_id",),
+    "direct_counter_entry": ("table_entry", "table_id"),
+    "register_entry": ("register_id",),
+    "value_set_entry": ("value_set_id",),
+    "digest_entry": ("digest_id",),
+}
+
+
+def _entity_source_id(entity):
+    kind = entity.WhichOneof("entity")
+    path = _ENTITY_SOURCE_ID.get(kind)
+    if path is None:
+        return kind, None
+    msg = getattr(entity, kind)
+    for attr in path:
+        msg = getattr(msg, attr)
+    return kind, msg
+
+
+def _entity_source(kind, id_, context_):
+    # Name of the P4 object (e.g. table) an Entity message belongs to.
+    if id_ is None:
+        return kind
+    try:
+        return context_.get_name_from_id(id_)
+    except KeyError:
+        return kind
+
+
+def _to_entity_msg(entity):
+    if isinstance(entity, p4runtime_pb2.Entity):
+        return entity
+    if not isinstance(entity, _EntityBase):
+        raise UserError(
+            "Expected an entity object or a p4runtime_pb2.Entity message, got {}".format(
+                type(entity).__name__))
+    entity._update_msg()
+    entity._validate_msg()
+    msg = p4runtime_pb2.Entity()
+    getattr(msg, entity._entity_type.name).CopyFrom(entity._entry)
+    return msg
+
+
+def _read_many(targets, entities, entities_per_request, max_workers):
+    # targets: list of (client, context, device) tuples.
+    entities = [_to_entity_msg(e) for e in entities]
+    if entities_per_request is None:
+        entities_per_request = max(len(entities), 1)
+    elif type(entities_per_request) is not int or entities_per_request <= 0:
+        raise UserError("entities_per_request must be a positive integer")
+    groups = [entities[i:i + entities_per_request]
+              for i in range(0, len(entities), entities_per_request)]
+    return _read_many_iter([(target, group) for target in targets for group in groups],
+                           max_workers)
+
+
+def _read_many_iter(tasks, max_workers):
+    if not tasks:
+        return
+    num_workers = min(len(tasks), max_workers)
+    # Bounded, so that the workers stop receiving when the consumer is slower than the server.
+    results = queue.Queue(maxsize=2 * num_workers)
+    # Set when the consumer stops iterating (or a read fails): the workers stop and the ongoing
+    # Read RPCs are cancelled.
+    stop = Event()
+    calls = set()
+    calls_lock = Lock()
+    done = object()
+
+    def put(item):
+        # Returns False if the consumer has stopped iterating.
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def cancel(call):
+        cancel_ = getattr(call, "cancel", None)
+        if cancel_ is not None:
+            cancel_()
+
+    @parse_p4runtime_error
+    def read(target, group):
+        client_, context_, device = target
+        sources = {}
+        reps = client_.read(group)
+        with calls_lock:
+            calls.add(reps)
+        if stop.is_set():
+            cancel(reps)
+            return
+        try:
+            for rep in reps:
+                batch = []
+                for entity in rep.entities:
+                    source_id = _entity_source_id(entity)
+                    source = sources.get(source_id)
+                    if source is None:
+                        source = sources[source_id] = _entity_source(*source_id, context_)
+                    batch.append(ReadResult(device, source, entity))
+                if not put(batch):
+                    cancel(reps)
+                    return
+        finally:
+            with calls_lock:
+                calls.discard(reps)
+
+    def run(target, group):
+        try:
+            read(target, group)
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    executor = futures.ThreadPoolExecutor(max_workers=num_workers)
+    fs = []
+    try:
+        for target, group in tasks:
+            fs.append(executor.submit(run, target, group))
+        remaining = len(tasks)
+        while remaining:
+            item = results.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield from item
+    finally:
+        stop.set()
+        for f in fs:
+            f.cancel()
+        with calls_lock:
+            for call in calls:
+                cancel(call)
+        executor.shutdown(wait=False)
+
+
+def read_many(entities, entities_per_request=1, max_workers=16):
+    """
+    Reads many entities (entity objects such as table_entry["<table_name>"], or
+    p4runtime_pb2.Entity messages) with concurrent ReadRequests, and returns an iterator of
+    ReadResult(device, source, entity) tuples, where entity is the p4runtime_pb2.Entity message
+    returned by the server, device is the device id and source the name of the P4 object (e.g.
+    the table) the entity belongs to. Results are returned as soon as they are received, so
+    results for different entities may be interleaved.
+
+    Each ReadRequest includes entities_per_request entities (all of them if None), and at most
+    max_workers requests are outstanding at a time. For example, to read all the entries of all
+    the tables, with one ReadRequest per table:
+
+    for r in read_many([table_entry[t.name] for t in P4Objects(P4Type.table)]):
+        print(r.source, r.entity.table_entry)
+    """
+    return _read_many([(client, context, client.device_id)], entities, entities_per_request,
+                      max_workers)
+
+
+# Table entry fields which are only returned by the server when requested (direct resources and
+# idle time): they are not stored in the shadow cache, and reads which request them are not
+# answered by the cache.
+_SHADOW_UNCACHED_FIELDS = ("meter_config", "counter_data", "meter_counter_data",
+                           "time_since_last_hit")
+
+
+class ShadowCache:
+    """
+    A client-side copy of the table entries of the device, kept up-to-date with the writes issued
+    by this client. Do not instantiate directly, use shadow_cache() instead.
+    """
+
+    def __init__(self, tables=None, resync_interval=None):
+        if resync_interval is not None and resync_interval <= 0:
+            raise UserError("resync_interval must be a positive number")
+        self.resync_interval = resync_interval
+        # the cache belongs to the client (and P4 program) active when it is created
+        self._client = client
+        self._context = context
+        self._table_ids = None
+        if tables is not None:
+            self._table_ids = {context.get_obj_id(P4Type.table, t) for t in tables}
+            if None in self._table_ids:
+                raise UserError("Unknown table in {}".format(tables))
+        self._lock = Lock()
+        # table id -> {table_entry_key: TableEntry message}, for the tables which are in sync only
+        self._tables = {}
+        # table id -> time.monotonic() of the last resync
+        self._synced_at = {}
+        # table id -> number of writes and invalidations, used to discard the result of a resync
+        # if the table was written to while the entries were being read
+        self._generations = Counter()
+        self.hits = 0
+        self.misses = 0
+        self.resyncs = 0
+        self.invalidations = 0
+
+    def __dir__(self):
+        return ["resync_interval", "hits", "misses", "resyncs", "invalidations", "resync",
+                "invalidate", "disable", "stats"]
+
+    def _is_cached(self, table_id):
+        return table_id != 0 and (self._table_ids is None or table_id in self._table_ids)
+
+    def _get_table_ids(self, tables):
+        if tables is not None:
+            table_ids = [self._context.get_obj_id(P4Type.table, t) for t in tables]
+            if None in table_ids:
+                raise UserError("Unknown table in {}".format(tables))
+            return table_ids
+        if self._table_ids is not None:
+            return list(self._table_ids)
+        return [t.preamble.id for _, t in self._context.get_objs(P4Type.table)]
+
+    def _invalidate_table(self, table_id):
+        self._generations[table_id] += 1
+        self._synced_at.pop(table_id, None)
+        if self._tables.pop(table_id, None) is not None:
+            self.invalidations += 1
+
+    def _record(self, updates, error=None):
+        # Called for the updates of every WriteRequest sent by the shell, with the exception raised
+        # by the write, if any. Since a failed WriteRequest may have been partially applied, the
+        # tables it includes are invalidated.
+        with self._lock:
+            for update in updates:
+                if update.entity.WhichOneof("entity") != "table_entry":
+                    continue
+                te = update.entity.table_entry
+                if not self._is_cached(te.table_id):
+                    continue
+                if error is not None:
+                    self._invalidate_table(te.table_id)
+                    continue
+                self._generations[te.table_id] += 1
+                entries = self._tables.get(te.table_id)
+                if entries is None or te.is_default_action:
+                    continue
+                key = table_entry_key(te)
+                if update.type == p4runtime_pb2.Update.DELETE:
+                    entries.pop(key, None)
+                else:
+                    entries[key] = self._strip(te)
+
+    @staticmethod
+    def _strip(te):
+        # The messages are not copied unless they need to be modified: the Update messages are
+        # owned by the shell and not reused once sent.
+        fields = [f for f in _SHADOW_UNCACHED_FIELDS if te.HasField(f)]
+        if not fields:
+            return te
+        msg = p4runtime_pb2.TableEntry()
+        msg.CopyFrom(te)
+        for f in fields:
+            msg.ClearField(f)
+        return msg
+
+    @parse_p4runtime_error
+    def _load(self, table_ids):
+        with self._lock:
+            generations = {t: self._generations[t] for t in table_ids}
+        tables = {t: {} for t in table_ids}
+        entities = []
+        for t in table_ids:
+            entity = p4runtime_pb2.Entity()
+            entity.table_entry.table_id = t
+            entities.append(entity)
+        for rep in self._client.read(entities):
+            for entity in rep.entities:
+                te = entity.table_entry
+                tables[te.table_id][table_entry_key(te)] = self._strip(te)
+        now = time.monotonic()
+        with self._lock:
+            self.resyncs += 1
+            for t, entries in tables.items():
+                if self._generations[t] == generations[t]:
+                    self._tables[t] = entries
+                    self._synced_at[t] = now
+        return tables
+
+    def _read(self, entity):
+        # Returns a ReadResponse message for the entity, or None if the read cannot be answered
+        # by the cache.
+        if entity.WhichOneof("entity") != "table_entry":
+            return None
+        te = entity.table_entry
+        if not self._is_cached(te.table_id) or te.is_default_action:
+            return None
+        for f in _SHADOW_UNCACHED_FIELDS:
+            if te.HasField(f):
+                return None
+        key = table_entry_key(te) if te.match else None
+        with self._lock:
+            entries = self._tables.get(te.table_id)
+            if entries is not None and self.resync_interval is not None and \
+                    time.monotonic() - self._synced_at[te.table_id] >= self.resync_interval:
+                entries = None
+            if entries is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                matches = list(entries.values()) if key is None else [entries.get(key)]
+        if entries is None:
+            entries = self._load([te.table_id])[te.table_id]
+            matches = list(entries.values()) if key is None else [entries.get(key)]
+        rep = p4runtime_pb2.ReadResponse()
+        for msg in matches:
+            if msg is not None:
+                rep.entities.add().table_entry.CopyFrom(msg)
+        return rep
+
+    def resync(self, tables=None):
+        """Reads the entries of the given tables (list of names, all the cached tables by
+        default) from the device now, with a single ReadRequest."""
+        self._load(self._get_table_ids(tables))
+
+    def invalidate(self, tables=None):
+        """Drops the entries of the given tables (list of names, all the cached tables by
+        default), the next read of these tables is sent to the device."""
+        with self._lock:
+            for t in self._get_table_ids(tables):
+                self._invalidate_table(t)
+
+    def disable(self):
+        """Disables the cache: reads are sent to the device again."""
+        if _shadows.get(self._client) is self:
+            del _shadows[self._client]
+            self._client.remove_primary_callback(self.invalidate)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disable()
+        return False
+
+    def stats(self):
+        """Returns a dictionary with the cache counters."""
+        with self._lock:
+            return {
+                "tables": len(self._tables),
+                "entries": sum(len(entries) for entries in self._tables.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "resyncs": self.resyncs,
+                "invalidations": self.invalidations,
+            }
+
+
+def shadow_cache(tables=None, resync_interval=None):
+    """
+    Enables a client-side copy of the table entries of the device, and returns it (a ShadowCache
+    instance). Successful writes issued by the shell (insert / modify / delete, including batched
+    writes) update the copy, and table entry reads (read() and read_msgs()) are answered from it
+    without a Read RPC when possible: reads of a specific entry (all the match fields set) and
+    wildcard reads of a table. This is only correct if this client is the only writer for the
+    cached tables (all the tables by default, or the list of table names in tables).
+
+    The entries of a table are read from the device the first time the table is read, and again
+    on the next read once resync_interval seconds have elapsed (if provided); call resync() to read
+    them immediately. The following reads are always sent to the device: reads of default entries,
+    reads of direct resources (counter_data, meter_config, ...) or time_since_last_hit, and reads
+    of all the tables at once. read_many() and snapshots always read from the device.
+
+    The copy of a table is invalidated, and read from the device again by the next read, if a
+    WriteRequest including one of its entries fails. All the tables are invalidated when the client
+    transitions from backup to primary, since another controller may have modified the tables.
+
+    The cache belongs to the active client: with sessions (see p4runtime_sh.session), each session
+    can have its own cache, enabled while the session is active, and writes fanned out to several
+    sessions update the cache of each of them.
+
+    cache = shadow_cache(tables=["MyIngress.ipv4_lpm"], resync_interval=60)
+    ...
+    print(cache.stats())
+    cache.disable()
+    """
+    if client in _shadows:
+        raise UserError("The shadow cache is already enabled")
+    shadow = ShadowCache(tables, resync_interval)
+    _shadows[client] = shadow
+    client.add_primary_callback(shadow.invalidate)
+    return shadow
+
+
+def _read_one(entity):
+    # Read path of the entity objects: the shadow cache (if enabled) answers the read if it can.
+    shadow = _shadows.get(client)
+    if shadow is not None:
+        rep = shadow._read(entity)
+        if rep is not None:
+            return iter([rep])
+    return client.read_one(entity)
+
+
 class _EntityBase:
     def __init__(self, entity_type, p4runtime_cls, modify_only=False):
         self._init = False
@@ -659,7 +1436,7 @@ class _EntityBase:
         self._modify_only = modify_only
 
     def __dir__(self):
-        d = ["msg", "read"]
+        d = ["msg", "read", "read_msgs"]
         if self._modify_only:
             d.append("modify")
         else:
@@ -696,7 +1473,18 @@ class _EntityBase:
         update = p4runtime_pb2.Update()
         update.type = type_
         getattr(update.entity, self._entity_type.name).CopyFrom(self._entry)
-        client.write_update(update)
+        if write_batch is not None:
+            write_batch.add(update, self)
+            return
+        shadow = _shadows.get(client)
+        try:
+            client.write_update(update)
+        except Exception as e:
+            if shadow is not None:
+                shadow._record((update,), e)
+            raise
+        if shadow is not None:
+            shadow._record((update,))
 
     def insert(self):
         if self._modify_only:
@@ -717,6 +1505,15 @@ class _EntityBase:
     def _from_msg(self, msg):
         raise NotImplementedError
 
+    def _new_from_msg(self, msg):
+        # creates a new instance of the same entity from a message
+        if isinstance(self, _P4EntityBase):
+            e = type(self)(self.name)
+        else:
+            e = type(self)()
+        e._from_msg(msg)
+        return e
+
     def read(self, function=None):
         # Entities should override this method and provide a helpful docstring
         self._update_msg()
@@ -724,7 +1521,7 @@ class _EntityBase:
         entity = p4runtime_pb2.Entity()
         getattr(entity, self._entity_type.name).CopyFrom(self._entry)
 
-        iterator = client.read_one(entity)
+        iterator = _read_one(entity)
 
         # Cannot use a (simpler) generator here as we need to decorate __next__ with
         # @parse_p4runtime_error.
@@ -748,16 +1545,8 @@ class _EntityBase:
                     self._entities_it = None
                     return next(self)
 
-                if isinstance(self._entity, _P4EntityBase):
-                    e = type(self._entity)(self._entity.name)  # create new instance of same entity
-                else:
-                    e = type(self._entity)()
                 msg = getattr(entity, self._entity._entity_type.name)
-                e._from_msg(msg)
-                # neither of these should be needed
-                # e._update_msg()
-                # e._entry.CopyFrom(msg)
-                return e
+                return self._entity._new_from_msg(msg)
 
         if function is None:
             return _EntryIterator(self, iterator)
@@ -765,6 +1554,36 @@ class _EntityBase:
             for x in _EntryIterator(self, iterator):
                 function(x)
 
+    def read_msgs(self, function=None):
+        """Same as read(), but the server's response is not converted to Python objects: instead,
+        the P4Runtime Protobuf messages (e.g. p4runtime_pb2.TableEntry for table entries) are
+        returned directly. This is much faster when reading a large number of entities, and
+        entities are streamed one ReadResponse at a time so memory usage does not depend on the
+        number of entities.
+
+        If function is None, returns an iterator of messages. Otherwise, function is applied to
+        all the messages returned by the server.
+        """
+        self._update_msg()
+        self._validate_msg()
+        entity = p4runtime_pb2.Entity()
+        getattr(entity, self._entity_type.name).CopyFrom(self._entry)
+
+        it = self._iter_msgs(_read_one(entity))
+        if function is None:
+            return it
+        for msg in it:
+            function(msg)
+
+    def _iter_msgs(self, responses):
+        name = self._entity_type.name
+        try:
+            for rep in responses:
+                for entity in rep.entities:
+                    yield getattr(entity, name)
+        except grpc.RpcError as e:
+            raise P4RuntimeException(e) from None
+
 
 class _P4EntityBase(_EntityBase):
     def __init__(self, p4_type, entity_type, p4runtime_cls, name=None, modify_only=False):
@@ -773,7 +1592,7 @@ class _P4EntityBase(_EntityBase):
         if name is None:
             raise UserError("Please provide name for {}".format(p4_type.pretty_name))
         self.name = name
-        self._info = P4Objects(p4_type)[name]
+        self._info = _get_p4object(p4_type, name)
         self.id = self._info.id
 
     def __dir__(self):
@@ -1117,7 +1936,7 @@ class Oneshot:
             raise UserError("Please provide table name")
         self.table_name = table_name
         self.actions = []
-        self._table_info = P4Objects(P4Type.table)[table_name]
+        self._table_info = _get_p4object(P4Type.table, table_name)
         ap = _get_action_profile(table_name)
         if not ap:
             raise UserError("Cannot create Oneshot instance for a direct table")
@@ -1369,96 +2188,86 @@ class _IdleTimeout:
         return d, r
 
 
-class TableEntry(_P4EntityBase):
-    @enum.unique
-    class _ActionSpecType(enum.Enum):
-        NONE = 0
-        DIRECT_ACTION = 1
-        MEMBER_ID = 2
-        GROUP_ID = 3
-        ONESHOT = 4
-
-    @classmethod
-    def _action_spec_name_to_type(cls, name):
-        return {
-            "action": cls._ActionSpecType.DIRECT_ACTION,
-            "member_id": cls._ActionSpecType.MEMBER_ID,
-            "group_id": cls._ActionSpecType.GROUP_ID,
-            "oneshot": cls._ActionSpecType.ONESHOT,
-        }.get(name, None)
-
-    def __init__(self, table_name=None):
-        super().__init__(
-            P4Type.table, P4RuntimeEntity.table_entry,
-            p4runtime_pb2.TableEntry, table_name)
-        self.match = MatchKey(table_name, self._info.match_fields)
-        self._action_spec_type = self._ActionSpecType.NONE
-        self._action_spec = None
-        self.priority = 0
-        self.is_default = False
-        ap = _get_action_profile(table_name)
-        if ap is None:
-            self._support_members = False
-            self._support_groups = False
+class _TableInfo:
+    """Per-table data derived from the P4Info message, shared by all TableEntry instances for the
+    same table. Use _TableInfo.get to retrieve the cached instance."""
+    def __init__(self, table_name):
+        table = context.get_table(table_name)
+        self.name = table_name
+        self.match_fields = OrderedDict()
+        for mf in table.match_fields:
+            self.match_fields[mf.name] = mf
+        self.match_fields_suffixes = _unique_suffixes(self.match_fields)
+        self.action_ids = frozenset(action_ref.id for action_ref in table.action_refs)
+        self.action_profile = _get_action_profile(table_name)
+        if self.action_profile is None:
+            self.support_members = False
+            self.support_groups = False
         else:
-            self._support_members = True
-            self._support_groups = ap.with_selector
-        self._direct_counter = None
-        self._direct_meter = None
-        for res_id in self._info.direct_resource_ids:
+            self.support_members = True
+            self.support_groups = self.action_profile.with_selector
+        self.direct_counter = None
+        self.direct_meter = None
+        for res_id in table.direct_resource_ids:
             prefix = (res_id & 0xff000000) >> 24
             if prefix == p4info_pb2.P4Ids.DIRECT_COUNTER:
-                self._direct_counter = context.get_obj_by_id(res_id)
+                self.direct_counter = context.get_obj_by_id(res_id)
             elif prefix == p4info_pb2.P4Ids.DIRECT_METER:
-                self._direct_meter = context.get_obj_by_id(res_id)
-        self._counter_data = None
-        self._meter_config = None
-        self.idle_timeout_ns = 0
-        self._time_since_last_hit = None
-        self._idle_timeout_behavior = None
-        table = context.get_table(table_name)
+                self.direct_meter = context.get_obj_by_id(res_id)
+        self.idle_timeout_behavior = None
         if table.idle_timeout_behavior > 0:
-            self._idle_timeout_behavior = table.idle_timeout_behavior
-        self.metadata = b""
-        self.__doc__ = """
+            self.idle_timeout_behavior = table.idle_timeout_behavior
+        self._doc = None
+
+    @staticmethod
+    def get(table_name):
+        return context.get_cached((_TableInfo, table_name), lambda: _TableInfo(table_name))
+
+    def docstring(self):
+        if self._doc is None:
+            self._doc = self._make_docstring()
+        return self._doc
+
+    def _make_docstring(self):
+        doc = """
 An entry for table '{}'
 
 Use <self>.info to display the P4Info entry for this table.
 
 To set the match key, use <self>.match['<field name>'] = <expr>.
 Type <self>.match? for more details.
-""".format(table_name)
-        if self._direct_counter is not None:
-            self.__doc__ += """
+""".format(self.name)
+        if self.direct_counter is not None:
+            doc += """
 To set the counter spec, use <self>.counter_data.byte_count and/or <self>.counter_data.packet_count.
 To unset it, use <self>.counter_data = None or <self>.clear_counter_data().
 """
-        if self._direct_meter is not None:
-            self.__doc__ += """
+        if self.direct_meter is not None:
+            doc += """
 To access the meter config, use <self>.meter_config.<cir|cburst|pir|pburst|eburst>.
 To unset it, use <self>.meter_config = None or <self>.clear_meter_config().
 """
-        if ap is None:
-            self.__doc__ += """
+        if self.action_profile is None:
+            doc += """
 To set the action specification (this is a direct table):
 <self>.action = <instance of type Action>.
 To set the value of action parameters, use <self>.action['<param name>'] = <expr>.
 Type <self>.action? for more details.
 """
-        if self._support_members:
-            self.__doc__ += """
+        if self.support_members:
+            doc += """
 Access the member_id with <self>.member_id.
 """
-        if self._support_groups:
-            self.__doc__ += """
+        if self.support_groups:
+            doc += """
 Or access the group_id with <self>.group_id.
 """
-        if self._idle_timeout_behavior is not None:
-            self.__doc__ += """
+        if self.idle_timeout_behavior is not None:
+            doc += """
 To access the time this entry was last hit, use <self>.time_since_last_hit.elapsed_ns.
 To unset it, use <self>.time_since_last_hit = None or <self>.clear_time_since_last_hit().
 """
-        self.__doc__ += """
+        doc += """
 To set the priority, use <self>.priority = <expr>.
 
 To mark the entry as default, use <self>.is_default = True.
@@ -1467,8 +2276,8 @@ To add an idle timeout to the entry, use <self>.idle_timeout_ns = <expr>.
 
 To add metadata to the entry, use <self>.metadata = <expr>.
 """
-        if ap is None:
-            self.__doc__ += """
+        if self.action_profile is None:
+            doc += """
 Typical usage to insert a table entry:
 t = table_entry['<table_name>'](action='<action_name>')
 t.match['<f1>'] = ...
@@ -1490,7 +2299,7 @@ t.action['<pM>'] = ...
 t.modify
 """
         else:
-            self.__doc__ += """
+            doc += """
 Typical usage to insert a table entry:
 t = table_entry['<table_name>']
 t.match['<f1>'] = ...
@@ -1499,15 +2308,93 @@ t.match['<fN>'] = ...
 # OR t.match.set(f1=..., ..., fN=...)
 t.member_id = <expr>
 """
-        self.__doc__ += """
+        doc += """
 For information about how to read table entries, use <self>.read?
 """
+        return doc
+
+
+def _match_key(matches):
+    key = []
+    canon = bytes_utils.to_canonical_bytes
+    for m in matches:
+        kind = m.WhichOneof("field_match_type")
+        if kind == "exact":
+            key.append((m.field_id, canon(m.exact.value)))
+        elif kind == "lpm":
+            key.append((m.field_id, canon(m.lpm.value), m.lpm.prefix_len))
+        elif kind == "ternary":
+            key.append((m.field_id, canon(m.ternary.value), canon(m.ternary.mask)))
+        elif kind == "range":
+            key.append((m.field_id, canon(m.range.low), canon(m.range.high)))
+        elif kind == "optional":
+            key.append((m.field_id, canon(m.optional.value)))
+        else:
+            key.append((m.field_id, m.SerializeToString(deterministic=True)))
+    key.sort()
+    return tuple(key)
+
+
+def table_entry_key(table_entry):
+    """
+    Returns the canonical key of a p4runtime_pb2.TableEntry message: a tuple (table_id, priority,
+    is_default_action, field matches), where the field matches are sorted by field id and use
+    canonical bytestrings, whatever the value of the canonical_bytestrings option. Two messages
+    for the same entry have the same key, which can be used as a dictionary key.
+    """
+    return (table_entry.table_id, table_entry.priority, table_entry.is_default_action,
+            _match_key(table_entry.match))
+
+
+class TableEntry(_P4EntityBase):
+    @enum.unique
+    class _ActionSpecType(enum.Enum):
+        NONE = 0
+        DIRECT_ACTION = 1
+        MEMBER_ID = 2
+        GROUP_ID = 3
+        ONESHOT = 4
+
+    @classmethod
+    def _action_spec_name_to_type(cls, name):
+        return {
+            "action": cls._ActionSpecType.DIRECT_ACTION,
+            "member_id": cls._ActionSpecType.MEMBER_ID,
+            "group_id": cls._ActionSpecType.GROUP_ID,
+            "oneshot": cls._ActionSpecType.ONESHOT,
+        }.get(name, None)
+
+    __doc__ = _LazyDocstring()
 
+    def __init__(self, table_name=None):
+        super().__init__(
+            P4Type.table, P4RuntimeEntity.table_entry,
+            p4runtime_pb2.TableEntry, table_name)
+        table_info = _TableInfo.get(self._info.name)
+        self._table_info = table_info
+        self.match = MatchKey._from_table_info(table_name, table_info)
+        self._action_spec_type = self._ActionSpecType.NONE
+        self._action_spec = None
+        self.priority = 0
+        self.is_default = False
+        self._support_members = table_info.support_members
+        self._support_groups = table_info.support_groups
+        self._direct_counter = table_info.direct_counter
+        self._direct_meter = table_info.direct_meter
+        self._counter_data = None
+        self._meter_config = None
+        self.idle_timeout_ns = 0
+        self._time_since_last_hit = None
+        self._idle_timeout_behavior = table_info.idle_timeout_behavior
+        self.metadata = b""
         self._init = True
 
+    def _get_docstring(self):
+        return self._table_info.docstring()
+
     def __dir__(self):
         d = super().__dir__() + [
-            "match", "priority", "is_default", "idle_timeout_ns", "metadata",
+            "match", "priority", "is_default", "key", "idle_timeout_ns", "metadata", "load",
             "clear_action", "clear_match", "clear_counter_data", "clear_meter_config",
             "clear_time_since_last_hit"]
         if self._support_groups:
@@ -1601,6 +2488,8 @@ For information about how to read table entries, use <self>.read?
             return
         elif name == "name":
             raise UserError("Cannot change table name")
+        elif name == "key":
+            raise UserError("Cannot set 'key', it is derived from the match key and priority")
         elif name == "priority":
             if type(value) is not int:
                 raise UserError("priority must be an integer")
@@ -1687,11 +2576,13 @@ For information about how to read table entries, use <self>.read?
             return self._action_spec
         return None
 
+    @property
+    def key(self):
+        """The canonical key of the entry (see table_entry_key), usable as a dictionary key."""
+        return (self.id, self.priority, self.is_default, _match_key(self.match._mk.values()))
+
     def _is_valid_action_id(self, action_id):
-        for action_ref in self._info.action_refs:
-            if action_id == action_ref.id:
-                return True
-        return False
+        return action_id in self._table_info.action_ids
 
     def _from_msg(self, msg):
         self.priority = msg.priority
@@ -1746,9 +2637,74 @@ For information about how to read table entries, use <self>.read?
 
         To delete all the entries from a table, simply use:
         table_entry['<table_name>'].read(function=lambda x: x.delete())
+
+        When reading large tables, consider using <self>.read_msgs instead, which
+        returns p4runtime_pb2.TableEntry messages without any conversion.
         """
         return super().read(function)
 
+    def load(self, path, file_format=None, update_type="insert", max_updates=1000,
+             pipelined=False):
+        """Generate WriteRequests for all the entries listed in a CSV or JSONL
+        file (one entry per row / line) and return the number of entries.
+
+        For CSV files, the first row lists the column names. For JSONL files,
+        each line is a JSON object mapping column names to values. The file
+        format is inferred from the file extension unless file_format ('csv' or
+        'jsonl') is provided. Use '-' as the path to read from stdin.
+
+        Column names can be:
+          * a match field name, or a unique suffix of one
+          * an action parameter name
+          * 'action', 'priority', 'member_id' or 'group_id'
+        Values use the same syntax as <self>.match['<f>'] = '...' and
+        <self>.action['<p>'] = '...'. Empty values are ignored, for example to
+        omit a ternary field for some entries.
+
+        Anything already set on <self> (action, action parameters, match fields,
+        priority, ...) is used as default for all the entries. For example:
+        table_entry['<table_name>'](action='<action_name>').load('routes.csv')
+
+        update_type is one of 'insert' (default), 'modify' or 'delete'. The
+        updates are sent as WriteRequests of up to max_updates updates
+        (see batch() for the meaning of pipelined), or added to the current
+        batch if called in the scope of a batch. In case of a
+        P4RuntimeWriteException, the failed_entities attribute includes
+        (path, line number) tuples.
+        """
+        loader = _TableEntryLoader(self, update_type)
+        if path == "-":
+            if file_format is None:
+                raise UserError("file_format must be provided when reading from stdin")
+            return self._load(loader, sys.stdin, file_format, "<stdin>", max_updates, pipelined)
+        file_format = _TableEntryLoader.get_file_format(path, file_format)
+        with open(path, 'r', newline='') as f:
+            return self._load(loader, f, file_format, path, max_updates, pipelined)
+
+    @staticmethod
+    def _load(loader, f, file_format, path, max_updates, pipelined):
+        count = 0
+        if write_batch is not None:
+            for line_num, update in loader.updates(f, file_format, path):
+                write_batch.add(update, (path, line_num))
+                count += 1
+            return count
+        b = WriteBatch(max_updates, pipelined)
+        try:
+            for line_num, update in loader.updates(f, file_format, path):
+                b.add(update, (path, line_num))
+                count += 1
+            b.flush()
+        except BaseException:
+            # do not leave WriteRequests in flight behind us, the original error takes precedence
+            try:
+                b.wait()
+            except Exception:
+                pass
+            raise
+        b.wait()
+        return count
+
     def _update_msg(self):
         entry = p4runtime_pb2.TableEntry()
         entry.table_id = self.id
@@ -1807,6 +2763,339 @@ For information about how to read table entries, use <self>.read?
         self._time_since_last_hit = None
 
 
+def _make_mf_parser(field_info, canonical):
+    """Returns a function which converts a string to a FieldMatch message for the given match field.
+    Unlike MatchKey.__setitem__, this does not print anything and values are silently masked, which
+    is what we want when loading many entries from a file."""
+    field_id = field_info.id
+    bitwidth = field_info.bitwidth
+    nbytes = (bitwidth + 7) // 8
+    parse_value = bytes_utils.make_value_parser(bitwidth)
+    full_mask = (1 << bitwidth) - 1
+    match_type = field_info.match_type
+    FieldMatch = p4runtime_pb2.FieldMatch
+
+    def parse_exact(s):
+        mf = FieldMatch(field_id=field_id)
+        mf.exact.value = canonical(parse_value(s))
+        return mf
+
+    def parse_optional(s):
+        mf = FieldMatch(field_id=field_id)
+        mf.optional.value = canonical(parse_value(s))
+        return mf
+
+    def parse_lpm(s):
+        prefix, sep, length = s.partition('/')
+        prefix = parse_value(prefix.strip())
+        if sep:
+            try:
+                length = int(length)
+            except ValueError:
+                raise UserError("'{}' is not a valid prefix length".format(length))
+        else:
+            length = bitwidth
+        if length == 0:
+            raise UserError(
+                "Ignoring LPM don't care match (prefix length of 0) as per P4Runtime spec")
+        if length < 0 or length > bitwidth:
+            raise UserError("Invalid prefix length")
+        mf = FieldMatch(field_id=field_id)
+        mf.lpm.prefix_len = length
+        if length // 8 == len(prefix):
+            mf.lpm.value = prefix
+            return mf
+        mask = ((1 << length) - 1) << (bitwidth - length)
+        value = int.from_bytes(prefix, byteorder='big') & mask
+        mf.lpm.value = canonical(value.to_bytes(nbytes, byteorder='big'))
+        return mf
+
+    def parse_ternary(s):
+        value, sep, mask = s.partition('&&&')
+        value = parse_value(value.strip())
+        if sep:
+            mask = parse_value(mask.strip())
+        else:
+            mask = full_mask.to_bytes(nbytes, byteorder='big')
+        mask_ = int.from_bytes(mask, byteorder='big')
+        if mask_ == 0:
+            raise UserError("Ignoring ternary don't care match (mask of 0s) as per P4Runtime spec")
+        value_ = int.from_bytes(value, byteorder='big') & mask_
+        mf = FieldMatch(field_id=field_id)
+        mf.ternary.value = canonical(value_.to_bytes(len(value), byteorder='big'))
+        mf.ternary.mask = canonical(mask)
+        return mf
+
+    def parse_range(s):
+        start, sep, end = s.partition('..')
+        if not sep:
+            raise UserError("'{}' does not specify a valid range, use '<start>..<end>'".format(s))
+        start = parse_value(start.strip())
+        end = parse_value(end.strip())
+        start_ = int.from_bytes(start, byteorder='big')
+        end_ = int.from_bytes(end, byteorder='big')
+        if start_ > end_:
+            raise UserError("Invalid range match: start is greater than end")
+        if start_ == 0 and end_ == full_mask:
+            raise UserError(
+                "Ignoring range don't care match (all possible values) as per P4Runtime spec")
+        mf = FieldMatch(field_id=field_id)
+        mf.range.low = canonical(start)
+        mf.range.high = canonical(end)
+        return mf
+
+    parsers = {
+        p4info_pb2.MatchField.EXACT: parse_exact,
+        p4info_pb2.MatchField.LPM: parse_lpm,
+        p4info_pb2.MatchField.TERNARY: parse_ternary,
+        p4info_pb2.MatchField.RANGE: parse_range,
+        p4info_pb2.MatchField.OPTIONAL: parse_optional,
+    }
+    if match_type not in parsers:
+        raise UserError("Unsupported match type for field:\n{}".format(field_info))
+    return parsers[match_type]
+
+
+class _TableEntryLoader:
+    """Converts the rows of a CSV or JSONL file to Update messages for one table.
+
+    Each column name is resolved once (to a match field, an action parameter or one of the special
+    columns), and the value parsers are built once per match field and once per action, so that
+    converting a cell is a single function call."""
+    _update_types = {
+        "insert": p4runtime_pb2.Update.INSERT,
+        "modify": p4runtime_pb2.Update.MODIFY,
+        "delete": p4runtime_pb2.Update.DELETE,
+    }
+    _special_columns = ("action", "priority", "member_id", "group_id")
+
+    def __init__(self, template, update_type="insert"):
+        if update_type not in self._update_types:
+            raise UserError("update_type must be one of {}".format(
+                ", ".join(self._update_types.keys())))
+        self._update_type = self._update_types[update_type]
+        table_info = template._table_info
+        self._table_info = table_info
+        if global_options.get_option(Options.canonical_bytestrings):
+            self._canonical = bytes_utils.to_canonical_bytes
+        else:
+            self._canonical = bytes
+        self._param_names = set()
+        for action_id in table_info.action_ids:
+            for param in context.get_obj_by_id(action_id).params:
+                self._param_names.add(param.name)
+        # Everything already set on the template TableEntry is used as default for each row.
+        template._update_msg()
+        self._base = p4runtime_pb2.TableEntry()
+        self._base.CopyFrom(template._entry)
+        self._base.ClearField("match")
+        self._base.ClearField("action")
+        self._table_id = template.id
+        self._copy_base = self._base != p4runtime_pb2.TableEntry(table_id=self._table_id)
+        self._default_match = OrderedDict(template.match._mk)
+        self._default_action_spec = p4runtime_pb2.TableAction()
+        self._default_action_spec.CopyFrom(template._entry.action)
+        self._default_action_name = None
+        self._default_params = {}
+        if template._action_spec_type == TableEntry._ActionSpecType.DIRECT_ACTION:
+            self._default_action_name = template._action_spec.action_name
+            self._default_params = template._action_spec._param_values
+        # column name -> (kind, name, match field parser)
+        self._columns = {}
+        self._mf_parsers = {}
+        # action name -> (action id, [(param id, param name, parser, default value)])
+        self._actions = {}
+
+    def _resolve_column(self, name):
+        column = self._columns.get(name)
+        if column is not None:
+            return column
+        table_info = self._table_info
+        if name in self._special_columns:
+            if name == "action" and table_info.action_profile is not None:
+                raise UserError(
+                    "Table has an implementation and therefore does not support direct actions")
+            if name == "member_id" and not table_info.support_members:
+                raise UserError(
+                    "Table does not have an action profile and therefore does not support members")
+            if name == "group_id" and not table_info.support_groups:
+                raise UserError(
+                    "Table does not have an action profile with selector "
+                    "and therefore does not support groups")
+            column = (name, name, None)
+        else:
+            mf_name = name if name in table_info.match_fields else \
+                table_info.match_fields_suffixes.get(name)
+            is_param = name in self._param_names
+            if mf_name is not None and is_param:
+                raise UserError(
+                    "Column '{}' is ambiguous for table '{}': it is both a match field and an "
+                    "action parameter name".format(name, table_info.name))
+            if mf_name is not None:
+                if mf_name in self._mf_parsers:
+                    raise UserError("Match field '{}' is set by more than one column".format(
+                        mf_name))
+                parser = _make_mf_parser(table_info.match_fields[mf_name], self._canonical)
+                self._mf_parsers[mf_name] = parser
+                column = ("match", mf_name, parser)
+            elif is_param:
+                column = ("param", name, None)
+            else:
+                raise UserError(
+                    "Column '{}' is not a valid match field name (nor a valid unique suffix) or "
+                    "action parameter name for table '{}'".format(name, table_info.name))
+        self._columns[name] = column
+        return column
+
+    def _resolve_action(self, action_name):
+        action = self._actions.get(action_name)
+        if action is not None:
+            return action
+        action_info = context.get_action(action_name)
+        if action_info is None:
+            raise UserError("Unknown action '{}'".format(action_name))
+        action_id = action_info.preamble.id
+        if action_id not in self._table_info.action_ids:
+            raise UserError("action '{}' is not a valid action for this table".format(
+                action_name))
+        defaults = {}
+        if action_name == self._default_action_name:
+            defaults = self._default_params
+        params = []
+        for param in action_info.params:
+            parser = bytes_utils.make_value_parser(param.bitwidth)
+            default = defaults.get(param.name)
+            params.append((param.id, param.name, parser,
+                           None if default is None else default.value))
+        action = (action_id, params)
+        self._actions[action_name] = action
+        return action
+
+    def make_update(self, cells):
+        """Returns an Update message for a row, given as an iterable of (column name, value)."""
+        match = OrderedDict(self._default_match) if self._default_match else {}
+        params = {}
+        specials = {}
+        for name, value in cells:
+            if value is None:
+                continue
+            if type(value) is not str:
+                value = str(value)
+            else:
+                value = value.strip()
+                if not value:
+                    continue
+            kind, name, parser = self._resolve_column(name)
+            if kind == "match":
+                match[name] = parser(value)
+            elif kind == "param":
+                params[name] = value
+            else:
+                specials[kind] = value
+
+        update = p4runtime_pb2.Update()
+        update.type = self._update_type
+        entry = update.entity.table_entry
+        if self._copy_base:
+            entry.CopyFrom(self._base)
+        else:
+            entry.table_id = self._table_id
+        entry.match.extend(match.values())
+        if "priority" in specials:
+            entry.priority = self._parse_int("priority", specials["priority"])
+
+        action_specs = [k for k in ("action", "member_id", "group_id") if k in specials]
+        if len(action_specs) > 1:
+            raise UserError("Only one of {} can be set for an entry".format(
+                ", ".join(action_specs)))
+        if "member_id" in specials:
+            entry.action.action_profile_member_id = self._parse_int(
+                "member_id", specials["member_id"])
+        elif "group_id" in specials:
+            entry.action.action_profile_group_id = self._parse_int(
+                "group_id", specials["group_id"])
+        elif "action" in specials or (params and self._default_action_name is not None):
+            action_name = specials.get("action", self._default_action_name)
+            action_id, action_params = self._resolve_action(action_name)
+            action = entry.action.action
+            action.action_id = action_id
+            canonical = self._canonical
+            for param_id, param_name, parser, default in action_params:
+                value = params.get(param_name)
+                if value is not None:
+                    value = canonical(parser(value))
+                elif default is not None:
+                    value = default
+                else:
+                    raise UserError("Missing value for parameter '{}' of action '{}'".format(
+                        param_name, action_name))
+                action.params.add(param_id=param_id, value=value)
+        elif params:
+            raise UserError("Action parameters are set but no action is specified")
+        elif self._default_action_spec.WhichOneof("type") is not None:
+            entry.action.CopyFrom(self._default_action_spec)
+        return update
+
+    @staticmethod
+    def _parse_int(name, value):
+        try:
+            return int(value, 0)
+        except ValueError:
+            raise UserError("{} must be an integer".format(name))
+
+    @staticmethod
+    def _read_csv(f, path):
+        reader = csv.reader(f)
+        header = None
+        for row in reader:
+            if not row or row[0].startswith("#"):
+                continue
+            if header is None:
+                header = [name.strip() for name in row]
+                continue
+            if len(row) != len(header):
+                raise UserError("{}, line {}: expected {} values but got {}".format(
+                    path, reader.line_num, len(header), len(row)))
+            yield reader.line_num, zip(header, row)
+
+    @staticmethod
+    def _read_jsonl(f, path):
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                raise UserError("{}, line {}: invalid JSON: {}".format(path, line_num, e))
+            if not isinstance(row, dict):
+                raise UserError("{}, line {}: expected a JSON object".format(path, line_num))
+            yield line_num, row.items()
+
+    _readers = {"csv": _read_csv.__func__, "jsonl": _read_jsonl.__func__}
+
+    @classmethod
+    def get_file_format(cls, path, file_format=None):
+        if file_format is None:
+            ext = os.path.splitext(path)[1].lower()
+            file_format = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}.get(ext)
+            if file_format is None:
+                raise UserError(
+                    "Cannot infer file format from '{}', please provide it".format(path))
+        if file_format not in cls._readers:
+            raise UserError("file_format must be one of {}".format(", ".join(cls._readers)))
+        return file_format
+
+    def updates(self, f, file_format, path="<stdin>"):
+        """Generates (line number, Update message) tuples for all the rows read from f."""
+        for line_num, cells in self._readers[file_format](f, path):
+            try:
+                update = self.make_update(cells)
+            except UserError as e:
+                raise UserError("{}, line {}: {}".format(path, line_num, e)) from None
+            yield line_num, update
+
+
 class _CounterEntryBase(_P4EntityBase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -2621,70 +3910,101 @@ You may also use <self>.set(<md_name>='<value>')
         return self._md.values()
 
 
-class PacketIn():
-    def __init__(self):
-        ctrl_pkt_md = P4Objects(P4Type.controller_packet_metadata)
-        self.md_info_list = {}
-        if "packet_in" in ctrl_pkt_md:
-            self.p4_info = ctrl_pkt_md["packet_in"]
-            for md_info in self.p4_info.metadata:
-                self.md_info_list[md_info.name] = md_info
-        self.packet_in_queue = queue.Queue()
+class _StreamSniffer:
+    """
+    Base class for the objects which receive a type of stream messages (packet-in, idle timeout
+    notification, digest list). Messages are buffered by a client subscription (see
+    P4RuntimeClient.subscribe) from the moment the object is created: at most maxsize messages
+    are kept, extra messages are dropped.
+    """
+    _stream_type = None
 
-        def _packet_in_recv_func(packet_in_queue):
-            while True:
-                msg = client.get_stream_packet("packet", timeout=None)
-                if not msg:
-                    break
-                packet_in_queue.put(msg)
+    def __init__(self, maxsize=65536, on_receive=None):
+        self._sub = client.subscribe(self._stream_type, maxsize=maxsize, on_receive=on_receive)
+
+    @property
+    def dropped(self):
+        return self._sub.dropped
+
+    def close(self):
+        """Stop receiving messages."""
+        self._sub.close()
 
-        self.recv_t = Thread(target=_packet_in_recv_func, args=(self.packet_in_queue, ))
-        self.recv_t.start()
+    def _sniff(self, timeout, max_count, batch_size):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        count = 0
+        try:
+            while max_count is None or count < max_count:
+                n = batch_size or 1
+                if max_count is not None:
+                    n = min(n, max_count - count)
+                wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+                msgs = self._sub.drain(n, timeout=wait)
+                if not msgs:
+                    # timeout expired or stream closed
+                    break
+                count += len(msgs)
+                if batch_size is None:
+                    yield from msgs
+                else:
+                    yield msgs
+        except KeyboardInterrupt:
+            # User sends an interrupt (e.g., Ctrl+C).
+            return
 
-    def sniff(self, function=None, timeout=None):
+    def sniff(self, function=None, timeout=None, max_count=None, batch_size=None):
         """
-        Return an iterator of packet-in messages.
+        Return an iterator which yields messages as they arrive, until the timeout (in seconds)
+        expires, max_count messages have been received, a keyboard interrupt occurs (Ctrl+C) or
+        the stream is closed. The timeout is None by default (no timeout).
+        If batch_size is provided, the iterator yields lists of messages instead: each list
+        contains the messages available at that time, at most batch_size of them.
         If the function is provided, we do not return an iterator and instead we apply
-        the function to every packet-in message.
+        the function to every message (or list of messages) as it arrives.
         """
-        msgs = []
-
         if timeout is not None and timeout < 0:
             raise ValueError("Timeout can't be a negative number.")
+        if batch_size is not None and batch_size <= 0:
+            raise ValueError("batch_size must be a positive integer.")
+        it = self._sniff(timeout, max_count, batch_size)
+        if function is None:
+            return it
+        for item in it:
+            function(item)
 
-        if timeout is None:
-            while True:
-                try:
-                    msgs.append(self.packet_in_queue.get(block=True))
-                except KeyboardInterrupt:
-                    # User sends a Ctrl+C -> breaking
-                    break
 
-        else:  # timeout parameter is provided
-            deadline = time.time() + timeout
-            remaining_time = timeout
-            while remaining_time > 0:
-                try:
-                    msgs.append(self.packet_in_queue.get(block=True, timeout=remaining_time))
-                    remaining_time = deadline - time.time()
-                except KeyboardInterrupt:
-                    # User sends an interrupt(e.g., Ctrl+C).
-                    break
-                except queue.Empty:
-                    # No item available on timeout. Exiting
-                    break
+class PacketIn(_StreamSniffer):
+    _stream_type = "packet"
 
-        if function is None:
-            return iter(msgs)
-        else:
-            for msg in msgs:
-                function(msg)
+    def __init__(self, maxsize=65536):
+        ctrl_pkt_md = P4Objects(P4Type.controller_packet_metadata)
+        self.md_info_list = {}
+        if "packet_in" in ctrl_pkt_md:
+            self.p4_info = ctrl_pkt_md["packet_in"]
+            for md_info in self.p4_info.metadata:
+                self.md_info_list[md_info.name] = md_info
+        super().__init__(maxsize)
+
+    @staticmethod
+    def subscribe(function=None, maxsize=1024, batch_size=1, batch_timeout=None):
+        """
+        Subscribe to packet-in messages, which are delivered directly by the thread receiving from
+        the stream. If the function is provided and batch_size is 1, it is called for each
+        packet-in message by that thread. Otherwise, up to maxsize messages are buffered (extra
+        messages are dropped and counted in the subscription's dropped attribute) and can be
+        consumed by iterating over the returned subscription; if the function is provided, it is
+        called with lists of messages by a dedicated thread. A batch is delivered after batch_size
+        messages, or batch_timeout seconds
+        after its first message. Call close() on the subscription to stop the delivery.
+        """
+        return client.subscribe("packet", callback=function, maxsize=maxsize,
+                                batch_size=batch_size, batch_timeout=batch_timeout)
 
 
 class PacketOut:
     def __init__(self, payload=b'', **kwargs):
 
-        self.p4_info = P4Objects(P4Type.controller_packet_metadata)["packet_out"]
+        self.p4_info = _get_p4object(P4Type.controller_packet_metadata, "packet_out")
         self.payload = payload
         self.metadata = PacketMetadata(self.p4_info.metadata)
         if kwargs:
@@ -2721,117 +4041,768 @@ class PacketOut:
         client.stream_out_q.put(msg)
 
 
-class IdleTimeoutNotification():
-    def __init__(self):
-        self.notification_queue = queue.Queue()
+def _encode_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
 
-        def _notification_recv_func(notification_queue):
-            while True:
-                msg = client.get_stream_packet("idle_timeout_notification", timeout=None)
-                if not msg:
-                    break
-                notification_queue.put(msg)
 
-        self.recv_t = Thread(target=_notification_recv_func, args=(self.notification_queue, ))
-        self.recv_t.start()
+class PacketOutTemplate:
+    """
+    A packet-out template, for sending many packets which share the same
+    metadata values. The metadata is validated and encoded once, when the
+    template is created; each packet is then sent as a pre-serialized
+    StreamMessageRequest, which only requires the payload to be copied.
+
+    packet_out_template = PacketOutTemplate(egress_port="1")
+    packet_out_template.send(b'AAAA')
+    packet_out_template.send_many(payloads)
+
+    Payloads can be bytes, bytearray or memoryview objects.
+    """
+
+    # StreamMessageRequest.packet and PacketOut.payload field tags
+    _PACKET_TAG = b'\x12'
+    _PAYLOAD_TAG = b'\x0a'
+
+    def __init__(self, **kwargs):
+        self.p4_info = _get_p4object(P4Type.controller_packet_metadata, "packet_out")
+        self.metadata = PacketMetadata(self.p4_info.metadata)
+        for key, value in kwargs.items():
+            self.metadata[key] = value
+        packet_out = p4runtime_pb2.PacketOut()
+        packet_out.metadata.extend(self.metadata.values())
+        self._md_bytes = packet_out.SerializeToString()
 
-    def sniff(self, function=None, timeout=None):
+    def __dir__(self):
+        return ["encode", "metadata", "send", "send_many"]
+
+    def encode(self, payload):
+        """Returns the serialized StreamMessageRequest for the given payload."""
+        if type(payload) is memoryview:
+            if payload.format != 'B' or payload.ndim != 1:
+                payload = payload.cast('B')
+        elif type(payload) is not bytes and type(payload) is not bytearray:
+            raise UserError("payload must be a bytes, bytearray or memoryview type")
+        payload_len = _encode_varint(len(payload))
+        packet_len = _encode_varint(
+            1 + len(payload_len) + len(payload) + len(self._md_bytes))
+        return b''.join((self._PACKET_TAG, packet_len, self._PAYLOAD_TAG, payload_len,
+                         payload, self._md_bytes))
+
+    def send(self, payload):
+        client.stream_out_q.put(self.encode(payload))
+
+    def send_many(self, payloads, batch_size=256):
         """
-        Return an iterator of notification messages.
-        If the function is provided, we do not return an iterator and instead we apply
-        the function to every notification message.
+        Sends a packet for each payload in the iterable. Packets are queued for
+        the stream in batches of batch_size, to reduce the number of queue
+        operations. Returns the number of packets sent.
         """
-        msgs = []
+        if batch_size < 1:
+            raise UserError("batch_size must be a positive integer")
+        encode = self.encode
+        count = 0
+        batch = []
+        for payload in payloads:
+            batch.append(encode(payload))
+            if len(batch) == batch_size:
+                client.stream_out_q.put(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            client.stream_out_q.put(batch)
+            count += len(batch)
+        return count
+
+
+class IdleTimeoutNotification(_StreamSniffer):
+    _stream_type = "idle_timeout_notification"
+
+
+class DigestList(_StreamSniffer):
+    _stream_type = "digest"
+
+    def __init__(self, maxsize=65536):
+        self._client = client
+        super().__init__(maxsize, on_receive=self._ack)
+
+    def _ack(self, msg):
+        if DigestPipeline._is_open(self._client):
+            # digest lists are acknowledged by the pipeline, once processed
+            return
+        # Acknowledge the digest
+        ack = p4runtime_pb2.StreamMessageRequest()
+        ack.digest_ack.digest_id = msg.digest.digest_id
+        ack.digest_ack.list_id = msg.digest.list_id
+        self._client.stream_out_q.put(ack)
+
+
+DecodedDigestList = namedtuple(
+    'DecodedDigestList', ['name', 'digest_id', 'list_id', 'timestamp', 'data'])
+
+
+def _make_p4data_decoder(type_spec, type_info):
+    # Returns a function converting a P4Data message with the given P4DataTypeSpec to a Python
+    # value, and the array typecode to use for the value in columnar form (None for a list).
+    kind = type_spec.WhichOneof("type_spec")
+    if kind == "bitstring":
+        bitstring = type_spec.bitstring
+        if bitstring.HasField("int"):
+            bitwidth = bitstring.int.bitwidth
+
+            def decode_int(d):
+                v = int.from_bytes(d.bitstring, 'big')
+                return v - (1 << bitwidth) if v >> (bitwidth - 1) else v
+            return decode_int, 'q' if bitwidth <= 64 else None
+        if bitstring.HasField("varbit"):
+            return (lambda d: int.from_bytes(d.varbit.bitstring, 'big')), None
+        typecode = 'Q' if bitstring.bit.bitwidth <= 64 else None
+        return (lambda d: int.from_bytes(d.bitstring, 'big')), typecode
+    if kind == "bool":
+        return (lambda d: d.bool), 'B'
+    if kind == "new_type":
+        new_type = type_info.new_types.get(type_spec.new_type.name)
+        if new_type is not None:
+            if new_type.HasField("original_type"):
+                return _make_p4data_decoder(new_type.original_type, type_info)
+            translated = new_type.translated_type
+            if translated.HasField("sdn_string"):
+                return (lambda d: d.bitstring.decode()), None
+            return (lambda d: int.from_bytes(d.bitstring, 'big')), 'Q'
+    # other types (headers, nested structs, ...) are not decoded
+    return (lambda d: d), None
+
+
+def _make_digest_decoder(digest_id):
+    # Returns (digest name, namedtuple type or None, member names, member decoders, typecodes).
+    digest = context.get_obj_by_id(digest_id)
+    type_info = context.p4info.type_info
+    type_spec = digest.type_spec
+    if type_spec.HasField("struct"):
+        members = type_info.structs[type_spec.struct.name].members
+        names = [m.name for m in members]
+        decoders = [_make_p4data_decoder(m.type_spec, type_info) for m in members]
+        tuple_type = namedtuple(type_spec.struct.name, names, rename=True)
+    else:
+        names = ["value"]
+        decoders = [_make_p4data_decoder(type_spec, type_info)]
+        tuple_type = None
+    return (digest.preamble.name, tuple_type, names,
+            [d[0] for d in decoders], [d[1] for d in decoders])
 
-        if timeout is not None and timeout < 0:
-            raise ValueError("Timeout can't be a negative number.")
 
-        if timeout is None:
-            while True:
-                try:
-                    msgs.append(self.notification_queue.get(block=True))
-                except KeyboardInterrupt:
-                    # User sends a Ctrl+C -> breaking
-                    break
+class DigestPipeline:
+    """
+    Receives digest lists and decodes their data according to the P4Info type of the digest.
+    Each digest list is returned as a DecodedDigestList (name, digest_id, list_id, timestamp,
+    data). With format "tuples", data is a list with a named tuple for each digest (or a plain
+    value if the digest type is not a struct); with format "columns", data is a dictionary
+    mapping each struct member to an array (or a list, for values which do not fit in 64 bits).
+
+    Digest lists are acknowledged once processed: when iterating with lists(), a digest list is
+    acknowledged when the next one is requested; process() acknowledges each digest list after
+    the function returns. With auto_ack=False, call ack() instead. Acknowledgements are queued for
+    the stream in batches of ack_batch_size, and pending acknowledgements are always sent before
+    waiting for more digest lists. While a pipeline is open for a client, digest_list does not
+    acknowledge the digest lists received by that client itself.
+
+    Digest lists which are not acknowledged are sent again by the server once its ack timeout
+    expires (ack_timeout_ns in the digest configuration): this is how the digest lists dropped
+    because the queue is full (maxsize) are recovered, and how the ones received but not
+    processed yet when the pipeline is closed are, since they are discarded without being
+    acknowledged. stats() reports them as "dropped" and "discarded" respectively.
+
+    with DigestPipeline() as pipeline:
+        pipeline.process(lambda dl: learn(dl.data), timeout=10)
+        print(pipeline.stats())
+    """
+    # P4RuntimeClient -> number of open pipelines, pipelines can be opened from different threads
+    # and for different clients (see p4runtime_sh.session)
+    _num_open = Counter()
+    _num_open_lock = Lock()
+
+    def __init__(self, format="tuples", maxsize=65536, ack_batch_size=64, auto_ack=True):
+        if format not in ("tuples", "columns"):
+            raise UserError("format must be 'tuples' or 'columns'")
+        if ack_batch_size <= 0:
+            raise UserError("ack_batch_size must be a positive integer")
+        self.format = format
+        self.ack_batch_size = ack_batch_size
+        self.auto_ack = auto_ack
+        self.lists_processed = 0
+        self.digests_processed = 0
+        self.acks_sent = 0
+        self.ack_batches = 0
+        self.discarded = 0
+        self.last_lag_ns = 0
+        self.max_lag_ns = 0
+        self._pending_acks = []
+        # digest lists received from the subscription but not returned yet
+        self._backlog = deque()
+        self._start = time.monotonic()
+        self._closed = False
+        self._client = client
+        self._update_num_open(1)
+        try:
+            self._sub = client.subscribe("digest", maxsize=maxsize)
+        except Exception:
+            self._update_num_open(-1)
+            raise
 
-        else:  # timeout parameter is provided
-            deadline = time.time() + timeout
-            remaining_time = timeout
-            while remaining_time > 0:
-                try:
-                    msgs.append(self.notification_queue.get(block=True, timeout=remaining_time))
-                    remaining_time = deadline - time.time()
-                except KeyboardInterrupt:
-                    # User sends an interrupt(e.g., Ctrl+C).
-                    break
-                except queue.Empty:
-                    # No item available on timeout. Exiting
-                    break
+    def _update_num_open(self, delta):
+        with DigestPipeline._num_open_lock:
+            num_open = DigestPipeline._num_open
+            num_open[self._client] += delta
+            if num_open[self._client] <= 0:
+                del num_open[self._client]
 
-        if function is None:
-            return iter(msgs)
-        else:
-            for msg in msgs:
-                function(msg)
+    @staticmethod
+    def _is_open(client_):
+        with DigestPipeline._num_open_lock:
+            return client_ in DigestPipeline._num_open
 
+    def __enter__(self):
+        return self
 
-class DigestList():
-    def __init__(self):
-        self.digest_list_queue = queue.Queue()
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-        def _notification_recv_func(digest_list_queue):
-            while True:
-                msg = client.get_stream_packet("digest", timeout=None)
-                if not msg:
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.flush_acks()
+        self._sub.close()
+        # digest lists received but not processed are not acknowledged (see above)
+        self.discarded = len(self._backlog) + len(self._sub.drain(timeout=0))
+        self._backlog.clear()
+        self._update_num_open(-1)
+
+    def decode(self, msg):
+        """Decodes a StreamMessageResponse (or DigestList) message."""
+        digest_list = msg.digest if isinstance(msg, p4runtime_pb2.StreamMessageResponse) else msg
+        name, tuple_type, names, decoders, typecodes = context.get_cached(
+            ("digest_decoder", digest_list.digest_id),
+            lambda: _make_digest_decoder(digest_list.digest_id))
+        if tuple_type is not None:
+            rows = [[decode(d) for decode, d in zip(decoders, data.struct.members)]
+                    for data in digest_list.data]
+            if self.format == "tuples":
+                data = [tuple_type._make(row) for row in rows]
+            else:
+                data = {}
+                for i, (member, typecode) in enumerate(zip(names, typecodes)):
+                    column = [row[i] for row in rows]
+                    data[member] = array(typecode, column) if typecode else column
+        else:
+            decode = decoders[0]
+            values = [decode(d) for d in digest_list.data]
+            if self.format == "tuples":
+                data = values
+            else:
+                data = {"value": array(typecodes[0], values) if typecodes[0] else values}
+        return DecodedDigestList(name, digest_list.digest_id, digest_list.list_id,
+                                 digest_list.timestamp, data)
+
+    def ack(self, digest_list):
+        ack = p4runtime_pb2.StreamMessageRequest()
+        ack.digest_ack.digest_id = digest_list.digest_id
+        ack.digest_ack.list_id = digest_list.list_id
+        self._pending_acks.append(ack)
+        if len(self._pending_acks) >= self.ack_batch_size:
+            self.flush_acks()
+
+    def flush_acks(self):
+        if self._pending_acks:
+            # a list of requests is sent on the stream with a single queue operation
+            self._client.stream_out_q.put(self._pending_acks)
+            self.acks_sent += len(self._pending_acks)
+            self.ack_batches += 1
+            self._pending_acks = []
+
+    def _next_msg(self, timeout):
+        if not self._backlog:
+            self._backlog.extend(self._sub.drain(timeout=0))
+        if not self._backlog:
+            self.flush_acks()
+            self._backlog.extend(self._sub.drain(timeout=timeout))
+        return self._backlog.popleft() if self._backlog else None
+
+    def lists(self, timeout=None, max_count=None):
+        """
+        Return an iterator which yields decoded digest lists as they arrive, until the timeout
+        (in seconds) expires, max_count digest lists have been returned, or the stream is closed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        count = 0
+        try:
+            while max_count is None or count < max_count:
+                wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+                msg = self._next_msg(wait)
+                if msg is None:
                     break
-                digest_list_queue.put(msg)
-                # Acknowledge the digest
-                ack = p4runtime_pb2.StreamMessageRequest()
-                ack.digest_ack.digest_id = msg.digest.digest_id
-                ack.digest_ack.list_id = msg.digest.list_id
-                client.stream_out_q.put(ack)
+                decoded = self.decode(msg)
+                if decoded.timestamp:
+                    self.last_lag_ns = time.time_ns() - decoded.timestamp
+                    self.max_lag_ns = max(self.max_lag_ns, self.last_lag_ns)
+                yield decoded
+                count += 1
+                self.lists_processed += 1
+                self.digests_processed += len(msg.digest.data)
+                if self.auto_ack:
+                    self.ack(decoded)
+        finally:
+            self.flush_acks()
 
-        self.recv_t = Thread(target=_notification_recv_func, args=(self.digest_list_queue, ))
-        self.recv_t.start()
+    def __iter__(self):
+        return self.lists()
 
-    def sniff(self, function=None, timeout=None):
+    def process(self, function, timeout=None, max_count=None):
         """
-        Return an iterator of DigestList messages.
-        If the function is provided, we do not return an iterator and instead we apply
-        the function to every notification message.
+        Apply the function to each decoded digest list as it arrives (see lists()). Returns the
+        number of digest lists processed.
         """
-        msgs = []
-
-        if timeout is not None and timeout < 0:
-            raise ValueError("Timeout can't be a negative number.")
+        count = 0
+        for digest_list in self.lists(timeout=timeout, max_count=max_count):
+            function(digest_list)
+            count += 1
+        return count
+
+    def stats(self):
+        """Returns a dictionary with the pipeline counters and throughput."""
+        elapsed = time.monotonic() - self._start
+        return {
+            "received": self._sub.received,
+            "dropped": self._sub.dropped,
+            "pending": self._sub.pending + len(self._backlog),
+            "lists_processed": self.lists_processed,
+            "digests_processed": self.digests_processed,
+            "acks_sent": self.acks_sent,
+            "ack_batches": self.ack_batches,
+            "discarded": self.discarded,
+            "lists_per_sec": self.lists_processed / elapsed if elapsed > 0 else 0.0,
+            "digests_per_sec": self.digests_processed / elapsed if elapsed > 0 else 0.0,
+            "last_lag_ms": self.last_lag_ns / 1e6,
+            "max_lag_ms": self.max_lag_ns / 1e6,
+        }
+
+
+def _table_entry_key_msg(table_entry):
+    # The fields of a TableEntry which identify the entry (what is needed to delete it).
+    key = p4runtime_pb2.TableEntry()
+    key.table_id = table_entry.table_id
+    key.match.extend(table_entry.match)
+    key.priority = table_entry.priority
+    return key
+
+
+class AgingService:
+    """
+    Deletes the table entries reported as idle by the server in idle timeout notifications, with
+    batched WriteRequests (at most max_updates updates each, sent concurrently). Notifications are
+    collected for up to batch_timeout seconds, or until max_updates notifications have been
+    received, and the entries they report are deduplicated.
+
+    If confirm is True, the entries are first read from the server (with batched ReadRequests),
+    requesting time_since_last_hit, and only the entries which have not been hit since their
+    idle_timeout_ns are deleted. Since a ReadRequest fails as a whole if one of its entries no
+    longer exists, a request which fails with NOT_FOUND is split until the missing entries are
+    isolated; they are counted in entries_not_found. If tables is provided (a list of table
+    names), notifications for entries of other tables are ignored.
+
+    aging = AgingService(confirm=True)
+    aging.start()  # process notifications in a background thread
+    ...
+    aging.stop()
+    print(aging.stats())
+
+    Alternatively, call run() to process notifications in the current thread.
+    """
 
-        if timeout is None:
+    def __init__(self, confirm=False, max_updates=1000, batch_timeout=0.05, tables=None,
+                 maxsize=65536):
+        if type(max_updates) is not int or max_updates <= 0:
+            raise UserError("max_updates must be a positive integer")
+        self.confirm = confirm
+        self.max_updates = max_updates
+        self._table_ids = None
+        if tables is not None:
+            self._table_ids = {context.get_obj_id(P4Type.table, t) for t in tables}
+            if None in self._table_ids:
+                raise UserError("Unknown table in {}".format(tables))
+        self.notifications = 0
+        self.entries_notified = 0
+        self.entries_active = 0
+        self.entries_not_found = 0
+        self.entries_deleted = 0
+        self.delete_errors = 0
+        self.read_errors = 0
+        self.read_requests = 0
+        self.write_requests = 0
+        self.last_latency_ns = 0
+        self.max_latency_ns = 0
+        self._thread = None
+        self._sub = client.subscribe("idle_timeout_notification", maxsize=maxsize,
+                                     batch_size=max_updates, batch_timeout=batch_timeout)
+
+    def _chunks(self, items):
+        for i in range(0, len(items), self.max_updates):
+            yield items[i:i + self.max_updates]
+
+    @parse_p4runtime_error
+    def _read(self, keys):
+        entities = []
+        for key in keys:
+            entity = p4runtime_pb2.Entity()
+            entity.table_entry.CopyFrom(key)
+            entity.table_entry.time_since_last_hit.SetInParent()
+            entities.append(entity)
+        self.read_requests += 1
+        return [entity.table_entry
+                for rep in client.read(entities) for entity in rep.entities]
+
+    def _read_existing(self, keys):
+        # Reads the entries which still exist: entries deleted since the notification (e.g. by
+        # the controller, or by a previous batch) make the whole ReadRequest fail with NOT_FOUND,
+        # so the keys are split in halves until the missing entries are isolated.
+        try:
+            return self._read(keys)
+        except P4RuntimeException as e:
+            if e.grpc_error.code() != grpc.StatusCode.NOT_FOUND:
+                logging.error("Error when reading idle entries: {}".format(e))
+                self.read_errors += 1
+                return []
+            if len(keys) == 1:
+                self.entries_not_found += 1
+                return []
+        mid = len(keys) // 2
+        return self._read_existing(keys[:mid]) + self._read_existing(keys[mid:])
+
+    def _read_idle(self, keys):
+        idle = []
+        for chunk in self._chunks(keys):
+            for te in self._read_existing(chunk):
+                # if the server does not report time_since_last_hit, rely on the notification
+                if te.HasField("time_since_last_hit") and \
+                        te.time_since_last_hit.elapsed_ns < te.idle_timeout_ns:
+                    self.entries_active += 1
+                    continue
+                idle.append(_table_entry_key_msg(te))
+        return idle
+
+    def _delete(self, keys):
+        futures = []
+        for chunk in self._chunks(keys):
+            req = p4runtime_pb2.WriteRequest()
+            for key in chunk:
+                update = req.updates.add()
+                update.type = p4runtime_pb2.Update.DELETE
+                update.entity.table_entry.CopyFrom(key)
+            futures.append((client.write_async(req), req, len(chunk)))
+            self.write_requests += 1
+        shadow = _shadows.get(client)
+        for f, req, num_updates in futures:
+            e = f.exception()
+            if shadow is not None:
+                shadow._record(req.updates, e)
+            if e is None:
+                self.entries_deleted += num_updates
+            elif isinstance(e, P4RuntimeWriteException):
+                # typically NOT_FOUND, for entries which have already been deleted
+                self.delete_errors += len(e.errors)
+                self.entries_deleted += num_updates - len(e.errors)
+            else:
+                logging.error("Error when deleting idle entries: {}".format(e))
+                self.delete_errors += num_updates
+
+    def process(self, notifications):
+        """Deletes the idle entries reported by a list of StreamMessageResponse (or
+        IdleTimeoutNotification) messages. Returns the number of entries deleted."""
+        keys = {}
+        timestamp = 0
+        for msg in notifications:
+            if isinstance(msg, p4runtime_pb2.StreamMessageResponse):
+                msg = msg.idle_timeout_notification
+            self.notifications += 1
+            timestamp = max(timestamp, msg.timestamp)
+            for te in msg.table_entry:
+                if self._table_ids is not None and te.table_id not in self._table_ids:
+                    continue
+                self.entries_notified += 1
+                key = table_entry_key(te)
+                if key not in keys:
+                    keys[key] = _table_entry_key_msg(te)
+        keys = list(keys.values())
+        if self.confirm and keys:
+            keys = self._read_idle(keys)
+        deleted = self.entries_deleted
+        if keys:
+            self._delete(keys)
+        if timestamp:
+            self.last_latency_ns = time.time_ns() - timestamp
+            self.max_latency_ns = max(self.max_latency_ns, self.last_latency_ns)
+        return self.entries_deleted - deleted
+
+    def run(self, timeout=None):
+        """
+        Process notifications in the current thread until the timeout (in seconds) expires, stop()
+        is called, the stream is closed, or a keyboard interrupt occurs (Ctrl+C). Returns the
+        number of entries deleted.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        deleted = 0
+        try:
             while True:
-                try:
-                    msgs.append(self.digest_list_queue.get(block=True))
-                except KeyboardInterrupt:
-                    # User sends a Ctrl+C -> breaking
+                wait = None if deadline is None else deadline - time.monotonic()
+                if wait is not None and wait <= 0:
                     break
-
-        else:  # timeout parameter is provided
-            deadline = time.time() + timeout
-            remaining_time = timeout
-            while remaining_time > 0:
-                try:
-                    msgs.append(self.digest_list_queue.get(block=True, timeout=remaining_time))
-                    remaining_time = deadline - time.time()
-                except KeyboardInterrupt:
-                    # User sends an interrupt(e.g., Ctrl+C).
-                    break
-                except queue.Empty:
-                    # No item available on timeout. Exiting
+                notifications = self._sub.get_batch(timeout=wait)
+                if notifications:
+                    deleted += self.process(notifications)
+                elif self._sub.closed:
                     break
+        except KeyboardInterrupt:
+            pass
+        return deleted
+
+    def start(self):
+        """Process notifications in a background thread, until stop() is called."""
+        if self._thread is not None:
+            raise UserError("Aging service already started")
+        self._thread = Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop receiving notifications. Notifications already received are still processed."""
+        self._sub.close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """Returns a dictionary with the aging counters."""
+        return {
+            "notifications": self.notifications,
+            "dropped": self._sub.dropped,
+            "entries_notified": self.entries_notified,
+            "entries_active": self.entries_active,
+            "entries_not_found": self.entries_not_found,
+            "entries_deleted": self.entries_deleted,
+            "delete_errors": self.delete_errors,
+            "read_errors": self.read_errors,
+            "read_requests": self.read_requests,
+            "write_requests": self.write_requests,
+            "last_latency_ms": self.last_latency_ns / 1e6,
+            "max_latency_ms": self.max_latency_ns / 1e6,
+        }
+
+
+CounterSample = namedtuple('CounterSample', ['timestamp', 'byte_count', 'packet_count'])
+
+
+def _counter_deltas(prev, cur):
+    # A value lower than in the previous sample means that the counter was reset (or the table
+    # entry re-created): the delta is the new value. Rows which are not in the previous sample
+    # (new table entries) are compared to 0.
+    deltas = array('Q', [c - p if c >= p else c for p, c in zip(prev, cur)])
+    deltas.extend(cur[len(prev):])
+    return deltas
+
+
+class CounterPoller:
+    """
+    Periodically reads all the values of an indirect or direct counter, with a single wildcard
+    read, and stores them as CounterSample(timestamp, byte_count, packet_count) tuples, where
+    byte_count and packet_count are arrays of unsigned 64-bit integers (array.array('Q')) and
+    timestamp is the time at which the read was issued (time.time()). No Python object is created
+    for the counter entries.
+
+    For an indirect counter, the arrays are indexed by counter index and have the size of the
+    counter. For a direct counter, each table entry is assigned a row the first time it is read,
+    and the key of the entry in each row (see table_entry_key) is given by <self>.keys. When table
+    entries are missing from a read (deleted), their rows are dropped: the following rows are
+    moved up, in <self>.keys and in all the samples of the ring buffer, so that the samples stay
+    aligned. <self>.keys is then replaced by a new list, and <self>.compactions is incremented.
+
+    The last history samples are kept in a ring buffer (see samples()), and deltas() / rates()
+    compare the last two samples.
+
+    poller = CounterPoller("MyIngress.port_counter", history=60)
+    poller.start(interval=1)  # poll in a background thread
+    ...
+    bytes_per_s, packets_per_s = poller.rates()
+    poller.stop()
+
+    Alternatively, call poll() to read the counter values in the current thread.
+    """
 
-        if function is None:
-            return iter(msgs)
+    def __init__(self, counter_name, history=60):
+        if type(history) is not int or history < 2:
+            raise UserError("history must be an integer >= 2")
+        counter = context.get_obj(P4Type.counter, counter_name)
+        self.direct = counter is None
+        if self.direct:
+            counter = context.get_obj(P4Type.direct_counter, counter_name)
+            if counter is None:
+                raise UserError("Counter '{}' does not exist".format(counter_name))
+        self.name = counter.preamble.name
+        self.id = counter.preamble.id
+        self.size = None if self.direct else counter.size
+        self._table_id = counter.direct_table_id if self.direct else None
+        # direct counters only: table entry key for each row, and row for each key
+        self.keys = []
+        self._rows = {}
+        self._samples = deque(maxlen=history)
+        self.polls = 0
+        self.compactions = 0
+        self.read_errors = 0
+        self.last_poll_duration = 0
+        self._thread = None
+        self._stop = Event()
+
+    def __len__(self):
+        return len(self._samples)
+
+    @parse_p4runtime_error
+    def _read(self):
+        entity = p4runtime_pb2.Entity()
+        values = []
+        if self.direct:
+            entity.direct_counter_entry.table_entry.table_id = self._table_id
+            rows = self._rows
+            for rep in client.read_one(entity):
+                for e in rep.entities:
+                    c = e.direct_counter_entry
+                    key = table_entry_key(c.table_entry)
+                    row = rows.get(key)
+                    if row is None:
+                        row = rows[key] = len(self.keys)
+                        self.keys.append(key)
+                    values.append((row, c.data))
+            if len(values) < len(self.keys):
+                new_rows = self._compact({row for row, _ in values})
+                values = [(new_rows[row], data) for row, data in values]
+            size = len(self.keys)
         else:
-            for msg in msgs:
-                function(msg)
+            entity.counter_entry.counter_id = self.id
+            for rep in client.read_one(entity):
+                for e in rep.entities:
+                    c = e.counter_entry
+                    values.append((c.index.index, c.data))
+            size = self.size
+        byte_count = array('Q', bytes(8 * size))
+        packet_count = array('Q', bytes(8 * size))
+        for row, data in values:
+            if row < size:
+                byte_count[row] = data.byte_count
+                packet_count[row] = data.packet_count
+        return byte_count, packet_count
+
+    def _compact(self, rows):
+        # Drops the rows of the table entries which are not in rows (the rows returned by the last
+        # read), in the keys and in the samples. Returns the new row of each row which is kept.
+        kept = sorted(rows)
+        self.keys = [self.keys[row] for row in kept]
+        self._rows = {key: row for row, key in enumerate(self.keys)}
+        for i, sample in enumerate(self._samples):
+            # rows added after the sample was taken are not in it, they are the last ones in kept
+            size = len(sample.packet_count)
+            self._samples[i] = CounterSample(
+                sample.timestamp,
+                array('Q', [sample.byte_count[row] for row in kept if row < size]),
+                array('Q', [sample.packet_count[row] for row in kept if row < size]))
+        self.compactions += 1
+        return {row: new_row for new_row, row in enumerate(kept)}
+
+    def poll(self):
+        """Reads all the counter values and returns the new sample, which is appended to the ring
+        buffer."""
+        timestamp = time.time()
+        start = time.monotonic()
+        sample = CounterSample(timestamp, *self._read())
+        self.last_poll_duration = time.monotonic() - start
+        self._samples.append(sample)
+        self.polls += 1
+        return sample
+
+    def samples(self):
+        """The samples in the ring buffer, oldest first."""
+        return list(self._samples)
+
+    def last(self):
+        """The last sample, or None if the counter has not been polled yet."""
+        return self._samples[-1] if self._samples else None
+
+    def deltas(self):
+        """Returns (elapsed time in seconds, byte count deltas, packet count deltas) between the
+        last two samples, with the deltas as arrays indexed like the samples."""
+        if len(self._samples) < 2:
+            raise UserError("At least 2 samples are needed")
+        prev, cur = self._samples[-2], self._samples[-1]
+        return (cur.timestamp - prev.timestamp,
+                _counter_deltas(prev.byte_count, cur.byte_count),
+                _counter_deltas(prev.packet_count, cur.packet_count))
+
+    def rates(self):
+        """Returns (bytes per second, packets per second) between the last two samples, as arrays
+        of floats (array.array('d')) indexed like the samples."""
+        elapsed, byte_deltas, packet_deltas = self.deltas()
+        if elapsed <= 0:
+            raise UserError("The last 2 samples have the same timestamp")
+        return (array('d', [d / elapsed for d in byte_deltas]),
+                array('d', [d / elapsed for d in packet_deltas]))
+
+    def run(self, interval=1.0, function=None):
+        """
+        Polls the counter every interval seconds in the current thread, until stop() is called or
+        a keyboard interrupt occurs (Ctrl+C). If function is provided, it is called with each new
+        sample. Read errors are logged and counted in <self>.read_errors.
+        """
+        try:
+            while True:
+                start = time.monotonic()
+                try:
+                    sample = self.poll()
+                except P4RuntimeException as e:
+                    logging.error("Error when polling counter '{}': {}".format(self.name, e))
+                    self.read_errors += 1
+                else:
+                    if function is not None:
+                        function(sample)
+                if self._stop.wait(max(0, interval - (time.monotonic() - start))):
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop.clear()
+
+    def start(self, interval=1.0, function=None):
+        """Polls the counter in a background thread (see run()), until stop() is called."""
+        if self._thread is not None:
+            raise UserError("Counter poller already started")
+        self._thread = Thread(target=self.run, args=(interval, function), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """Returns a dictionary with the poller counters."""
+        return {
+            "polls": self.polls,
+            "read_errors": self.read_errors,
+            "samples": len(self._samples),
+            "rows": self.size if not self.direct else len(self.keys),
+            "compactions": self.compactions,
+            "last_poll_duration_ms": self.last_poll_duration * 1e3,
+        }
 
 
 def Write(input_):
@@ -2839,15 +4810,30 @@ def Write(input_):
     Reads a WriteRequest from a file (text format) and sends it to the server.
     It rewrites the device id and election id appropriately.
     """
-    req = p4runtime_pb2.WriteRequest()
-    if os.path.isfile(input_):
-        with open(input_, 'r') as f:
-            google.protobuf.text_format.Merge(f.read(), req)
-        client.write(req)
-    else:
+    if not os.path.isfile(input_):
         raise UserError(
             "Write only works with files at the moment and '{}' is not a file".format(
                 input_))
+    req = _read_write_request(input_)
+    shadow = _shadows.get(client)
+    try:
+        client.write(req)
+    except Exception as e:
+        if shadow is not None:
+            shadow._record(req.updates, e)
+        raise
+    if shadow is not None:
+        shadow._record(req.updates)
+
+
+def _read_write_request(path):
+    req = p4runtime_pb2.WriteRequest()
+    if path == "-":
+        google.protobuf.text_format.Merge(sys.stdin.read(), req)
+        return req
+    with open(path, 'r') as f:
+        google.protobuf.text_format.Merge(f.read(), req)
+    return req
 
 
 def APIVersion():
@@ -2858,11 +4844,13 @@ def APIVersion():
     return client.api_version()
 
 
-# see https://ipython.readthedocs.io/en/stable/config/details.html
-class MyPrompt(Prompts):
-    def in_prompt_tokens(self, cli=None):
-        return [(Token.Prompt, 'P4Runtime sh'),
-                (Token.PrompSeparator, ' >>> ')]
+def __getattr__(name):
+    # MyPrompt used to be defined in this module, it now lives in p4runtime_sh.interactive so that
+    # IPython is only imported when starting the interactive shell.
+    if name == "MyPrompt":
+        from .interactive import MyPrompt
+        return MyPrompt
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 FwdPipeConfig = namedtuple('FwdPipeConfig', ['p4info', 'bin'])
@@ -2932,16 +4920,166 @@ def get_arg_parser():
                         metavar='<path to .pem>',
                         type=str, action='store', default=None)
 
+    subparsers = parser.add_subparsers(
+        dest='command', metavar='<command>',
+        help='Run a command and exit, instead of starting the interactive shell')
+    load_parser = subparsers.add_parser(
+        'load', help='Write table entries listed in a CSV or JSONL file, see TableEntry.load')
+    load_parser.add_argument('table', help='Table name', type=str)
+    load_parser.add_argument('path', help='Path to the CSV or JSONL file, - for stdin', type=str)
+    load_parser.add_argument('--format', dest='file_format',
+                             help='File format, by default it is inferred from the extension',
+                             choices=['csv', 'jsonl'], action='store', default=None)
+    load_parser.add_argument('--update-type',
+                             help='Type of the P4Runtime updates',
+                             choices=['insert', 'modify', 'delete'], action='store',
+                             default='insert')
+    load_parser.add_argument('--max-updates',
+                             help='Maximum number of updates per WriteRequest',
+                             type=int, action='store', default=1000)
+    load_parser.add_argument('--pipelined',
+                             help='Do not wait for a WriteRequest to complete before sending the '
+                             'next one',
+                             action='store_true')
+
+    run_parser = subparsers.add_parser(
+        'run', help='Run a Python script which uses the shell API')
+    run_parser.add_argument('script', help='Path to the script', type=str)
+    run_parser.add_argument('script_args', help='Arguments passed to the script (sys.argv)',
+                            nargs=argparse.REMAINDER)
+    run_parser.add_argument('--max-updates',
+                            help='Run the script in the scope of a write batch (see batch()) '
+                                 'and report the write throughput',
+                            type=int, action='store', default=None)
+    run_parser.add_argument('--pipelined',
+                            help='Use a pipelined write batch, requires --max-updates',
+                            action='store_true')
+
+    apply_parser = subparsers.add_parser(
+        'apply', help='Write the updates of WriteRequests stored in text format files')
+    apply_parser.add_argument('paths', help='Paths to the files (applied in order), - for stdin',
+                              metavar='path', type=str, nargs='+')
+    apply_parser.add_argument('--max-updates',
+                              help='Maximum number of updates per WriteRequest',
+                              type=int, action='store', default=1000)
+    apply_parser.add_argument('--pipelined',
+                              help='Do not wait for a WriteRequest to complete before sending '
+                              'the next one',
+                              action='store_true')
+
     return parser
 
 
+def _report_throughput(count, what, elapsed):
+    print("Wrote {} {} in {:.3f}s ({:.0f} {}/s)".format(
+        count, what, elapsed, count / elapsed if elapsed > 0 else 0, what))
+
+
+def _run_load(args):
+    start = time.time()
+    try:
+        count = TableEntry(args.table).load(
+            args.path, file_format=args.file_format, update_type=args.update_type,
+            max_updates=args.max_updates, pipelined=args.pipelined)
+    except (UserError, P4RuntimeException, P4RuntimeWriteException) as e:
+        logging.critical(e)
+        return 1
+    _report_throughput(count, "entries", time.time() - start)
+    return 0
+
+
+def _run_script(args):
+    if args.pipelined and args.max_updates is None:
+        logging.critical("--pipelined requires --max-updates")
+        return 1
+    try:
+        with open(args.script, 'r') as f:
+            code = compile(f.read(), args.script, 'exec')
+    except (OSError, SyntaxError) as e:
+        logging.critical(e)
+        return 1
+    ns = _make_user_ns(interactive=False)
+    ns["__name__"] = "__main__"
+    ns["__file__"] = args.script
+    argv = sys.argv
+    sys.argv = [args.script] + args.script_args
+
+    def run():
+        # sys.exit() ends the script normally: the updates of the batch are still written
+        try:
+            exec(code, ns)
+        except SystemExit as e:
+            return e.code
+        return 0
+
+    start = time.time()
+    try:
+        if args.max_updates is None:
+            return run()
+        with batch(args.max_updates, args.pipelined) as b:
+            ret = run()
+        _report_throughput(b.num_updates, "updates", time.time() - start)
+        return ret
+    except Exception:
+        logging.exception("Error when running '{}'".format(args.script))
+        return 1
+    finally:
+        sys.argv = argv
+
+
+def _run_apply(args):
+    start = time.time()
+    b = WriteBatch(args.max_updates, args.pipelined)
+    count = 0
+    try:
+        # Files are applied in order: all the updates from a file are completed before moving to
+        # the next one, so that updates which depend on each other can be put in separate files.
+        for path in args.paths:
+            req = _read_write_request(path)
+            if req.atomicity != p4runtime_pb2.WriteRequest.CONTINUE_ON_ERROR:
+                # the request cannot be split
+                client.write(req)
+                count += len(req.updates)
+                continue
+            for idx, update in enumerate(req.updates):
+                b.add(update, (path, idx))
+            b.flush()
+            b.wait()
+        count += b.num_updates
+    except (OSError, google.protobuf.text_format.ParseError,
+            UserError, P4RuntimeException, P4RuntimeWriteException) as e:
+        logging.critical(e)
+        return 1
+    _report_throughput(count, "updates", time.time() - start)
+    return 0
+
+
+def client_stats(enable=None):
+    """
+    Returns a dictionary with the state of the P4Runtime client (primary or backup, WriteRequests
+    in flight, number of messages waiting in the stream queues) and, once metrics are enabled, the
+    client metrics: for each RPC, the number of calls, errors by gRPC status code (and by
+    P4Runtime error code for failed updates), a latency histogram and the bytes sent and
+    received; and the number of StreamChannel messages received by type.
+
+    Metrics are disabled by default, as they add some overhead to each RPC. Use
+    client_stats(enable=True) to start collecting them and client_stats(enable=False) to stop.
+    """
+    if enable is not None:
+        if enable:
+            client.enable_metrics()
+        else:
+            client.disable_metrics()
+    return client.stats()
+
+
 def setup(device_id=1,
           grpc_addr='localhost:9559',
           election_id=(1, 0),
           role_name=None,
           config=None,
           ssl_options=None,
-          verbose=True):
+          verbose=False):
     global client
     logging.debug("Creating P4Runtime client")
     client = P4RuntimeClient(device_id, grpc_addr, election_id, role_name, ssl_options)
@@ -2985,34 +5123,18 @@ def setup(device_id=1,
 def teardown():
     global client
     logging.debug("Tearing down P4Runtime client")
+    shadow = _shadows.get(client)
+    if shadow is not None:
+        shadow.disable()
     client.tear_down()
     client = None
 
 
-def main():
-    parser = get_arg_parser()
-    args = parser.parse_args()
-    if args.verbose:
-        logging.basicConfig(level=logging.DEBUG)
-    if args.cacert and not args.ssl:
-        logging.error(
-            "--cacert makes no sense if SSL/TLS is disabled, did you mean to use --ssl?")
-    if args.cert and not args.ssl:
-        logging.error(
-            "--cert makes no sense if SSL/TLS is disabled, did you mean to use --ssl?")
-    if args.private_key and not args.ssl:
-        logging.error(
-            "--private-key makes no sense if SSL/TLS is disabled, did you mean to use --ssl?")
-    ssl_options = SSLOptions(not args.ssl, args.cacert, args.cert, args.private_key)
-    setup(args.device_id, args.grpc_addr, args.election_id, args.role_name, args.config,
-          ssl_options)
-
-    c = Config()
-    c.TerminalInteractiveShell.banner1 = '*** Welcome to the IPython shell for P4Runtime ***'
-    c.TerminalInteractiveShell.prompts_class = MyPrompt
-    c.TerminalInteractiveShell.autocall = 2
-    c.TerminalInteractiveShell.show_rewritten_input = False
-
+def _make_user_ns(interactive=True):
+    """Returns the namespace in which the shell commands (or a script) are run. When interactive is
+    False, the packet_in, idle_timeout_notification and digest_list singletons (which each start a
+    thread listening on the stream) are not created, but the PacketIn, IdleTimeoutNotification and
+    DigestList classes are available instead."""
     user_ns = {
         "TableEntry": TableEntry,
         "MatchKey": MatchKey,
@@ -3033,7 +5155,12 @@ def main():
         "CloneSessionEntry": CloneSessionEntry,
         "DigestEntry": DigestEntry,
         "APIVersion": APIVersion,
+        "read_many": read_many,
+        "client_stats": client_stats,
+        "table_entry_key": table_entry_key,
+        "shadow_cache": shadow_cache,
         "global_options": global_options,
+        "batch": batch,
     }
 
     for obj_type in P4Type:
@@ -3054,12 +5181,59 @@ def main():
 
     user_ns["multicast_group_entry"] = MulticastGroupEntry
     user_ns["clone_session_entry"] = CloneSessionEntry
-    user_ns["packet_in"] = PacketIn()  # Singleton packet_in object to handle all packet-in cases
     user_ns["packet_out"] = PacketOut
-    user_ns["idle_timeout_notification"] = IdleTimeoutNotification()  # Singleton
-    user_ns["digest_list"] = DigestList()  # Singleton
+    user_ns["packet_out_template"] = PacketOutTemplate
+    user_ns["digest_pipeline"] = DigestPipeline
+    user_ns["aging_service"] = AgingService
+    user_ns["counter_poller"] = CounterPoller
+    if interactive:
+        # Singleton packet_in object to handle all packet-in cases
+        user_ns["packet_in"] = PacketIn()
+        user_ns["idle_timeout_notification"] = IdleTimeoutNotification()  # Singleton
+        user_ns["digest_list"] = DigestList()  # Singleton
+    else:
+        user_ns["PacketIn"] = PacketIn
+        user_ns["IdleTimeoutNotification"] = IdleTimeoutNotification
+        user_ns["DigestList"] = DigestList
+
+    return user_ns
+
+
+def main():
+    parser = get_arg_parser()
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    if args.cacert and not args.ssl:
+        logging.error(
+            "--cacert makes no sense if SSL/TLS is disabled, did you mean to use --ssl?")
+    if args.cert and not args.ssl:
+        logging.error(
+            "--cert makes no sense if SSL/TLS is disabled, did you mean to use --ssl?")
+    if args.private_key and not args.ssl:
+        logging.error(
+            "--private-key makes no sense if SSL/TLS is disabled, did you mean to use --ssl?")
+    ssl_options = SSLOptions(not args.ssl, args.cacert, args.cert, args.private_key)
+    commands = {
+        'load': _run_load,
+        'run': _run_script,
+        'apply': _run_apply,
+    }
+    try:
+        setup(args.device_id, args.grpc_addr, args.election_id, args.role_name, args.config,
+              ssl_options, verbose=args.command is None)
+    except ConnectionError as e:
+        logging.critical(e)
+        sys.exit(1)
+    if args.command is not None:
+        # Non-interactive mode: no IPython shell and no stream listener threads.
+        ret = commands[args.command](args)
+        client.tear_down()
+        sys.exit(ret)
 
-    start_ipython(user_ns=user_ns, config=c, argv=[])
+    # imported here and not at the top of the file, see p4runtime_sh/interactive.py
+    from . import interactive
+    interactive.start(_make_user_ns(interactive=True))
 
     client.tear_down()
 
@@ -0,0 +1,385 @@
+# SPDX-FileCopyrightText: 2026 The P4 Language Consortium
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from p4.v1 import p4runtime_pb2
+from . import shell
+from .bytes_utils import to_canonical_bytes as _canon
+from .context import P4Type
+from .utils import UserError
+
+# Kinds of entities captured in a snapshot, in the order in which they must be inserted or
+# modified (deletions happen in the reverse order, see Diff.phases), since table entries can refer
+# to action profile groups, which can refer to action profile members.
+KINDS = (
+    "action_profile_member",
+    "action_profile_group",
+    "multicast_group_entry",
+    "clone_session_entry",
+    "table_entry",
+    "counter_entry",
+    "direct_counter_entry",
+    "meter_entry",
+    "direct_meter_entry",
+)
+
+# Entities which always exist on the device: they can only be modified.
+_MODIFY_ONLY_KINDS = frozenset(
+    ["counter_entry", "direct_counter_entry", "meter_entry", "direct_meter_entry"])
+
+
+def _watch_value(msg):
+    kind = msg.WhichOneof("watch_kind")
+    return None if kind is None else (kind, getattr(msg, kind))
+
+
+def _action_value(action):
+    return (action.action_id,
+            tuple(sorted((p.param_id, _canon(p.value)) for p in action.params)))
+
+
+def _table_action_value(table_action):
+    kind = table_action.WhichOneof("type")
+    if kind == "action":
+        return (kind, _action_value(table_action.action))
+    if kind == "action_profile_action_set":
+        return (kind, tuple(sorted(
+            (_action_value(a.action), a.weight, _watch_value(a))
+            for a in table_action.action_profile_action_set.action_profile_actions)))
+    if kind is None:
+        return None
+    return (kind, getattr(table_action, kind))
+
+
+def _meter_config_value(msg):
+    if not msg.HasField("config"):
+        return None
+    return _meter_config_tuple(msg.config)
+
+
+def _meter_config_tuple(c):
+    # an empty MeterConfig is the default configuration, as is a missing one
+    value = (c.cir, c.cburst, c.pir, c.pburst, c.eburst)
+    return None if not any(value) else value
+
+
+def _counter_data_value(msg):
+    return (msg.data.byte_count, msg.data.packet_count)
+
+
+def _replicas_value(replicas):
+    return tuple(sorted((r.egress_port, r.port, r.instance) for r in replicas))
+
+
+def entity_key_value(entity):
+    """
+    Returns (kind, key, value) for an Entity message. key identifies the entity on the device and
+    value includes everything that a MODIFY update can change; both are hashable tuples in which
+    bytestrings are canonical and repeated fields sorted, so that equivalent messages have the
+    same key and value. Read-only data (e.g. table entry counters) is not part of the value.
+    """
+    kind = entity.WhichOneof("entity")
+    if kind == "table_entry":
+        te = entity.table_entry
+        value = (_table_action_value(te.action), te.idle_timeout_ns, te.metadata,
+                 _meter_config_tuple(te.meter_config))
+        return kind, shell.table_entry_key(te), value
+    if kind == "action_profile_member":
+        m = entity.action_profile_member
+        return kind, (m.action_profile_id, m.member_id), _action_value(m.action)
+    if kind == "action_profile_group":
+        g = entity.action_profile_group
+        members = tuple(sorted((m.member_id, m.weight, _watch_value(m)) for m in g.members))
+        return kind, (g.action_profile_id, g.group_id), (members, g.max_size)
+    if kind == "packet_replication_engine_entry":
+        pre = entity.packet_replication_engine_entry
+        kind = pre.WhichOneof("type")
+        if kind == "multicast_group_entry":
+            mc = pre.multicast_group_entry
+            return kind, (mc.multicast_group_id,), (_replicas_value(mc.replicas), mc.metadata)
+        if kind == "clone_session_entry":
+            cs = pre.clone_session_entry
+            value = (_replicas_value(cs.replicas), cs.class_of_service, cs.packet_length_bytes)
+            return kind, (cs.session_id,), value
+    if kind == "counter_entry":
+        c = entity.counter_entry
+        return kind, (c.counter_id, c.index.index), _counter_data_value(c)
+    if kind == "direct_counter_entry":
+        c = entity.direct_counter_entry
+        return kind, shell.table_entry_key(c.table_entry), _counter_data_value(c)
+    if kind == "meter_entry":
+        m = entity.meter_entry
+        return kind, (m.meter_id, m.index.index), _meter_config_value(m)
+    if kind == "direct_meter_entry":
+        m = entity.direct_meter_entry
+        return kind, shell.table_entry_key(m.table_entry), _meter_config_value(m)
+    raise UserError("Entities of type '{}' are not supported in snapshots".format(kind))
+
+
+def _wildcard_entities(kind, context):
+    # Entity messages which read all the entities of the given kind.
+    def make(setter):
+        entity = p4runtime_pb2.Entity()
+        setter(entity)
+        return entity
+    if kind == "table_entry":
+        # the meter configuration of the entries (part of their value) is only returned if
+        # requested, for the tables with a direct meter
+        metered = {m.direct_table_id for _, m in context.get_objs(P4Type.direct_meter)}
+
+        def table_entry(e, table_id):
+            e.table_entry.table_id = table_id
+            if table_id in metered:
+                e.table_entry.meter_config.SetInParent()
+        return [make(lambda e: table_entry(e, t.preamble.id))
+                for _, t in context.get_objs(P4Type.table)]
+    if kind in ("action_profile_member", "action_profile_group"):
+        return [make(lambda e: setattr(getattr(e, kind), "action_profile_id", ap.preamble.id))
+                for _, ap in context.get_objs(P4Type.action_profile)]
+    if kind in ("multicast_group_entry", "clone_session_entry"):
+        return [make(lambda e: getattr(e.packet_replication_engine_entry, kind).SetInParent())]
+    if kind == "counter_entry":
+        return [make(lambda e: setattr(e.counter_entry, "counter_id", c.preamble.id))
+                for _, c in context.get_objs(P4Type.counter)]
+    if kind == "meter_entry":
+        return [make(lambda e: setattr(e.meter_entry, "meter_id", m.preamble.id))
+                for _, m in context.get_objs(P4Type.meter)]
+    if kind == "direct_counter_entry":
+        return [make(lambda e: setattr(e.direct_counter_entry.table_entry, "table_id",
+                                       c.direct_table_id))
+                for _, c in context.get_objs(P4Type.direct_counter)]
+    if kind == "direct_meter_entry":
+        return [make(lambda e: setattr(e.direct_meter_entry.table_entry, "table_id",
+                                       m.direct_table_id))
+                for _, m in context.get_objs(P4Type.direct_meter)]
+    raise UserError("Unknown entity kind '{}', expected one of {}".format(kind, KINDS))
+
+
+class Snapshot:
+    """
+    A keyed store of P4Runtime entities, e.g. the state of a device or the desired state for that
+    device. Entities are indexed by kind and by a canonical key (see entity_key_value), and stored
+    together with their canonical value, so that comparisons do not require serializing or
+    converting the Protobuf messages. The snapshot keeps a reference to the Entity messages
+    which are added to it, they should not be modified afterwards.
+
+    current = Snapshot.capture()
+    desired = Snapshot()
+    desired.add(te)  # shell entity objects or p4runtime_pb2.Entity messages
+    diff = current.diff(desired)
+    diff.apply(max_updates=1000)
+    """
+
+    def __init__(self, entities=()):
+        # kind -> {key: (value, Entity message)}
+        self._store = {kind: {} for kind in KINDS}
+        for entity in entities:
+            self.add(entity)
+
+    @classmethod
+    def capture(cls, kinds=None, entities_per_request=1, max_workers=16):
+        """
+        Reads all the entities of the given kinds (all supported kinds by default) from the
+        device, using concurrent ReadRequests (see shell.read_many). Default table entries are
+        not captured.
+        """
+        kinds = KINDS if kinds is None else kinds
+        entities = []
+        for kind in kinds:
+            entities.extend(_wildcard_entities(kind, shell.context))
+        snapshot = cls()
+        for r in shell.read_many(entities, entities_per_request, max_workers):
+            snapshot.add(r.entity)
+        return snapshot
+
+    def add(self, entity):
+        """Adds an entity (shell entity object or p4runtime_pb2.Entity message), replacing the
+        entity with the same key if any."""
+        entity = shell._to_entity_msg(entity)
+        kind, key, value = entity_key_value(entity)
+        self._store[kind][key] = (value, entity)
+
+    def get(self, kind, key):
+        """Returns the Entity message with the given kind and key, or None."""
+        item = self._store[kind].get(key)
+        return None if item is None else item[1]
+
+    def __contains__(self, entity):
+        kind, key, _ = entity_key_value(shell._to_entity_msg(entity))
+        return key in self._store[kind]
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._store.values())
+
+    def __iter__(self):
+        for entries in self._store.values():
+            for _, entity in entries.values():
+                yield entity
+
+    def kinds(self):
+        """Kinds of the entities in the snapshot."""
+        return [kind for kind, entries in self._store.items() if entries]
+
+    def counts(self):
+        """Number of entities of each kind."""
+        return {kind: len(entries) for kind, entries in self._store.items() if entries}
+
+    def diff(self, desired):
+        """Returns the Diff (updates) which turns this snapshot into the desired one."""
+        diff = Diff()
+        for kind in KINDS:
+            current_entries = self._store[kind]
+            desired_entries = desired._store[kind]
+            modify_only = kind in _MODIFY_ONLY_KINDS
+            for key, (value, entity) in desired_entries.items():
+                current = current_entries.get(key)
+                if current is None:
+                    # default table entries (key[2] is is_default_action) always exist
+                    if modify_only or (kind == "table_entry" and key[2]):
+                        diff._add(kind, p4runtime_pb2.Update.MODIFY, entity)
+                    else:
+                        diff._add(kind, p4runtime_pb2.Update.INSERT, entity)
+                elif current[0] != value:
+                    diff._add(kind, p4runtime_pb2.Update.MODIFY, entity)
+                    diff._references.update(_references(current[1]))
+            if modify_only:
+                continue
+            for key, (_, entity) in current_entries.items():
+                if key not in desired_entries:
+                    if kind == "table_entry" and key[2]:
+                        # default entries cannot be deleted
+                        continue
+                    diff._add(kind, p4runtime_pb2.Update.DELETE, entity)
+        return diff
+
+    def save(self, path):
+        """Saves the snapshot to a file (as a serialized ReadResponse message)."""
+        tag = b'\x0a'  # ReadResponse.entities
+        with open(path, 'wb') as f:
+            for entries in self._store.values():
+                for _, entity in entries.values():
+                    data = entity.SerializeToString()
+                    f.write(tag + shell._encode_varint(len(data)) + data)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a snapshot saved with save()."""
+        with open(path, 'rb') as f:
+            rep = p4runtime_pb2.ReadResponse.FromString(f.read())
+        return cls(rep.entities)
+
+
+def _references(entity):
+    # (kind, id) of the action profile members and groups an entity refers to; the action profile
+    # of the table is not known here, so references from table entries match any action profile
+    kind = entity.WhichOneof("entity")
+    if kind == "table_entry":
+        action = entity.table_entry.action
+        ref = action.WhichOneof("type")
+        if ref == "action_profile_member_id":
+            return [("action_profile_member", action.action_profile_member_id)]
+        if ref == "action_profile_group_id":
+            return [("action_profile_group", action.action_profile_group_id)]
+    elif kind == "action_profile_group":
+        return [("action_profile_member", m.member_id)
+                for m in entity.action_profile_group.members]
+    return []
+
+
+def _id(kind, entity):
+    if kind == "action_profile_member":
+        return entity.action_profile_member.member_id
+    if kind == "action_profile_group":
+        return entity.action_profile_group.group_id
+    return None
+
+
+class Diff:
+    """
+    The updates which turn a snapshot into another one, grouped by kind and type (INSERT, MODIFY,
+    DELETE). Use apply() to send them to the device.
+    """
+
+    def __init__(self):
+        # (kind, update type) -> list of Entity messages
+        self._updates = {}
+        # (kind, id) of the members and groups referred to by the current version of modified
+        # entities: they can only be deleted once these modifications have been applied
+        self._references = set()
+
+    def _add(self, kind, update_type, entity):
+        self._updates.setdefault((kind, update_type), []).append(entity)
+
+    def __len__(self):
+        return sum(len(updates) for updates in self._updates.values())
+
+    def __bool__(self):
+        return bool(self._updates)
+
+    def counts(self):
+        """Number of updates for each (kind, update type name)."""
+        return {(kind, p4runtime_pb2.Update.Type.Name(t)): len(updates)
+                for (kind, t), updates in self._updates.items()}
+
+    def phases(self):
+        """Returns the updates as a list of (update type, list of Entity messages), in the order in
+        which they must be applied:
+
+        - deletions of table entries, then of the action profile groups and members which no
+          modified entity refers to (yet), so that replacing the contents of a full table or
+          action profile does not run out of resources;
+        - modifications and insertions (action profile members before the groups and table
+          entries which refer to them);
+        - the other deletions, in the reverse order: members and groups which are referred to by
+          an entity until it is modified, and packet replication entries (which table entries can
+          refer to through action parameters).
+
+        Updates of different phases must not be sent in the same WriteRequest."""
+        early, late = [], []
+        for kind in reversed(KINDS):
+            deletes = self._updates.get((kind, p4runtime_pb2.Update.DELETE), [])
+            if kind == "table_entry":
+                early.append((p4runtime_pb2.Update.DELETE, deletes))
+            elif kind in ("action_profile_member", "action_profile_group"):
+                referenced = [(kind, _id(kind, e)) in self._references for e in deletes]
+                early.append((p4runtime_pb2.Update.DELETE,
+                              [e for e, r in zip(deletes, referenced) if not r]))
+                late.append((p4runtime_pb2.Update.DELETE,
+                             [e for e, r in zip(deletes, referenced) if r]))
+            else:
+                late.append((p4runtime_pb2.Update.DELETE, deletes))
+        updates = []
+        for kind in KINDS:
+            for t in (p4runtime_pb2.Update.MODIFY, p4runtime_pb2.Update.INSERT):
+                updates.append((t, self._updates.get((kind, t), [])))
+        return [(t, entities) for t, entities in early + updates + late if entities]
+
+    def apply(self, max_updates=1000, pipelined=False):
+        """Sends the updates to the device, with multi-update WriteRequests (see shell.batch).
+        Returns the number of updates sent."""
+        count = 0
+        for update_type, entities in self.phases():
+            batch = shell.WriteBatch(max_updates, pipelined)
+            for entity in entities:
+                update = p4runtime_pb2.Update()
+                update.type = update_type
+                update.entity.CopyFrom(entity)
+                batch.add(update, entity)
+            batch.flush()
+            batch.wait()
+            count += batch.num_updates
+        return count
+
+
+def reconcile(desired, kinds=None, max_updates=1000, pipelined=False):
+    """
+    Captures the current state of the device (for the kinds of entities in the desired snapshot,
+    unless kinds is provided), and applies the updates needed to reach the desired state. Returns
+    the Diff which was applied.
+    """
+    if kinds is None:
+        kinds = desired.kinds()
+    current = Snapshot.capture(kinds)
+    diff = current.diff(desired)
+    diff.apply(max_updates, pipelined)
+    return diff
@@ -2,32 +2,43 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import asyncio
 import os
 
 from callee import Matcher
 from concurrent import futures
 import google.protobuf.text_format
-from google.rpc import code_pb2
+from google.rpc import code_pb2, status_pb2
 import grpc
 from io import StringIO
 import itertools
 import logging
+import math
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+import urllib.error
+import urllib.request
 from unittest.mock import ANY, Mock, patch
 from p4.v1 import p4runtime_pb2, p4runtime_pb2_grpc
 from p4.config.v1 import p4info_pb2
 from p4runtime_sh.context import P4Type, P4RuntimeEntity
 from p4runtime_sh.global_options import global_options
-from p4runtime_sh.p4runtime import P4RuntimeException
+from p4runtime_sh import exporter as metrics_exporter, output, snapshot
+from p4runtime_sh.p4runtime import (AsyncP4RuntimeClient, P4RuntimeException,
+                                    P4RuntimeWriteException)
 from p4runtime_sh.utils import UserError
 import nose2.tools
-from threading import Thread
+from threading import Barrier, Event, Thread
 import queue
 
 # ensures that IPython uses a "simple prompt"
 # see run_sh() in BaseTestCase for more details
 os.environ['IPY_TEST_SIMPLE_PROMPT'] = '1'
 import p4runtime_sh.shell as sh  # noqa: E402
+from p4runtime_sh.session import FanoutError, SessionManager  # noqa: E402
 
 
 class P4RuntimeServicer(p4runtime_pb2_grpc.P4RuntimeServicer):
@@ -35,6 +46,9 @@ class P4RuntimeServicer(p4runtime_pb2_grpc.P4RuntimeServicer):
         self.p4info = p4info_pb2.P4Info()
         self.p4runtime_api_version = "1.3.0"
         self.stored_packet_out = queue.Queue()
+        self.stored_digest_ack = queue.Queue()
+        # if set, called for each packet-out, returns the stream messages to send back
+        self.packet_out_replies = None
 
     def GetForwardingPipelineConfig(self, request, context):
         rep = p4runtime_pb2.GetForwardingPipelineConfigResponse()
@@ -61,6 +75,10 @@ class P4RuntimeServicer(p4runtime_pb2_grpc.P4RuntimeServicer):
                 yield rep
             elif req.HasField('packet'):
                 self.stored_packet_out.put(req)
+                if self.packet_out_replies is not None:
+                    yield from self.packet_out_replies(req.packet)
+            elif req.HasField('digest_ack'):
+                self.stored_digest_ack.put(req.digest_ack)
 
     def Capabilities(self, request, context):
         rep = p4runtime_pb2.CapabilitiesResponse()
@@ -129,6 +147,18 @@ class IPythonTestCase(BaseTestCase):
         self.assertEqual(rc, 0)
 
 
+class ImportTestCase(unittest.TestCase):
+    def test_no_ipython_import(self):
+        # IPython should only be imported when starting the interactive shell
+        code = ("import sys; import p4runtime_sh.shell, p4runtime_sh.session; "
+                "print(' '.join(m for m in ('IPython', 'traitlets') if m in sys.modules))")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.run(
+            [sys.executable, "-c", code], cwd=root, check=True,
+            stdout=subprocess.PIPE, universal_newlines=True).stdout
+        self.assertEqual(out.strip(), "")
+
+
 class ProtoCmp(Matcher):
     def __init__(self, expected):
         self.expected = expected
@@ -172,6 +202,14 @@ class UnitTestCase(BaseTestCase):
         google.protobuf.text_format.Merge(expected_txt, getattr(update.entity, entity_type.name))
         return req
 
+    def make_read_mock_entities(self, table_entries):
+        def _Read(request, context):
+            rep = p4runtime_pb2.ReadResponse()
+            for te in table_entries:
+                rep.entities.add().table_entry.CopyFrom(te)
+            yield rep
+        return _Read
+
     def make_read_mock(self, entity):
         def _Read(request, context):
             rep = p4runtime_pb2.ReadResponse()
@@ -232,6 +270,37 @@ class UnitTestCase(BaseTestCase):
         ce.read(inc)
         self.assertEqual(cnt[0], num_reps * num_entities_per_rep)
 
+    def test_read_msgs(self):
+        ce = sh.CounterEntry("CounterA")
+
+        def _Read(request, context):
+            for i in range(3):
+                rep = p4runtime_pb2.ReadResponse()
+                for j in range(2):
+                    counter_entry = rep.entities.add().counter_entry
+                    counter_entry.counter_id = 302055013
+                    counter_entry.index.index = i * 2 + j
+                yield rep
+
+        self.servicer.Read.side_effect = _Read
+
+        msgs = list(ce.read_msgs())
+        self.assertEqual([msg.index.index for msg in msgs], list(range(6)))
+        for msg in msgs:
+            self.assertIsInstance(msg, p4runtime_pb2.CounterEntry)
+
+        indices = []
+        ce.read_msgs(lambda msg: indices.append(msg.index.index))
+        self.assertEqual(indices, list(range(6)))
+
+        def _ReadError(request, context):
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            yield p4runtime_pb2.ReadResponse()
+
+        self.servicer.Read.side_effect = _ReadError
+        with self.assertRaises(P4RuntimeException):
+            next(ce.read_msgs())
+
     def test_read_error(self):
         ce = sh.CounterEntry("CounterA")
 
@@ -754,6 +823,123 @@ action {
 
         self.simple_read_check(expected_req.updates[0].entity, te, P4RuntimeEntity.table_entry)
 
+    def test_pretty_print(self):
+        te = p4runtime_pb2.TableEntry(table_id=sh.context.get_table_id("ExactOne"))
+        te.action.action.action_id = sh.context.get_action_id("actionA")
+        te.action.action.params.add(param_id=1, value=b"\x01")
+        te.counter_data.SetInParent()
+        expected = """
+table_id: 33582705 ("ExactOne")
+action {
+  action {
+    action_id: 16783703 ("actionA")
+    params {
+      param_id: 1 ("param")
+      value: "\\\\x01"
+    }
+  }
+}
+counter_data {
+  \n}
+"""
+        self.assertEqual(sh._repr_pretty_p4runtime(te), expected.lstrip())
+
+        # the printer can be used concurrently, e.g. by the stream threads
+        results = queue.Queue()
+
+        def _print():
+            for _ in range(50):
+                results.put(sh._repr_pretty_p4runtime(te))
+        threads = [Thread(target=_print) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        while not results.empty():
+            self.assertEqual(results.get(), expected.lstrip())
+
+        p4info = p4info_pb2.P4Info()
+        p4info.type_info.structs["s"].members.add(name="x")
+        extern = p4info.externs.add(extern_type_id=1)
+        extern.instances.add().info.Pack(p4runtime_pb2.Action(action_id=1))
+        expected = """
+externs {
+  extern_type_id: 1
+  instances {
+    info {
+      [type.googleapis.com/p4.v1.Action] {
+        action_id: 1
+      }
+    }
+  }
+}
+type_info {
+  structs {
+    key: "s"
+    value {
+      members {
+        name: "x"
+      }
+    }
+  }
+}
+"""
+        self.assertEqual(sh._repr_pretty_p4info(p4info), expected.lstrip())
+
+    def test_context_field_lookups(self):
+        ctx = sh.context
+        self.assertEqual(ctx.get_mf("ExactOne", "header_test.field32").id, 1)
+        self.assertEqual(ctx.get_mf_id("ExactOne", "header_test.field32"), 1)
+        self.assertEqual(ctx.get_mf_name("LpmTwo", 2), "header_test.field2")
+        self.assertIsNone(ctx.get_mf("ExactOne", "field32"))
+        self.assertIsNone(ctx.get_mf_name("ExactOne", 2))
+        self.assertIsNone(ctx.get_mf_name("Unknown", 1))
+        self.assertEqual(ctx.get_param("actionB", "param").bitwidth, 8)
+        self.assertEqual(ctx.get_param_id("actionA", "param"), 1)
+        self.assertEqual(ctx.get_param_name("actionA", 1), "param")
+        self.assertIsNone(ctx.get_param_name("actionA", 2))
+        self.assertIsNone(ctx.get_param("NoAction", "param"))
+        self.assertEqual(ctx.get_packet_metadata_name_from_id("packet_in", 1), "ingress_port")
+        self.assertIsNone(ctx.get_packet_metadata_name_from_id("packet_in", 2))
+
+    def test_p4objects_registry(self):
+        names = sh.context.get_obj_names(P4Type.table)
+        self.assertEqual(list(names), sorted(names))
+        self.assertIn("ExactOne", names)
+        tables = sh.P4Objects(P4Type.table)
+        self.assertEqual(list(tables._ipython_key_completions_()), list(names))
+        self.assertIn("All the tables in the P4 program", tables.__doc__)
+
+        # entities share the P4Object of the P4Info object they refer to
+        t = tables["ExactOne"]
+        self.assertIs(sh.CounterEntry("CounterA")._info, sh.CounterEntry("CounterA")._info)
+        self.assertIs(sh.TableEntry("ExactOne")._info, t)
+        self.assertIn("for table 'ExactOne'", t.__doc__)
+        with self.assertRaisesRegex(UserError, "table 'Unknown' does not exist"):
+            tables["Unknown"]
+
+        # the registry is rebuilt when the P4Info changes
+        sh.context.set_p4info(sh.context.p4info)
+        self.assertIsNot(tables["ExactOne"], t)
+        self.assertEqual(tables["ExactOne"].id, t.id)
+
+    def test_table_entry_template(self):
+        te1 = sh.TableEntry("ExactOne")
+        te2 = sh.TableEntry("ExactOne")(action="actionA")
+        self.assertIs(te1._table_info, te2._table_info)
+        self.assertIs(te1.match._fields, te2.match._fields)
+        self.assertIsNot(te1.match._mk, te2.match._mk)
+        self.assertIn("An entry for table 'ExactOne'", te1.__doc__)
+        self.assertIn("To set the counter spec", te1.__doc__)
+        self.assertIn("header_test.field32", te1.match.__doc__)
+        self.assertIn("Action parameters for action 'actionA'", te2.action.__doc__)
+        te1.match["field32"] = "10.0.0.1"
+        self.assertIsNone(te2.match["field32"])
+
+        # the cache is invalidated when the P4Info changes
+        sh.context.set_p4info(sh.context.p4info)
+        self.assertIsNot(sh.TableEntry("ExactOne")._table_info, te1._table_info)
+
     def test_table_info(self):
         t = sh.P4Objects(P4Type.table)["ExactOne"]
         expected = """
@@ -1144,6 +1330,322 @@ clone_session_entry {
         self.simple_read_check(
             expected_req.updates[0].entity, cse, P4RuntimeEntity.packet_replication_engine_entry)
 
+    def make_exact_entry(self, value):
+        te = sh.TableEntry("ExactOne")(action="actionA")
+        te.match["header_test.field32"] = value
+        te.action["param"] = "aa:bb:cc:dd:ee:ff"
+        return te
+
+    def test_write_batch(self):
+        self.assertEqual(sh.batch().max_updates, 1000)
+        self.assertIsNone(sh.batch(max_updates=None).max_updates)
+        with sh.batch() as b:
+            for i in range(3):
+                self.make_exact_entry(str(i)).insert()
+            self.assertEqual(len(b), 3)
+            self.servicer.Write.assert_not_called()
+        self.servicer.Write.assert_called_once_with(ANY, ANY)
+        req = self.servicer.Write.call_args[0][0]
+        self.assertEqual(len(req.updates), 3)
+        for i, update in enumerate(req.updates):
+            self.assertEqual(update.type, p4runtime_pb2.Update.INSERT)
+            self.assertEqual(update.entity.table_entry.match[0].exact.value, bytes([i]))
+
+        # no batch: one WriteRequest per update
+        self.make_exact_entry("0").delete()
+        self.assertEqual(self.servicer.Write.call_count, 2)
+
+    @nose2.tools.params((5, 2, 3), (4, 2, 2), (3, 10, 1))
+    def test_write_batch_max_updates(self, num_updates, max_updates, num_requests):
+        with sh.batch(max_updates=max_updates):
+            for i in range(num_updates):
+                self.make_exact_entry(str(i)).modify()
+        self.assertEqual(self.servicer.Write.call_count, num_requests)
+        sizes = [len(c[0][0].updates) for c in self.servicer.Write.call_args_list]
+        self.assertEqual(sum(sizes), num_updates)
+
+    def test_write_batch_invalid(self):
+        with self.assertRaisesRegex(UserError, "max_updates must be a positive integer"):
+            sh.batch(max_updates=0)
+        with sh.batch():
+            with self.assertRaisesRegex(UserError, "cannot be nested"):
+                with sh.batch():
+                    pass
+        # pending updates are discarded on error
+        with self.assertRaises(RuntimeError):
+            with sh.batch():
+                self.make_exact_entry("1").insert()
+                raise RuntimeError()
+        self.servicer.Write.assert_not_called()
+
+    def make_write_error_mock(self, failed_idx):
+        """Builds a Write mock which fails the update at index failed_idx of every request."""
+        def _Write(request, context):
+            status = status_pb2.Status(code=code_pb2.UNKNOWN)
+            for i, _ in enumerate(request.updates):
+                p4_error = p4runtime_pb2.Error()
+                if i == failed_idx:
+                    p4_error.canonical_code = code_pb2.ALREADY_EXISTS
+                    p4_error.message = "Entry already exists"
+                status.details.add().Pack(p4_error)
+            context.set_code(grpc.StatusCode.UNKNOWN)
+            context.set_trailing_metadata(
+                (("grpc-status-details-bin", status.SerializeToString()),))
+            return p4runtime_pb2.WriteResponse()
+        return _Write
+
+    def test_write_batch_error(self):
+        self.servicer.Write.side_effect = self.make_write_error_mock(1)
+
+        entries = [self.make_exact_entry(str(i)) for i in range(3)]
+        with self.assertRaises(P4RuntimeWriteException) as cm:
+            with sh.batch():
+                for te in entries:
+                    te.insert()
+        e = cm.exception
+        self.assertEqual(len(e.errors), 1)
+        self.assertEqual(e.errors[0][0], 1)
+        self.assertEqual(len(e.failed_entities), 1)
+        self.assertEqual(e.failed_entities[0][0].msg(), entries[1].msg())
+        self.assertEqual(e.failed_entities[0][1].canonical_code, code_pb2.ALREADY_EXISTS)
+        self.assertIsNone(sh.write_batch)
+
+        # the same object is reused for all the updates: the failed one is reported as it was
+        # when it was written
+        te = sh.TableEntry("ExactOne")(action="actionA")
+        te.action["param"] = "aa:bb:cc:dd:ee:ff"
+        with self.assertRaises(P4RuntimeWriteException) as cm:
+            with sh.batch():
+                for i in range(3):
+                    te.match["header_test.field32"] = str(i)
+                    te.insert()
+        failed = cm.exception.failed_entities[0][0]
+        self.assertIsInstance(failed, sh.TableEntry)
+        self.assertIsNot(failed, te)
+        self.assertEqual(failed.match["header_test.field32"].exact.value, b'\x01')
+        self.assertEqual(te.match["header_test.field32"].exact.value, b'\x02')
+
+    def test_write_batch_pipelined(self):
+        with sh.batch(max_updates=2, pipelined=True):
+            for i in range(5):
+                self.make_exact_entry(str(i)).insert()
+        self.assertEqual(self.servicer.Write.call_count, 3)
+        self.assertEqual(sh.client._writes_in_flight, 0)
+
+        self.servicer.Write.side_effect = self.make_write_error_mock(1)
+        entries = [self.make_exact_entry(str(i)) for i in range(4)]
+        with self.assertRaises(P4RuntimeWriteException) as cm:
+            with sh.batch(max_updates=2, pipelined=True):
+                for te in entries:
+                    te.insert()
+        failed = [entity for entity, _ in cm.exception.failed_entities]
+        self.assertEqual(len(failed), 2)
+        self.assertEqual(failed[0].msg(), entries[1].msg())
+        self.assertEqual(failed[1].msg(), entries[3].msg())
+
+        # an exception in the scope: the requests already sent are awaited and their errors logged
+        with self.assertLogs(level=logging.ERROR):
+            with self.assertRaisesRegex(ValueError, "in scope"):
+                with sh.batch(max_updates=2, pipelined=True):
+                    for te in entries:
+                        te.insert()
+                    raise ValueError("in scope")
+        self.assertEqual(sh.client._writes_in_flight, 0)
+        self.assertIsNone(sh.write_batch)
+
+        # completed requests are not kept by the batch
+        self.servicer.Write.side_effect = None
+        with sh.batch(max_updates=2, pipelined=True) as b:
+            for te in entries:
+                te.insert()
+            for f, *_ in list(b._pending):
+                f.exception()
+            entries[0].insert()
+            entries[1].insert()
+            self.assertEqual(len(b._pending), 1)
+
+    def write_tmp_file(self, name, content):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_load_csv(self):
+        path = self.write_tmp_file("entries.csv", (
+            "field32,action,param\n"
+            "# comment\n"
+            "10.0.0.1,actionA,aa:bb:cc:dd:ee:ff\n"
+            "2, actionB , 0x10\n"
+            "3,NoAction,\n"))
+        count = sh.TableEntry("ExactOne").load(path, max_updates=2)
+        self.assertEqual(count, 3)
+        self.assertEqual(self.servicer.Write.call_count, 2)
+        updates = [u for c in self.servicer.Write.call_args_list for u in c[0][0].updates]
+
+        expected = [sh.TableEntry("ExactOne")(action="actionA"),
+                    sh.TableEntry("ExactOne")(action="actionB"),
+                    sh.TableEntry("ExactOne")(action="NoAction")]
+        expected[0].match["field32"] = "10.0.0.1"
+        expected[0].action["param"] = "aa:bb:cc:dd:ee:ff"
+        expected[1].match["field32"] = "2"
+        expected[1].action["param"] = "0x10"
+        expected[2].match["field32"] = "3"
+        for update, te in zip(updates, expected):
+            self.assertEqual(update.type, p4runtime_pb2.Update.INSERT)
+            self.assertEqual(update.entity.table_entry, te.msg())
+
+    @nose2.tools.params(
+        ("LpmOne", "10.0.0.1/8"), ("LpmOne", "10.0.0.1"), ("LpmOne", "0x0a000001/32"),
+        ("LpmTwo", "0xabcde/12"), ("TernaryOne", "10.1.1.1&&&0xff00ff00"),
+        ("TernaryOne", "10.0.0.1"), ("RangeOne", "1..100"), ("OptionalOne", "0x11"))
+    def test_load_match_types(self, table_name, value):
+        loader = sh._TableEntryLoader(sh.TableEntry(table_name))
+        update = loader.make_update([("header_test.field32", value)]) \
+            if table_name != "LpmTwo" else loader.make_update([("field20", value)])
+        te = sh.TableEntry(table_name)
+        te.match["field32" if table_name != "LpmTwo" else "field20"] = value
+        self.assertEqual(update.entity.table_entry, te.msg())
+
+    def test_load_jsonl_defaults(self):
+        path = self.write_tmp_file("entries.jsonl", "\n".join([
+            '{"field32": "10.0.0.0&&&0xff000000"}',
+            '{"field32": "10.0.0.0&&&0xffff0000", "priority": 20, "param": "00:00:00:00:00:01"}',
+            '{"field32": "10.0.0.0&&&0xffffff00", "action": "NoAction"}',
+        ]))
+        te = sh.TableEntry("TernaryOne")(action="actionA", priority=10)
+        te.action["param"] = "aa:bb:cc:dd:ee:ff"
+        with sh.batch():
+            self.assertEqual(te.load(path), 3)
+        self.servicer.Write.assert_called_once_with(ANY, ANY)
+        entries = [u.entity.table_entry for u in self.servicer.Write.call_args[0][0].updates]
+        self.assertEqual([e.priority for e in entries], [10, 20, 10])
+        self.assertEqual(entries[0].action, te.msg().action)
+        self.assertEqual(entries[1].action.action.params[0].value, b'\x01')
+        self.assertEqual(entries[2].action.action.action_id,
+                         sh.context.get_action("NoAction").preamble.id)
+        self.assertEqual(len(entries[2].action.action.params), 0)
+
+    @nose2.tools.params(
+        ("entries.csv", "field32,foo\n1,2\n", "line 2: Column 'foo' is not a valid"),
+        ("entries.csv", "field32,action\n1,actionA\n",
+         "line 2: Missing value for parameter 'param'"),
+        ("entries.csv", "field32,param\n1,2\n", "line 2: Action parameters are set but no"),
+        ("entries.csv", "field32\n1\n1,2\n", "line 3: expected 1 values but got 2"),
+        ("entries.jsonl", '{"field32": "1"}\n[]\n', "line 2: expected a JSON object"),
+        ("entries.txt", "", "Cannot infer file format"))
+    def test_load_invalid(self, name, content, msg):
+        path = self.write_tmp_file(name, content)
+        with self.assertRaisesRegex(UserError, msg):
+            sh.TableEntry("ExactOne").load(path)
+
+    def test_load_error(self):
+        self.servicer.Write.side_effect = self.make_write_error_mock(1)
+        path = self.write_tmp_file("entries.csv", "field32\n1\n2\n3\n")
+        with self.assertRaises(P4RuntimeWriteException) as cm:
+            sh.TableEntry("ExactOne")(action="NoAction").load(path)
+        self.assertEqual(cm.exception.failed_entities[0][0], (path, 3))
+
+    def test_run_apply(self):
+        paths = []
+        for name, values in (("a.txt", ["1", "2", "3"]), ("b.txt", ["4", "5"])):
+            req = p4runtime_pb2.WriteRequest()
+            for v in values:
+                update = req.updates.add()
+                update.type = p4runtime_pb2.Update.INSERT
+                update.entity.table_entry.CopyFrom(self.make_exact_entry(v).msg())
+            paths.append(self.write_tmp_file(
+                name, google.protobuf.text_format.MessageToString(req)))
+        args = sh.get_arg_parser().parse_args(["apply", "--max-updates", "2"] + paths)
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            self.assertEqual(sh._run_apply(args), 0)
+        self.assertIn("Wrote 5 updates", mock_stdout.getvalue())
+        sizes = [len(c[0][0].updates) for c in self.servicer.Write.call_args_list]
+        self.assertEqual(sizes, [2, 1, 2])
+
+        args = sh.get_arg_parser().parse_args(["apply", paths[0] + ".missing"])
+        self.assertEqual(sh._run_apply(args), 1)
+
+    def test_run_script(self):
+        path = self.write_tmp_file("script.py", "\n".join([
+            "import sys",
+            "assert 'packet_in' not in globals() and PacketIn is not None",
+            "for i in range(3):",
+            "    te = table_entry['ExactOne'](action='NoAction')",
+            "    te.match['field32'] = str(i)",
+            "    te.insert()",
+            "if __name__ == '__main__' and len(sys.argv) > 1:",
+            "    sys.exit(int(sys.argv[1]))",
+        ]))
+        parser = sh.get_arg_parser()
+        args = parser.parse_args(["run", "--max-updates", "10", path])
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            self.assertEqual(sh._run_script(args), 0)
+        self.assertIn("Wrote 3 updates", mock_stdout.getvalue())
+        self.servicer.Write.assert_called_once_with(ANY, ANY)
+
+        # no batch: one WriteRequest per update
+        args = parser.parse_args(["run", path, "3"])
+        self.assertEqual(sh._run_script(args), 3)
+        self.assertEqual(self.servicer.Write.call_count, 4)
+        self.assertIsNone(sh.write_batch)
+
+        # sys.exit() in a batch: the buffered updates are still written
+        args = parser.parse_args(["run", "--max-updates", "10", path, "2"])
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            self.assertEqual(sh._run_script(args), 2)
+        self.assertIn("Wrote 3 updates", mock_stdout.getvalue())
+        self.assertEqual(self.servicer.Write.call_count, 5)
+        self.assertEqual(len(self.servicer.Write.call_args[0][0].updates), 3)
+
+        self.servicer.Write.side_effect = self.make_write_error_mock(0)
+        with self.assertLogs(level=logging.ERROR):
+            self.assertEqual(sh._run_script(args), 1)
+
+    def test_write_async_window(self):
+        release = Event()
+        started = queue.Queue()
+
+        def _Write(request, context):
+            started.put(request)
+            release.wait()
+            return p4runtime_pb2.WriteResponse()
+
+        self.servicer.Write.side_effect = _Write
+        sh.client.max_in_flight_writes = 2
+
+        def make_req():
+            req = p4runtime_pb2.WriteRequest()
+            update = req.updates.add()
+            update.type = p4runtime_pb2.Update.INSERT
+            update.entity.table_entry.CopyFrom(self.make_exact_entry("1").msg())
+            return req
+
+        fs = [sh.client.write_async(make_req()) for _ in range(2)]
+        started.get(timeout=2)
+        started.get(timeout=2)
+
+        def _write_third():
+            fs.append(sh.client.write_async(make_req()))
+
+        _t = Thread(target=_write_third)
+        _t.start()
+        _t.join(timeout=0.2)
+        self.assertTrue(_t.is_alive())  # blocked because the window is full
+        self.assertTrue(started.empty())
+
+        release.set()
+        _t.join()
+        self.assertTrue(sh.client.wait_for_writes(timeout=2))
+        self.assertEqual(len(fs), 3)
+        for f in fs:
+            self.assertIsInstance(f.result(), p4runtime_pb2.WriteResponse)
+
+        self.servicer.Write.side_effect = self.make_write_error_mock(0)
+        f = sh.client.write_async(make_req())
+        self.assertIsInstance(f.exception(timeout=2), P4RuntimeWriteException)
+
     def test_p4runtime_api_version(self):
         version = sh.APIVersion()
         self.assertEqual(version, self.servicer.p4runtime_api_version)
@@ -1159,12 +1661,49 @@ clone_session_entry {
         options.set(option_name, False)
         self.assertEqual(options[option_name], False)
 
+    def test_output_sinks(self):
+        class Unprintable:
+            def __str__(self):
+                raise AssertionError("should not be formatted")
+
+        sh.global_options["verbose"] = True
+        self.assertTrue(sh.global_options["canonical_bytestrings"])
+        with output.redirect_output(output.BufferedSink()) as sink:
+            te = sh.TableEntry("ExactOne")
+            te.match["field32"] = "0x1"
+            te.match["field32"]
+            self.assertIn("field_id: 1", sink.getvalue())
+            sink.clear()
+            sh._print("a", 1)
+            self.assertEqual(list(sink.lines), ["a 1"])
+        self.assertIsInstance(output.get_output_sink(), output.StdoutSink)
+
+        with output.redirect_output(output.SilentSink()):
+            sh._print(Unprintable())
+        with output.redirect_output(output.LoggingSink(level=logging.DEBUG)):
+            with patch.object(logging.getLogger("p4runtime_sh"), "isEnabledFor",
+                              return_value=False):
+                sh._print(Unprintable())
+            with self.assertLogs("p4runtime_sh", level=logging.DEBUG) as cm:
+                sh._print("Unset")
+            self.assertEqual(cm.records[0].getMessage(), "Unset")
+        sh.global_options["verbose"] = False
+        sh._print(Unprintable())
+        with self.assertRaises(TypeError):
+            output.set_output_sink(None)
+
     def test_global_options_invalid(self):
         with self.assertRaisesRegex(UserError, "Unknown option name"):
             sh.global_options["foo"]
         with self.assertRaisesRegex(UserError, "Invalid value type"):
             sh.global_options["canonical_bytestrings"] = "bar"
 
+    def echo_packet_out(self, packet):
+        rep = p4runtime_pb2.StreamMessageResponse()
+        rep.packet.payload = packet.payload
+        rep.packet.metadata.extend(packet.metadata)
+        return [rep]
+
     def test_packet_in(self):
         # In this tests we will send a packet-in message from the servicer and check if
         # packet_in.sniff method works
@@ -1184,12 +1723,56 @@ clone_session_entry {
         _t = Thread(target=_sniff_packet, args=(captured_packet, ))
         _t.start()
 
-        # TODO: modify the servicer to send stream message?
-        sh.client.stream_in_q["packet"].put(msg)
+        self.servicer.packet_out_replies = lambda packet: [msg]
+        sh.PacketOut(b'AAAA', egress_port='1').send()
         _t.join()
 
         self.assertEqual(len(captured_packet), 1)
         self.assertEqual(captured_packet[0],  msg)
+        packet_in.close()
+
+    def test_sniff_streaming(self):
+        self.servicer.packet_out_replies = self.echo_packet_out
+        template = sh.PacketOutTemplate(egress_port='1')
+        packet_in = sh.PacketIn()
+
+        # messages are yielded as they arrive, the iterator stops after max_count messages
+        template.send(b'\x00')
+        it = packet_in.sniff(timeout=5, max_count=3)
+        self.assertEqual(next(it).packet.payload, b'\x00')
+        template.send_many([b'\x01', b'\x02', b'\x03'])
+        self.assertEqual([m.packet.payload for m in it], [b'\x01', b'\x02'])
+
+        received = []
+        packet_in.sniff(lambda batch: received.append(len(batch)), timeout=0.2, batch_size=2)
+        self.assertEqual(received, [1])
+
+        template.send_many(bytes([i]) for i in range(5))
+        batches = []
+        while sum(batches) < 5:
+            batches += [len(b) for b in packet_in.sniff(timeout=1, max_count=5, batch_size=2)]
+        self.assertTrue(all(n <= 2 for n in batches))
+        packet_in.close()
+
+        def digest_reply(packet):
+            rep = p4runtime_pb2.StreamMessageResponse()
+            rep.digest.digest_id = 1
+            rep.digest.list_id = packet.payload[0]
+            rep2 = p4runtime_pb2.StreamMessageResponse()
+            rep2.idle_timeout_notification.timestamp = packet.payload[0]
+            return [rep, rep2]
+        self.servicer.packet_out_replies = digest_reply
+        digest_list = sh.DigestList()
+        notifications = sh.IdleTimeoutNotification()
+        template.send_many([b'\x01', b'\x02'])
+        self.assertEqual([m.digest.list_id for m in digest_list.sniff(timeout=1, max_count=2)],
+                         [1, 2])
+        self.assertEqual(
+            [m.idle_timeout_notification.timestamp
+             for m in notifications.sniff(timeout=1, max_count=2)],
+            [1, 2])
+        digest_list.close()
+        notifications.close()
 
     def test_packet_out(self):
         expected_msg = p4runtime_pb2.StreamMessageRequest()
@@ -1207,6 +1790,746 @@ clone_session_entry {
         actual_msg = self.servicer.stored_packet_out.get(block=True, timeout=1)
         self.assertEqual(actual_msg, expected_msg)
 
+    def test_packet_out_template(self):
+        template = sh.PacketOutTemplate(egress_port='1')
+        md = p4runtime_pb2.PacketMetadata()
+        md.metadata_id = 1
+        md.value = b'\x00\x01'
+
+        payloads = [b'', b'AAAA', bytearray(b'B' * 200), memoryview(b'xxCCCC')[2:]]
+        for payload in payloads:
+            expected_msg = p4runtime_pb2.StreamMessageRequest()
+            expected_msg.packet.payload = bytes(payload)
+            expected_msg.packet.metadata.append(md)
+            self.assertEqual(
+                p4runtime_pb2.StreamMessageRequest.FromString(template.encode(payload)),
+                expected_msg)
+
+        template.send(b'AAAA')
+        actual_msg = self.servicer.stored_packet_out.get(block=True, timeout=1)
+        self.assertEqual(actual_msg.packet.payload, b'AAAA')
+
+        count = template.send_many((bytes([i]) for i in range(10)), batch_size=4)
+        self.assertEqual(count, 10)
+        for i in range(10):
+            actual_msg = self.servicer.stored_packet_out.get(block=True, timeout=1)
+            self.assertEqual(actual_msg.packet.payload, bytes([i]))
+            self.assertEqual(list(actual_msg.packet.metadata), [md])
+
+        with self.assertRaisesRegex(UserError, "payload must be"):
+            template.send("AAAA")
+
+    def test_digest_pipeline(self):
+        digest_id = 385901477
+
+        def digest_reply(packet):
+            rep = p4runtime_pb2.StreamMessageResponse()
+            rep.digest.digest_id = digest_id
+            rep.digest.list_id = packet.payload[0]
+            rep.digest.timestamp = time.time_ns()
+            for i in range(2):
+                members = rep.digest.data.add().struct.members
+                members.add().bitstring = b'\x00\x00\x00\x00\x00' + bytes([i])
+                members.add().bitstring = b'\x0a'
+            return [rep]
+        self.servicer.packet_out_replies = digest_reply
+        template = sh.PacketOutTemplate(egress_port='1')
+
+        digest_list = sh.DigestList()
+        with sh.DigestPipeline(ack_batch_size=2) as pipeline:
+            template.send_many([b'\x01', b'\x02', b'\x03'])
+            it = pipeline.lists(timeout=1)
+            dl = next(it)
+            self.assertEqual(dl.name, "test_digest_t")
+            self.assertEqual((dl.digest_id, dl.list_id), (digest_id, 1))
+            self.assertEqual([(d.f48, d.f12) for d in dl.data], [(0, 10), (1, 10)])
+            # not acknowledged before the digest list is processed
+            with self.assertRaises(queue.Empty):
+                self.servicer.stored_digest_ack.get(timeout=0.1)
+            self.assertEqual([d.list_id for d in it], [2, 3])
+            acks = [self.servicer.stored_digest_ack.get(timeout=1) for _ in range(3)]
+            self.assertEqual([a.list_id for a in acks], [1, 2, 3])
+            stats = pipeline.stats()
+            self.assertEqual((stats["lists_processed"], stats["digests_processed"]), (3, 6))
+            self.assertEqual((stats["acks_sent"], stats["ack_batches"]), (3, 2))
+
+        with sh.DigestPipeline(format="columns") as pipeline:
+            # open pipelines are tracked per client
+            self.assertTrue(sh.DigestPipeline._is_open(sh.client))
+            self.assertFalse(sh.DigestPipeline._is_open(Mock()))
+            template.send_many([b'\x04', b'\x06', b'\x07'])
+            seen = []
+            self.assertEqual(pipeline.process(seen.append, max_count=1, timeout=1), 1)
+            self.assertEqual(list(seen[0].data["f48"]), [0, 1])
+            self.assertEqual(list(seen[0].data["f12"]), [10, 10])
+            deadline = time.time() + 2
+            while pipeline.stats()["received"] < 3 and time.time() < deadline:
+                time.sleep(0.01)
+        # the digest lists which were not processed are discarded without being acknowledged
+        stats = pipeline.stats()
+        self.assertEqual((stats["discarded"], stats["pending"]), (2, 0))
+        self.assertEqual(self.servicer.stored_digest_ack.get(timeout=1).list_id, 4)
+        self.assertTrue(self.servicer.stored_digest_ack.empty())
+        self.assertEqual(len(sh.DigestPipeline._num_open), 0)
+
+        # without a pipeline, digest_list acknowledges digest lists on receipt
+        template.send(b'\x05')
+        self.assertEqual(self.servicer.stored_digest_ack.get(timeout=1).list_id, 5)
+        digest_list.close()
+
+    def test_aging_service(self):
+        def make_entry(value, idle_timeout_ns=0, elapsed_ns=None):
+            te = p4runtime_pb2.TableEntry()
+            te.table_id = 33582705
+            mf = te.match.add()
+            mf.field_id = 1
+            mf.exact.value = bytes([value])
+            te.idle_timeout_ns = idle_timeout_ns
+            if elapsed_ns is not None:
+                te.time_since_last_hit.elapsed_ns = elapsed_ns
+            return te
+
+        def notification_reply(packet):
+            rep = p4runtime_pb2.StreamMessageResponse()
+            rep.idle_timeout_notification.timestamp = time.time_ns()
+            for v in packet.payload:
+                rep.idle_timeout_notification.table_entry.append(make_entry(v, 1000))
+            return [rep]
+        self.servicer.packet_out_replies = notification_reply
+        template = sh.PacketOutTemplate(egress_port='1')
+
+        aging = sh.AgingService(max_updates=2, batch_timeout=0.1)
+        aging.start()
+        template.send(b'\x01\x02\x01\x03')
+        deadline = time.time() + 2
+        while aging.entries_deleted < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        aging.stop()
+        stats = aging.stats()
+        self.assertEqual((stats["entries_notified"], stats["entries_deleted"]), (4, 3))
+        self.assertEqual(stats["write_requests"], 2)
+        deleted = []
+        for call in self.servicer.Write.call_args_list:
+            req = call[0][0]
+            self.assertTrue(all(u.type == p4runtime_pb2.Update.DELETE for u in req.updates))
+            deleted.extend(u.entity.table_entry for u in req.updates)
+        self.assertEqual(sorted(deleted, key=lambda te: te.match[0].exact.value),
+                         [make_entry(v) for v in (1, 2, 3)])
+
+        self.servicer.Write.reset_mock()
+        # entry 2 was hit recently, it is not deleted
+        self.servicer.Read.side_effect = self.make_read_mock_entities(
+            [make_entry(1, 1000, 5000), make_entry(2, 1000, 10)])
+        aging = sh.AgingService(confirm=True)
+        template.send(b'\x01\x02')
+        self.assertEqual(aging.run(timeout=0.5), 1)
+        self.assertEqual(aging.entries_active, 1)
+        read_req = self.servicer.Read.call_args[0][0]
+        self.assertEqual(len(read_req.entities), 2)
+        self.assertTrue(read_req.entities[0].table_entry.HasField("time_since_last_hit"))
+        req = self.servicer.Write.call_args[0][0]
+        self.assertEqual([u.entity.table_entry for u in req.updates], [make_entry(1)])
+        aging.stop()
+
+        # entry 2 no longer exists: the ReadRequests including it fail, the other entries are
+        # still deleted
+        def _Read(request, context):
+            values = [e.table_entry.match[0].exact.value[0] for e in request.entities]
+            if 2 in values:
+                context.abort(grpc.StatusCode.NOT_FOUND, "entry not found")
+            rep = p4runtime_pb2.ReadResponse()
+            for v in values:
+                rep.entities.add().table_entry.CopyFrom(make_entry(v, 1000, 5000))
+            yield rep
+        self.servicer.Read.side_effect = _Read
+        self.servicer.Write.reset_mock()
+        aging = sh.AgingService(confirm=True)
+        template.send(b'\x01\x02\x03\x04')
+        self.assertEqual(aging.run(timeout=0.5), 3)
+        self.assertEqual((aging.entries_not_found, aging.read_errors), (1, 0))
+        req = self.servicer.Write.call_args[0][0]
+        self.assertEqual([u.entity.table_entry for u in req.updates],
+                         [make_entry(v) for v in (1, 3, 4)])
+        aging.stop()
+
+    def make_read_echo_mock(self, barrier=None):
+        # returns two entries for each table entry in the request
+        def _Read(request, context):
+            if barrier is not None:
+                barrier.wait(timeout=5)
+            rep = p4runtime_pb2.ReadResponse()
+            for entity in request.entities:
+                for i in range(2):
+                    te = rep.entities.add().table_entry
+                    te.CopyFrom(entity.table_entry)
+                    te.priority = i
+            yield rep
+        return _Read
+
+    def test_read_many(self):
+        tables = ["ExactOne", "LpmOne", "TernaryOne"]
+        # all requests must be outstanding at the same time to get past the barrier
+        self.servicer.Read.side_effect = self.make_read_echo_mock(Barrier(len(tables)))
+        results = list(sh.read_many([sh.TableEntry(t) for t in tables]))
+        self.assertEqual(self.servicer.Read.call_count, 3)
+        self.assertEqual(sorted((r.source, r.entity.table_entry.priority) for r in results),
+                         sorted((t, i) for t in tables for i in range(2)))
+        for r in results:
+            self.assertEqual(r.device, self.device_id)
+            self.assertEqual(sh.context.get_name_from_id(r.entity.table_entry.table_id), r.source)
+
+        self.servicer.Read.reset_mock()
+        self.servicer.Read.side_effect = self.make_read_echo_mock()
+        entity = p4runtime_pb2.Entity()
+        entity.table_entry.table_id = sh.context.get_obj_id(P4Type.table, "LpmTwo")
+        results = list(sh.read_many([sh.TableEntry("ExactOne"), entity],
+                                    entities_per_request=None))
+        self.assertEqual(self.servicer.Read.call_count, 1)
+        self.assertEqual(len(self.servicer.Read.call_args[0][0].entities), 2)
+        self.assertEqual([r.source for r in results], ["ExactOne"] * 2 + ["LpmTwo"] * 2)
+
+        def _ReadError(request, context):
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "bad read")
+            yield p4runtime_pb2.ReadResponse()
+        self.servicer.Read.side_effect = _ReadError
+        with self.assertRaises(P4RuntimeException):
+            list(sh.read_many([sh.TableEntry(t) for t in tables]))
+        with self.assertRaisesRegex(UserError, "Expected an entity"):
+            sh.read_many(["ExactOne"])
+
+    def test_read_many_close(self):
+        entity = p4runtime_pb2.Entity()
+        entity.table_entry.table_id = sh.context.get_obj_id(P4Type.table, "ExactOne")
+        received = []
+
+        class Client:
+            # a server which keeps sending ReadResponses
+            def read(self, entities):
+                while True:
+                    rep = p4runtime_pb2.ReadResponse()
+                    rep.entities.add().CopyFrom(entity)
+                    received.append(rep)
+                    yield rep
+
+        results = sh._read_many([(Client(), sh.context, self.device_id)], [entity] * 8, 1, 2)
+        self.assertEqual(next(results).source, "ExactOne")
+        results.close()
+        time.sleep(0.3)
+        # the workers stop receiving once the (bounded) result queue is full and the consumer
+        # has stopped iterating, and the other reads are never started
+        num_received = len(received)
+        self.assertLess(num_received, 16)
+        time.sleep(0.3)
+        self.assertEqual(len(received), num_received)
+
+    def test_table_entry_key(self):
+        te1 = sh.TableEntry("TernaryTwo")(action="actionA")
+        te1.priority = 10
+        te1.match["header_test.field32"] = "10.0.0.1&&&0xff"
+        te1.match["header_test.field16"] = "1&&&0xff"
+
+        sh.global_options["canonical_bytestrings"] = False
+        te2 = sh.TableEntry("TernaryTwo")
+        te2.priority = 10
+        te2.match["header_test.field16"] = "1&&&0xff"
+        te2.match["header_test.field32"] = "10.0.0.1&&&0xff"
+        # the key does not depend on the action, match field order or bytestring format
+        self.assertEqual(te1.key, te2.key)
+        self.assertEqual(te2.key, sh.table_entry_key(te2.msg()))
+        self.assertEqual({te1.key: 1}[te2.key], 1)
+        self.assertEqual(te1.key, (te1.id, 10, False, (
+            (1, b'\x01', b'\xff'), (2, b'\x01', b'\xff'))))
+
+        te2.priority = 11
+        self.assertNotEqual(te1.key, te2.key)
+        with self.assertRaisesRegex(UserError, "Cannot set 'key'"):
+            te1.key = None
+
+    def test_snapshot_reconcile(self):
+        table_id = sh.context.get_obj_id(P4Type.table, "ExactOne")
+        action_id = sh.context.get_obj_id(P4Type.action, "actionA")
+
+        def make_entry(addr, param):
+            # non-canonical bytestrings, as some servers return them
+            entity = p4runtime_pb2.Entity()
+            te = entity.table_entry
+            te.table_id = table_id
+            mf = te.match.add()
+            mf.field_id = 1
+            mf.exact.value = bytes([10, 0, 0, addr])
+            te.action.action.action_id = action_id
+            p = te.action.action.params.add()
+            p.param_id = 1
+            p.value = bytes([0, 0, 0, 0, 0, param])
+            return entity
+
+        def _Read(request, context):
+            rep = p4runtime_pb2.ReadResponse()
+            for entity in request.entities:
+                if entity.WhichOneof("entity") == "table_entry" and \
+                        entity.table_entry.table_id == table_id:
+                    for addr in (1, 2, 3):
+                        rep.entities.add().CopyFrom(make_entry(addr, addr))
+            yield rep
+        self.servicer.Read.side_effect = _Read
+
+        current = snapshot.Snapshot.capture(kinds=["table_entry"])
+        num_tables = len(list(sh.context.get_objs(P4Type.table)))
+        self.assertEqual(self.servicer.Read.call_count, num_tables)
+        self.assertEqual(current.counts(), {"table_entry": 3})
+
+        desired = snapshot.Snapshot()
+        for addr, param in ((1, 1), (2, 5), (4, 4)):
+            te = sh.TableEntry("ExactOne")(action="actionA")
+            te.match["header_test.field32"] = "10.0.0.{}".format(addr)
+            te.action["param"] = str(param)
+            desired.add(te)
+        self.assertIn(make_entry(1, 1), desired)
+        self.assertEqual(len(current.diff(current)), 0)
+
+        path = self.write_tmp_file("snapshot.bin", "")
+        desired.save(path)
+        desired = snapshot.Snapshot.load(path)
+        self.assertEqual(len(desired), 3)
+
+        self.servicer.Write.reset_mock()
+        diff = snapshot.reconcile(desired)
+        self.assertEqual(diff.counts(), {("table_entry", "DELETE"): 1,
+                                         ("table_entry", "MODIFY"): 1,
+                                         ("table_entry", "INSERT"): 1})
+        reqs = [c[0][0] for c in self.servicer.Write.call_args_list]
+        self.assertEqual([(u.type, u.entity.table_entry.match[0].exact.value)
+                          for req in reqs for u in req.updates],
+                         [(p4runtime_pb2.Update.DELETE, b'\x0a\x00\x00\x03'),
+                          (p4runtime_pb2.Update.MODIFY, b'\x0a\x00\x00\x02'),
+                          (p4runtime_pb2.Update.INSERT, b'\x0a\x00\x00\x04')])
+        self.assertEqual(len(reqs), 3)
+
+    def test_snapshot_meter_config(self):
+        table_id = sh.context.get_obj_id(P4Type.table, "ExactOne")
+        te = sh.TableEntry("ExactOne")(action="actionA")
+        te.match["header_test.field32"] = "10.0.0.1"
+        te.action["param"] = "1"
+        te.meter_config.cir = 1000
+        te.meter_config.cburst = 100
+        te.meter_config.pir = 2000
+        te.meter_config.pburst = 200
+        device_entry = te.msg()
+
+        def _Read(request, context):
+            # like a server: the meter configuration is only returned if requested
+            rep = p4runtime_pb2.ReadResponse()
+            for entity in request.entities:
+                if entity.table_entry.table_id == table_id:
+                    e = rep.entities.add().table_entry
+                    e.CopyFrom(device_entry)
+                    if not entity.table_entry.HasField("meter_config"):
+                        e.ClearField("meter_config")
+            yield rep
+        self.servicer.Read.side_effect = _Read
+
+        desired = snapshot.Snapshot([te])
+        current = snapshot.Snapshot.capture(kinds=["table_entry"])
+        self.assertEqual(len(current.diff(desired)), 0)
+        te.meter_config.cir = 500
+        desired = snapshot.Snapshot([te])
+        self.assertEqual(current.diff(desired).counts(), {("table_entry", "MODIFY"): 1})
+
+    def test_snapshot_diff_order(self):
+        def make_snapshot(member_ids, group_member_ids):
+            s = snapshot.Snapshot()
+            for member_id in member_ids:
+                member = sh.ActionProfileMember("ActProfWS")(member_id=member_id, action="actionA")
+                member.action["param"] = "aa:bb:cc:dd:ee:ff"
+                s.add(member)
+            group = sh.ActionProfileGroup("ActProfWS")(group_id=1)
+            for member_id in group_member_ids:
+                group.add(member_id)
+            s.add(group)
+            return s
+
+        # the group is modified to drop member 2, which is deleted: the member can only be deleted
+        # once the group no longer refers to it
+        current = make_snapshot([1, 2], [1, 2])
+        desired = make_snapshot([1], [1])
+        diff = current.diff(desired)
+        self.assertEqual(diff.counts(), {("action_profile_group", "MODIFY"): 1,
+                                         ("action_profile_member", "DELETE"): 1})
+        self.assertEqual(diff.apply(), 2)
+        reqs = [c[0][0] for c in self.servicer.Write.call_args_list]
+        self.assertEqual([(u.type, u.entity.WhichOneof("entity")) for req in reqs
+                          for u in req.updates],
+                         [(p4runtime_pb2.Update.MODIFY, "action_profile_group"),
+                          (p4runtime_pb2.Update.DELETE, "action_profile_member")])
+
+    def test_snapshot_replace_full(self):
+        def make_snapshot(ids):
+            s = snapshot.Snapshot()
+            for i in ids:
+                member = sh.ActionProfileMember("ActProfWS")(member_id=i, action="actionA")
+                member.action["param"] = "aa:bb:cc:dd:ee:ff"
+                s.add(member)
+                s.add(self.make_exact_entry(str(i)))
+            return s
+
+        # the table and the action profile hold 2 entities each, like the device
+        installed = {"table_entry": 2, "action_profile_member": 2}
+
+        def _Write(request, context):
+            for u in request.updates:
+                kind = u.entity.WhichOneof("entity")
+                installed[kind] += 1 if u.type == p4runtime_pb2.Update.INSERT else -1
+                if installed[kind] > 2:
+                    context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+                    return p4runtime_pb2.WriteResponse()
+            return p4runtime_pb2.WriteResponse()
+        self.servicer.Write.side_effect = _Write
+
+        diff = make_snapshot([1, 2]).diff(make_snapshot([3, 4]))
+        self.assertEqual(diff.apply(), 8)
+        self.assertEqual(installed, {"table_entry": 2, "action_profile_member": 2})
+        reqs = [c[0][0] for c in self.servicer.Write.call_args_list]
+        self.assertEqual([(req.updates[0].type, req.updates[0].entity.WhichOneof("entity"))
+                          for req in reqs],
+                         [(p4runtime_pb2.Update.DELETE, "table_entry"),
+                          (p4runtime_pb2.Update.DELETE, "action_profile_member"),
+                          (p4runtime_pb2.Update.INSERT, "action_profile_member"),
+                          (p4runtime_pb2.Update.INSERT, "table_entry")])
+
+    def test_shadow_cache(self):
+        device = [self.make_exact_entry(str(i)).msg() for i in (1, 2)]
+        self.servicer.Read.side_effect = self.make_read_mock_entities(device)
+
+        def read_values(te=None):
+            te = sh.TableEntry("ExactOne") if te is None else te
+            return sorted(te.match["header_test.field32"].exact.value for te in te.read())
+
+        cache = sh.shadow_cache(tables=["ExactOne"])
+        with self.assertRaisesRegex(UserError, "already enabled"):
+            sh.shadow_cache()
+        self.assertEqual(read_values(), [b'\x01', b'\x02'])
+        self.assertEqual(read_values(), [b'\x01', b'\x02'])
+        self.assertEqual(self.servicer.Read.call_count, 1)
+
+        # writes (including batched ones) are applied to the cache
+        self.make_exact_entry("3").insert()
+        self.make_exact_entry("1").delete()
+        with sh.batch(max_updates=2, pipelined=True):
+            for i in (4, 5):
+                self.make_exact_entry(str(i)).insert()
+        self.assertEqual(read_values(), [b'\x02', b'\x03', b'\x04', b'\x05'])
+        te = sh.TableEntry("ExactOne")
+        te.match["header_test.field32"] = "4"
+        self.assertEqual(read_values(te), [b'\x04'])
+        msg = next(te.read_msgs())
+        self.assertEqual(msg.action.action.params[0].value, b'\xaa\xbb\xcc\xdd\xee\xff')
+        te.match["header_test.field32"] = "1"
+        self.assertEqual(read_values(te), [])
+        self.assertEqual(self.servicer.Read.call_count, 1)
+        self.assertEqual(cache.stats(), {"tables": 1, "entries": 4, "hits": 5, "misses": 1,
+                                         "resyncs": 1, "invalidations": 0})
+
+        # reads the cache cannot answer go to the device
+        te = sh.TableEntry("ExactOne")
+        te.counter_data.packet_count = 0
+        list(te.read())
+        list(sh.TableEntry("LpmOne").read())
+        self.assertEqual(self.servicer.Read.call_count, 3)
+
+        # a failed write invalidates the table
+        self.servicer.Write.side_effect = self.make_write_error_mock(0)
+        with self.assertRaises(P4RuntimeWriteException):
+            self.make_exact_entry("6").insert()
+        self.assertEqual(read_values(), [b'\x01', b'\x02'])
+        self.assertEqual(self.servicer.Read.call_count, 4)
+        self.assertEqual(cache.invalidations, 1)
+
+        # as does a backup -> primary transition
+        arbitration = p4runtime_pb2.MasterArbitrationUpdate()
+        arbitration.status.code = code_pb2.ALREADY_EXISTS
+        sh.client._update_primary(arbitration)
+        read_values()
+        self.assertEqual(self.servicer.Read.call_count, 4)
+        arbitration.status.code = code_pb2.OK
+        sh.client._update_primary(arbitration)
+        read_values()
+        self.assertEqual(self.servicer.Read.call_count, 5)
+
+        cache.resync()
+        self.assertEqual(self.servicer.Read.call_count, 6)
+        cache.disable()
+        read_values()
+        self.assertEqual(self.servicer.Read.call_count, 7)
+        self.assertNotIn(sh.client, sh._shadows)
+
+    def test_counter_poller(self):
+        counter_id = sh.context.get_counter_id("CounterA")
+        values = {}
+
+        def _Read(request, context):
+            rep = p4runtime_pb2.ReadResponse()
+            for index, (byte_count, packet_count) in values.items():
+                c = rep.entities.add().counter_entry
+                c.counter_id = counter_id
+                c.index.index = index
+                c.data.byte_count = byte_count
+                c.data.packet_count = packet_count
+            yield rep
+        self.servicer.Read.side_effect = _Read
+
+        poller = sh.CounterPoller("CounterA", history=2)
+        with self.assertRaisesRegex(UserError, "At least 2 samples"):
+            poller.deltas()
+        values.update({0: (100, 1), 5: (1000, 10)})
+        sample = poller.poll()
+        self.assertEqual(len(sample.packet_count), 1024)
+        self.assertEqual((sample.byte_count[5], sample.packet_count[5]), (1000, 10))
+        self.assertEqual(sample.packet_count[1], 0)
+        req = self.servicer.Read.call_args[0][0]
+        self.assertEqual(req.entities[0].counter_entry.counter_id, counter_id)
+        self.assertFalse(req.entities[0].counter_entry.HasField("index"))
+
+        values.update({0: (50, 1), 5: (3000, 30)})  # index 0 was reset
+        poller.poll()
+        elapsed, byte_deltas, packet_deltas = poller.deltas()
+        self.assertEqual((byte_deltas[0], byte_deltas[5], packet_deltas[5]), (50, 2000, 20))
+        bytes_per_s, _ = poller.rates()
+        self.assertAlmostEqual(bytes_per_s[5], 2000 / elapsed)
+
+        poller.poll()
+        self.assertEqual(len(poller), 2)
+        self.assertEqual(poller.samples()[0].byte_count[5], 3000)
+
+        samples = queue.Queue()
+        poller.start(interval=0.01, function=samples.put)
+        samples.get(timeout=1)
+        poller.stop()
+        self.assertGreaterEqual(poller.stats()["polls"], 4)
+
+    def test_direct_counter_poller(self):
+        entries = [self.make_exact_entry(str(i)).msg() for i in (1, 2)]
+
+        def _Read(request, context):
+            rep = p4runtime_pb2.ReadResponse()
+            for i, te in enumerate(entries):
+                c = rep.entities.add().direct_counter_entry
+                c.table_entry.CopyFrom(te)
+                c.data.packet_count = 10 * (i + 1)
+            yield rep
+        self.servicer.Read.side_effect = _Read
+
+        poller = sh.CounterPoller("ExactOne_counter")
+        self.assertTrue(poller.direct)
+        poller.poll()
+        self.assertEqual(poller.keys, [sh.table_entry_key(te) for te in entries])
+        entries.reverse()
+        entries.append(self.make_exact_entry("3").msg())
+        sample = poller.poll()
+        self.assertEqual(list(sample.packet_count), [20, 10, 30])
+        _, _, packet_deltas = poller.deltas()
+        self.assertEqual(list(packet_deltas), [10, 10, 30])
+
+        # the rows of deleted entries are dropped, in the previous samples too
+        keys = [sh.table_entry_key(te) for te in entries]
+        del entries[0]
+        sample = poller.poll()
+        self.assertEqual(poller.keys, [keys[1], keys[2]])
+        self.assertEqual(poller.compactions, 1)
+        self.assertEqual(list(sample.packet_count), [10, 20])
+        self.assertEqual([list(s.packet_count) for s in poller.samples()[:-1]],
+                         [[10], [20, 30]])
+
+        with self.assertRaisesRegex(UserError, "does not exist"):
+            sh.CounterPoller("Unknown")
+
+    def test_metrics_exporter(self):
+        direct_entries = []
+        for addr in ("10.0.0.1", "10.0.0.2"):
+            te = sh.TableEntry("ExactOne")
+            te.match["header_test.field32"] = addr
+            direct_entries.append(te.msg())
+
+        def _Read(request, context):
+            rep = p4runtime_pb2.ReadResponse()
+            entity = request.entities[0]
+            kind = entity.WhichOneof("entity")
+            if kind == "counter_entry":
+                c = rep.entities.add().counter_entry
+                c.CopyFrom(entity.counter_entry)
+                c.index.index = 3
+                c.data.packet_count = 7
+            elif kind == "direct_counter_entry":
+                for msg in direct_entries:
+                    c = rep.entities.add().direct_counter_entry
+                    c.table_entry.CopyFrom(msg)
+                    c.data.packet_count = 9
+            elif kind == "meter_entry":
+                m = rep.entities.add().meter_entry
+                m.CopyFrom(entity.meter_entry)
+                m.index.index = 1
+                m.config.cir = 100
+            yield rep
+        self.servicer.Read.side_effect = _Read
+
+        exporter = metrics_exporter.MetricsExporter()
+        text = exporter.collect()
+        lines = text.splitlines()
+        self.assertIn("# TYPE p4_counter_packets counter", lines)
+        self.assertIn('p4_counter_packets_total{counter="CounterA",index="3"} 7', lines)
+        self.assertIn('p4_counter_packets_total{counter="CounterA",index="0"} 0', lines)
+        self.assertIn('p4_direct_counter_packets_total{counter="ExactOne_counter",'
+                      'table="ExactOne",match_header_test_field32="0xa000001"} 9', lines)
+        self.assertIn('p4_meter_cir{meter="MeterA",index="1"} 100', lines)
+        self.assertIn("p4runtime_client_primary 1", lines)
+        self.assertNotIn("p4_counter_bytes_total", text)
+        self.assertEqual(lines[-1], "# EOF")
+        self.assertEqual(len([line for line in lines if line.startswith("p4_counter_")]), 1024)
+
+        # deleted table entries are no longer exported
+        del direct_entries[0]
+        lines = exporter.collect().splitlines()
+        direct_lines = [line for line in lines if line.startswith("p4_direct_counter_")]
+        self.assertEqual(direct_lines, [
+            'p4_direct_counter_packets_total{counter="ExactOne_counter",'
+            'table="ExactOne",match_header_test_field32="0xa000002"} 9'])
+
+        with self.assertRaisesRegex(UserError, "does not exist"):
+            metrics_exporter.MetricsExporter(counters=["Unknown"])
+
+        exporter = metrics_exporter.MetricsExporter(counters=["CounterA"], direct_counters=[],
+                                                    meters=[])
+        path = self.write_tmp_file("p4.prom", "")
+        exporter.write_textfile(path)
+        with open(path) as f:
+            self.assertIn('p4_counter_packets_total{counter="CounterA",index="3"} 7', f.read())
+
+        port = exporter.serve(port=0)
+        try:
+            url = "http://127.0.0.1:{}/metrics".format(port)
+            with urllib.request.urlopen(url, timeout=5) as rep:
+                self.assertEqual(rep.headers["Content-Type"], metrics_exporter.CONTENT_TYPE)
+                self.assertIn(b"p4runtime_exporter_scrape_duration_seconds", rep.read())
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen("http://127.0.0.1:{}/".format(port), timeout=5)
+        finally:
+            exporter.shutdown()
+        self.assertEqual(exporter.scrapes, 2)
+
+    def test_client_metrics(self):
+        stats = sh.client_stats()
+        self.assertNotIn("rpcs", stats)
+        self.assertEqual(stats["primary"], True)
+        self.assertEqual(stats["stream_in_queues"]["packet"], 0)
+
+        sh.client_stats(enable=True)
+        self.servicer.Read.side_effect = self.make_read_mock_entities(
+            [self.make_exact_entry("1").msg()])
+        self.servicer.packet_out_replies = self.echo_packet_out
+        self.make_exact_entry("1").insert()
+        with sh.batch(pipelined=True):
+            self.make_exact_entry("2").insert()
+        self.assertEqual(len(list(sh.TableEntry("ExactOne").read())), 1)
+        self.servicer.Write.side_effect = self.make_write_error_mock(0)
+        with self.assertRaises(P4RuntimeWriteException):
+            self.make_exact_entry("3").insert()
+        sh.PacketOut(b'AAAA', egress_port='1').send()
+        self.assertIsNotNone(sh.client.get_stream_packet("packet", timeout=1))
+
+        deadline = time.time() + 1
+        while "Read" not in sh.client_stats()["rpcs"] and time.time() < deadline:
+            time.sleep(0.01)
+        stats = sh.client_stats()
+        write = stats["rpcs"]["Write"]
+        self.assertEqual(write["calls"], 3)
+        self.assertEqual(write["errors"], {"UNKNOWN": 1})
+        self.assertEqual(write["p4_errors"], {"ALREADY_EXISTS": 1})
+        self.assertEqual(write["latency_histogram"][-1], (math.inf, 3))
+        self.assertGreater(write["bytes_sent"], 0)
+        read = stats["rpcs"]["Read"]
+        self.assertEqual((read["calls"], read["errors"]), (1, {}))
+        self.assertGreater(read["bytes_received"], 0)
+        self.assertEqual(stats["stream"]["messages_received"], {"packet": 1})
+        self.assertEqual(stats["stream"]["messages_sent"], 1)
+
+        exporter = metrics_exporter.MetricsExporter(counters=[], direct_counters=[], meters=[])
+        lines = exporter.collect().splitlines()
+        self.assertIn('p4runtime_client_rpcs_total{rpc="Write"} 3', lines)
+        self.assertIn('p4runtime_client_rpc_errors_total{rpc="Write",code="UNKNOWN"} 1', lines)
+        self.assertIn('p4runtime_client_rpc_latency_seconds_bucket{rpc="Write",le="+Inf"} 3',
+                      lines)
+        self.assertIn('p4runtime_client_stream_queue_depth{queue="packet"} 0', lines)
+
+        # the stream counters can be read while new message types are being counted
+        metrics = sh.client.metrics
+
+        def count_types():
+            for i in range(2000):
+                metrics.add_stream_message_received("type{}".format(i))
+        t = Thread(target=count_types)
+        t.start()
+        while t.is_alive():
+            metrics.stats()
+        t.join()
+        self.assertEqual(len(metrics.stats()["stream"]["messages_received"]), 2001)
+
+        self.assertNotIn("rpcs", sh.client_stats(enable=False))
+
+    def test_packet_in_subscribe(self):
+        self.servicer.packet_out_replies = self.echo_packet_out
+        template = sh.PacketOutTemplate(egress_port='1')
+
+        received = queue.Queue()
+        sub = sh.PacketIn.subscribe(received.put)
+        template.send_many(bytes([i]) for i in range(5))
+        for i in range(5):
+            self.assertEqual(received.get(timeout=1).packet.payload, bytes([i]))
+        self.assertEqual(sub.received, 5)
+        sub.close()
+
+        sub = sh.PacketIn.subscribe(maxsize=4, batch_size=3)
+        template.send_many(bytes([i]) for i in range(6))
+        deadline = time.time() + 1
+        while sub.received < 6 and time.time() < deadline:
+            time.sleep(0.01)
+        # the last packets were dropped since the queue was full
+        self.assertEqual((sub.received, sub.dropped, sub.pending), (6, 2, 4))
+        self.assertEqual([m.packet.payload for m in sub.get_batch(timeout=1)],
+                         [b'\x00', b'\x01', b'\x02'])
+        self.assertEqual([m.packet.payload for m in sub.get_batch(timeout=0.1)], [b'\x03'])
+        sub.close()
+        self.assertEqual(list(sub), [])
+
+        batches = queue.Queue()
+        sub = sh.PacketIn.subscribe(batches.put, batch_size=10, batch_timeout=0.05)
+        template.send_many(bytes([i]) for i in range(4))
+        payloads = []
+        while len(payloads) < 4:
+            payloads.extend(m.packet.payload for m in batches.get(timeout=1))
+        self.assertEqual(payloads, [bytes([i]) for i in range(4)])
+        sub.close()
+
+        # the batch timeout applies to the oldest buffered message, even after a partial batch
+        # was consumed
+        sub = sh.PacketIn.subscribe(batch_size=10, batch_timeout=0.2)
+        template.send_many(bytes([i]) for i in range(2))
+        deadline = time.time() + 1
+        while sub.received < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.2)
+        self.assertEqual([m.packet.payload for m in sub.drain(max_count=1)], [b'\x00'])
+        start = time.monotonic()
+        self.assertEqual([m.packet.payload for m in sub.get_batch(timeout=1)], [b'\x01'])
+        self.assertLess(time.monotonic() - start, 0.1)
+        sub.close()
+
+        # without subscriptions, packet-ins go to the client queue again
+        template.send(b'AAAA')
+        msg = sh.client.get_stream_packet("packet", timeout=1)
+        self.assertEqual(msg.packet.payload, b'AAAA')
+
+        with self.assertRaisesRegex(ValueError, "Cannot subscribe"):
+            sh.client.subscribe("arbitration")
+
 
 class P4RuntimeClientTestCase(BaseTestCase):
     def setUp(self):
@@ -1239,3 +2562,245 @@ class P4RuntimeClientTestCase(BaseTestCase):
             self.assertIn("You are not the primary client", mock_stdout.getvalue())
             self.servicer.StreamChannel.assert_called_once_with(ANY, ANY)
             client.tear_down()
+
+
+class AsyncP4RuntimeClientTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device_id = 0
+        self.election_id = (0, 1)
+
+        self.servicer = P4RuntimeServicer()
+        self.servicer.Write = Mock(spec=[], return_value=p4runtime_pb2.WriteResponse())
+        self.servicer.Read = Mock(spec=[], return_value=p4runtime_pb2.ReadResponse())
+        p4runtime_pb2_grpc.add_P4RuntimeServicer_to_server(self.servicer, self.server)
+
+    def run_async(self, coro_fn):
+        async def _run():
+            async with AsyncP4RuntimeClient(
+                    self.device_id, self.grpc_addr, self.election_id) as client:
+                self.assertTrue(client.is_primary)
+                return await coro_fn(client)
+        return asyncio.run(_run())
+
+    def test_config_and_version(self):
+        async def _test(client):
+            await client.set_fwd_pipe_config(self._p4info_path, self._config_path)
+            p4info = await client.get_p4info()
+            self.assertEqual(p4info, self.servicer.p4info)
+            version = await client.api_version()
+            self.assertEqual(version, self.servicer.p4runtime_api_version)
+        self.run_async(_test)
+
+    def test_write_and_read(self):
+        update = p4runtime_pb2.Update()
+        update.type = p4runtime_pb2.Update.INSERT
+        update.entity.counter_entry.counter_id = 302055013
+
+        def _Read(request, context):
+            for _ in range(3):
+                rep = p4runtime_pb2.ReadResponse()
+                rep.entities.add().CopyFrom(update.entity)
+                yield rep
+
+        self.servicer.Read.side_effect = _Read
+
+        async def _test(client):
+            await client.write_update(update)
+            req = p4runtime_pb2.WriteRequest()
+            req.updates.extend([update, update])
+            await asyncio.gather(client.write(req), client.write(req))
+            reps = [rep async for rep in client.read_one(update.entity)]
+            return reps
+
+        reps = self.run_async(_test)
+        self.assertEqual(self.servicer.Write.call_count, 3)
+        req = self.servicer.Write.call_args_list[0][0][0]
+        self.assertEqual(req.device_id, self.device_id)
+        self.assertEqual(req.election_id.low, self.election_id[1])
+        self.assertEqual(len(reps), 3)
+
+    def test_errors(self):
+        def _Read(request, context):
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            yield p4runtime_pb2.ReadResponse()
+
+        def _Write(request, context):
+            context.set_code(grpc.StatusCode.UNKNOWN)
+            status = status_pb2.Status(code=code_pb2.UNKNOWN)
+            p4_error = p4runtime_pb2.Error(canonical_code=code_pb2.INVALID_ARGUMENT)
+            status.details.add().Pack(p4_error)
+            context.set_trailing_metadata(
+                (("grpc-status-details-bin", status.SerializeToString()),))
+            return p4runtime_pb2.WriteResponse()
+
+        self.servicer.Read.side_effect = _Read
+        self.servicer.Write.side_effect = _Write
+
+        async def _test(client):
+            with self.assertRaises(P4RuntimeException):
+                async for _ in client.read_one(p4runtime_pb2.Entity()):
+                    pass
+            with self.assertRaises(P4RuntimeWriteException) as cm:
+                await client.write(p4runtime_pb2.WriteRequest())
+            self.assertEqual(cm.exception.errors[0][0], 0)
+        self.run_async(_test)
+
+    def test_stream(self):
+        async def _test(client):
+            msg = p4runtime_pb2.StreamMessageRequest()
+            msg.packet.payload = b'payload'
+            await client.stream_send(msg)
+            # the event loop must keep running while we wait for the servicer
+            received = await asyncio.get_event_loop().run_in_executor(
+                None, lambda: self.servicer.stored_packet_out.get(timeout=1))
+            self.assertEqual(received, msg)
+            self.assertIsNone(await client.get_stream_packet("packet", timeout=0.1))
+        self.run_async(_test)
+
+
+class SessionManagerTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.servicer = P4RuntimeServicer()
+        self.servicer.Write = Mock(spec=[], return_value=p4runtime_pb2.WriteResponse())
+        self.servicer.Read = Mock(spec=[])
+        p4runtime_pb2_grpc.add_P4RuntimeServicer_to_server(self.servicer, self.server)
+        self.manager = SessionManager()
+        config = sh.FwdPipeConfig(self._p4info_path, self._config_path)
+        self.s0 = self.manager.connect(0, self.grpc_addr, (0, 1), config=config)
+        self.s1 = self.manager.connect(1, self.grpc_addr, (0, 1))
+
+    def tearDown(self):
+        self.manager.close_all()
+        super().tearDown()
+
+    def make_entry(self):
+        te = sh.TableEntry("ExactOne")(action="actionA")
+        te.match["header_test.field32"] = "10.0.0.1"
+        return te
+
+    def test_shared_context(self):
+        self.assertEqual(len(self.manager), 2)
+        self.assertIs(self.manager[(self.grpc_addr, 0)], self.s0)
+        self.assertIs(self.s0.context, self.s1.context)
+        self.assertEqual(self.manager.num_contexts(), 1)
+        with self.assertRaisesRegex(UserError, "already exists"):
+            self.manager.connect(1, self.grpc_addr, (0, 1))
+        self.manager.close(self.s1.key)
+        self.assertEqual(self.manager.num_contexts(), 1)
+        self.manager.close(self.s0.key)
+        self.assertEqual(self.manager.num_contexts(), 0)
+        with self.assertRaisesRegex(UserError, "Unknown session"):
+            self.manager[self.s0.key]
+
+    def test_connect_error(self):
+        # a port on which no server is listening
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
+        addr = "localhost:{}".format(server.add_insecure_port('[::]:0'))
+        server.stop(None)
+        with self.assertRaisesRegex(ConnectionError, "Cannot connect session"):
+            self.manager.connect(2, addr, (0, 1))
+        self.assertNotIn((addr, 2), self.manager)
+        self.assertEqual(self.manager.run(lambda s: s.client.device_id),
+                         {self.s0.key: 0, self.s1.key: 1})
+
+    def test_activate(self):
+        saved_client = sh.client
+        with self.s1:
+            self.assertIs(sh.client, self.s1.client)
+            self.make_entry().insert()
+        self.assertIs(sh.client, saved_client)
+        self.servicer.Write.assert_called_once_with(ANY, ANY)
+        self.assertEqual(self.servicer.Write.call_args[0][0].device_id, 1)
+
+    def test_fanout(self):
+        with self.manager.fanout():
+            self.make_entry().insert()
+            self.make_entry().delete()
+        self.assertEqual(self.servicer.Write.call_count, 2)
+        reqs = [c[0][0] for c in self.servicer.Write.call_args_list]
+        self.assertEqual(sorted(req.device_id for req in reqs), [0, 1])
+        for req in reqs:
+            self.assertEqual(len(req.updates), 2)
+
+        results = self.manager.run(lambda s: s.client.device_id)
+        self.assertEqual(results, {self.s0.key: 0, self.s1.key: 1})
+
+    def test_shadow_cache(self):
+        def _Read(request, context):
+            yield p4runtime_pb2.ReadResponse()
+        self.servicer.Read.side_effect = _Read
+
+        def read_values():
+            te = sh.TableEntry("ExactOne")
+            return sorted(te.match["header_test.field32"].exact.value for te in te.read())
+
+        caches = {}
+        for session in (self.s0, self.s1):
+            with session:
+                caches[session.key] = sh.shadow_cache(tables=["ExactOne"])
+                self.assertEqual(read_values(), [])
+        self.assertEqual(self.servicer.Read.call_count, 2)
+
+        # fanout writes update the cache of each session
+        with self.manager.fanout():
+            self.make_entry().insert()
+        with self.s1:
+            te = self.make_entry()
+            te.match["header_test.field32"] = "10.0.0.2"
+            te.insert()
+        with self.s0:
+            self.assertEqual(read_values(), [b'\x0a\x00\x00\x01'])
+        with self.s1:
+            self.assertEqual(read_values(), [b'\x0a\x00\x00\x01', b'\x0a\x00\x00\x02'])
+        self.assertEqual(self.servicer.Read.call_count, 2)
+
+        # a backup -> primary transition only invalidates the cache of that client
+        arbitration = p4runtime_pb2.MasterArbitrationUpdate()
+        arbitration.status.code = code_pb2.ALREADY_EXISTS
+        self.s1.client._update_primary(arbitration)
+        arbitration.status.code = code_pb2.OK
+        self.s1.client._update_primary(arbitration)
+        self.assertEqual(caches[self.s0.key].invalidations, 0)
+        self.assertEqual(caches[self.s1.key].invalidations, 1)
+
+        self.manager.close(self.s0.key)
+        self.assertNotIn(self.s0.client, sh._shadows)
+        self.assertIn(self.s1.client, sh._shadows)
+
+    def test_read_many(self):
+        entity = p4runtime_pb2.Entity()
+        entity.counter_entry.counter_id = 302055013
+
+        def _Read(request, context):
+            rep = p4runtime_pb2.ReadResponse()
+            rep.entities.add().CopyFrom(entity)
+            yield rep
+        self.servicer.Read.side_effect = _Read
+        results = list(self.manager.read_many([entity]))
+        self.assertEqual(sorted(r.device for r in results), sorted([self.s0.key, self.s1.key]))
+        sources = set(r.source for r in results)
+        self.assertEqual(sources, {self.s0.context.get_name_from_id(302055013)})
+        reqs = [c[0][0] for c in self.servicer.Read.call_args_list]
+        self.assertEqual(sorted(req.device_id for req in reqs), [0, 1])
+
+    def test_fanout_error(self):
+        def _Write(request, context):
+            if request.device_id == 1:
+                context.set_code(grpc.StatusCode.UNKNOWN)
+                status = status_pb2.Status(code=code_pb2.UNKNOWN)
+                p4_error = p4runtime_pb2.Error(canonical_code=code_pb2.INVALID_ARGUMENT)
+                status.details.add().Pack(p4_error)
+                context.set_trailing_metadata(
+                    (("grpc-status-details-bin", status.SerializeToString()),))
+            return p4runtime_pb2.WriteResponse()
+
+        self.servicer.Write.side_effect = _Write
+        with self.assertRaises(FanoutError) as cm:
+            with self.manager.fanout():
+                te = self.make_entry()
+                te.insert()
+        errors = cm.exception.errors
+        self.assertEqual(list(errors.keys()), [self.s1.key])
+        self.assertEqual(errors[self.s1.key].failed_entities[0][0].msg(), te.msg())